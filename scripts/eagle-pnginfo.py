@@ -1,67 +1,131 @@
+import time
+
+_IMPORT_START = time.perf_counter()
+
+import functools
 import os
 import gradio as gr
-import re
-from datetime import datetime
-import logging
+import threading
 from typing import Tuple, List, Optional
 
 from modules import paths, script_callbacks, shared
 from scripts.parser import Parser
 from scripts.tag_generator import TagGenerator
-from scripts.eagleapi import api_application, api_item, api_util, api_folder
+from scripts.eagleapi import hooks, scheduler, singleflight
+from scripts.pipeline import (
+    bundles,
+    encoder,
+    log,
+    prewarm,
+    profiler,
+    sinks,
+    startup,
+    tracing,
+)
+from scripts.pipeline.geninfo import prompt_tags
+from scripts.pipeline.payload import ImagePayload
 
 from PIL import Image, PngImagePlugin
 
-# Paperspace Gradient環境用: Google Drive API
-try:
-    from google.oauth2 import service_account
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload
-except ImportError:
-    pass
+# Eagle API (requests を含む) はローカル環境の送信が有効になって初めて読み込む
+api_folder = startup.LazyModule("scripts.eagleapi.api_folder", "eagle")
+outbox = startup.LazyModule("scripts.eagleapi.outbox", "eagle")
+relay = startup.LazyModule("scripts.eagleapi.relay", "eagle")
+shards = startup.LazyModule("scripts.eagleapi.shards", "eagle")
 
 # 定数
 EAGLE_SERVER_URL = "http://localhost"
 EAGLE_PORT = 41595
 STABLE_DIFFUSION_FOLDER_NAME = "stable diffusion"
 MOUNTED_DRIVE_FOLDER = "/content/gdrive/MyDrive/Eagle"
+# マウント済みDrive へ同期する前にいったん書き込むローカルディスク上のフォルダ
+MOUNTED_DRIVE_STAGING_FOLDER = "/content/eagle_staging"
+DRIVE_MAIN_FOLDER_ID = "1NuzFVjymjx5ByHPVqYKTDjDj6R3BlKvU"
 PATH_ROOT = paths.script_path
+EXTENSION_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTBOX_DB_FILE = os.path.join(EXTENSION_ROOT, "eagle_outbox.sqlite3")
+# Drive へまとめて送るアーカイブ (tar) を組み立てるローカルのフォルダ
+DRIVE_BUNDLE_DIR = os.path.join(EXTENSION_ROOT, "eagle_bundles")
+TRACE_DIR = os.path.join(EXTENSION_ROOT, "traces")
+PROFILE_DIR = os.path.join(EXTENSION_ROOT, "profiles")
+# このファイルがある間はスタックサンプラーを動かす (消すと停止して結果を書き出す)
+PROFILE_CONTROL_FILE = os.path.join(EXTENSION_ROOT, "eagle_profile.enable")
+# 0時の何秒前に翌日の日付フォルダを作っておくか
+PREWARM_LEAD_SECONDS = 600
+# scripts.eagleapi.shards.RULES と同じ (設定画面の登録時に eagleapi を読み込まないため)
+SHARD_RULES = ["seed", "prompt", "model", "round_robin"]
+
+# ロギングの設定 (webui のルートロガーには触れず、"eagle_pnginfo" ロガーだけを非同期化する)
+logger = log.setup_logging()
+_logging_conf = None
+# eagleapi の HTTP 呼び出しとアウトボックスの送信も処理トレースに記録する
+hooks.set_tracer(tracing)
+
+
+def configure_logging() -> None:
+    """設定画面のログ形式・レート制限・サンプリング率を反映します (変更が無ければ何もしません)。"""
+    global _logging_conf
+    conf = (
+        bool(getattr(shared.opts, "eagle_log_json", False)),
+        float(getattr(shared.opts, "eagle_log_rate_limit", 5)),
+        float(getattr(shared.opts, "eagle_log_sample_rate", 1.0)),
+    )
+    if conf != _logging_conf:
+        log.setup_logging(
+            json_format=conf[0], rate_limit_per_sec=conf[1], sample_rate=conf[2]
+        )
+        _logging_conf = conf
 
-# ロギングの設定
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    force=True,
-)
 
-# -----------------------------------------------------------------------------
-# ユーティリティ関数
-# -----------------------------------------------------------------------------
-def split_prompt(prompt: str) -> List[str]:
-    """プロンプトをトークンに分割します。
+_tracing_conf = None
 
-    Args:
-        prompt: 分割するプロンプト文字列
 
-    Returns:
-        分割されたトークンのリスト
-    """
-    tokens = re.split(r",|\s*(?i:break)\s*", prompt)
-    return [token.strip() for token in tokens if token.strip()]
+def configure_tracing() -> None:
+    """設定画面のトレース出力形式とサンプリング率を反映します (0なら無効)。"""
+    global _tracing_conf
+    conf = (
+        getattr(shared.opts, "eagle_trace_format", tracing.FORMAT_JSONL),
+        float(getattr(shared.opts, "eagle_trace_sample_rate", 0.0)),
+    )
+    if conf != _tracing_conf:
+        fmt, sample_rate = conf
+        ext = ".json" if fmt == tracing.FORMAT_CHROME else ".jsonl"
+        tracing.configure(
+            os.path.join(TRACE_DIR, "eagle_pnginfo_trace" + ext),
+            fmt=fmt,
+            sample_rate=sample_rate,
+        )
+        _tracing_conf = conf
 
 
-def process_prompt(prompt: str, prefix: str = "") -> List[str]:
-    """プロンプトを処理し、接頭辞を付けてリストを返します。
+_profiling_conf = None
 
-    Args:
-        prompt: 処理するプロンプト文字列
-        prefix: トークンに付ける接頭辞 (デフォルトは空)
 
-    Returns:
-        処理されたトークンのリスト
-    """
-    tokens = split_prompt(prompt)
-    return [f"{prefix}{token}" for token in tokens] if prefix else tokens
+def configure_profiling() -> None:
+    """設定画面のプロファイル間隔とスタックサンプラーの ON/OFF を反映します。"""
+    global _profiling_conf
+    conf = (
+        int(getattr(shared.opts, "eagle_profile_every_n", 0)),
+        bool(getattr(shared.opts, "eagle_profile_sampler", False)),
+    )
+    if conf != _profiling_conf:
+        profiler.configure(PROFILE_DIR, every_n=conf[0], sampler_enabled=conf[1])
+        _profiling_conf = conf
+
+
+_scheduler_conf = None
+
+
+def configure_scheduler() -> None:
+    """設定画面の Eagle へのリクエスト数の上限と応答時間に応じた自動調整を反映します。"""
+    global _scheduler_conf
+    conf = (
+        float(getattr(shared.opts, "eagle_rate_limit", 0)),
+        bool(getattr(shared.opts, "eagle_adaptive_throttle", False)),
+    )
+    if conf != _scheduler_conf:
+        scheduler.configure(rate=conf[0], adaptive=conf[1])
+        _scheduler_conf = conf
 
 
 # -----------------------------------------------------------------------------
@@ -110,14 +174,12 @@ def generate_tags(
     annotation = (
         params.pnginfo.get("parameters") if shared.opts.embed_generation_info else None
     )
-    tags = []
-    if shared.opts.save_positive_prompt_tags and positive_prompt:
-        tags += process_prompt(positive_prompt)
-    if negative_prompt:
-        if shared.opts.save_negative_prompt_tags == "tag":
-            tags += process_prompt(negative_prompt)
-        elif shared.opts.save_negative_prompt_tags == "n:tag":
-            tags += process_prompt(negative_prompt, prefix="n:")
+    tags = prompt_tags(
+        positive_prompt,
+        negative_prompt,
+        shared.opts.save_positive_prompt_tags,
+        shared.opts.save_negative_prompt_tags,
+    )
     if shared.opts.additional_tags:
         tag_gen = TagGenerator(p=params.p, image=params.image)
         additional = tag_gen.generate_from_p(shared.opts.additional_tags)
@@ -179,37 +241,44 @@ def fetch_or_create_stable_diffusion_folder(
     Returns:
         フォルダID
     """
-    logging.debug(f"Fetching or creating '{STABLE_DIFFUSION_FOLDER_NAME}' folder")
-    resp = api_folder.list(server_url=server_url, port=port)
-    if resp.status_code != 200:
-        logging.error(f"Eagleフォルダ一覧取得失敗: {resp.text}")
-        return ""
-    folder_list = api_util.getAllFolder(resp)
-    if not folder_list:
-        logging.error("フォルダ一覧が空または解析失敗")
+    # 同時に呼ばれても一覧の取得と作成は 1 回にまとめる
+    return singleflight.folders.do(
+        (server_url, port, None, STABLE_DIFFUSION_FOLDER_NAME),
+        _fetch_or_create_stable_diffusion_folder,
+        server_url,
+        port,
+    )
+
+
+def _fetch_or_create_stable_diffusion_folder(server_url: str, port: int) -> str:
+    logger.debug(f"Fetching or creating '{STABLE_DIFFUSION_FOLDER_NAME}' folder")
+    mirror = api_folder.get_mirror(server_url, port)
+    if not mirror.ensure_loaded():
+        logger.error("Eagleフォルダ一覧取得失敗")
         return ""
-    for fd in folder_list:
-        if fd.get("name") == STABLE_DIFFUSION_FOLDER_NAME:
-            logging.info(
-                f"Found existing '{STABLE_DIFFUSION_FOLDER_NAME}' folder: ID={fd.get('id')}"
-            )
-            return fd.get("id")
-    logging.info(f"'{STABLE_DIFFUSION_FOLDER_NAME}' フォルダが無いので新規作成します")
+    mirror.start_background_sync()
+    fd = mirror.find_by_name(STABLE_DIFFUSION_FOLDER_NAME)
+    if fd is not None:
+        logger.info(
+            f"Found existing '{STABLE_DIFFUSION_FOLDER_NAME}' folder: ID={fd.get('id')}"
+        )
+        return fd.get("id")
+    logger.info(f"'{STABLE_DIFFUSION_FOLDER_NAME}' フォルダが無いので新規作成します")
     r_create = api_folder.create(
         STABLE_DIFFUSION_FOLDER_NAME, server_url=server_url, port=port
     )
     if r_create.status_code == 200:
         try:
             new_id = r_create.json()["data"]["id"]
-            logging.info(
+            logger.info(
                 f"Created '{STABLE_DIFFUSION_FOLDER_NAME}' folder: ID={new_id}"
             )
             return new_id
         except:
-            logging.error("フォルダ作成後のレスポンス解析に失敗")
+            logger.error("フォルダ作成後のレスポンス解析に失敗")
             return ""
     else:
-        logging.error(f"'{STABLE_DIFFUSION_FOLDER_NAME}' フォルダ作成失敗: {r_create.text}")
+        logger.error(f"'{STABLE_DIFFUSION_FOLDER_NAME}' フォルダ作成失敗: {r_create.text}")
         return ""
 
 
@@ -233,24 +302,32 @@ def find_or_create_subfolder(
     Returns:
         サブフォルダID
     """
-    logging.debug(
+    # 同時に呼ばれても一覧の取得と作成は 1 回にまとめる (同名フォルダの重複作成を防ぐ)
+    return singleflight.folders.do(
+        (server_url, port, parent_id, subfolder_name),
+        _find_or_create_subfolder,
+        parent_id,
+        subfolder_name,
+        server_url,
+        port,
+    )
+
+
+def _find_or_create_subfolder(
+    parent_id: str, subfolder_name: str, server_url: str, port: int
+) -> str:
+    logger.debug(
         f"find_or_create_subfolder 開始: parent_id={parent_id}, subfolder_name={subfolder_name}"
     )
-    r_list = api_folder.list(server_url=server_url, port=port)
-    if r_list.status_code != 200:
-        logging.error(f"サブフォルダ検索: フォルダ一覧取得失敗: {r_list.text}")
+    mirror = api_folder.get_mirror(server_url, port)
+    if not mirror.ensure_loaded():
+        logger.error("サブフォルダ検索: フォルダ一覧取得失敗")
         return ""
-    folder_list = api_util.getAllFolder(r_list)
-    if not folder_list:
-        logging.error("サブフォルダ検索: フォルダ一覧が空または解析失敗")
-        return ""
-    for fd in folder_list:
-        if fd.get("name") == subfolder_name and "stable diffusion" in fd.get(
-            "extendTags", []
-        ):
-            logging.info(f"既存サブフォルダあり: '{subfolder_name}' (ID={fd.get('id')})")
-            return fd.get("id")
-    logging.info(f"サブフォルダ '{subfolder_name}' が無いので新規作成")
+    fd = mirror.find_child(parent_id, subfolder_name)
+    if fd is not None:
+        logger.info(f"既存サブフォルダあり: '{subfolder_name}' (ID={fd.get('id')})")
+        return fd.get("id")
+    logger.info(f"サブフォルダ '{subfolder_name}' が無いので新規作成")
     r_sub = api_folder.create_subfolder(
         newfoldername=subfolder_name,
         parent_id=parent_id,
@@ -261,192 +338,318 @@ def find_or_create_subfolder(
     if r_sub.status_code == 200:
         try:
             new_id = r_sub.json()["data"]["id"]
-            logging.info(f"サブフォルダ '{subfolder_name}' 作成完了: ID={new_id}")
+            logger.info(f"サブフォルダ '{subfolder_name}' 作成完了: ID={new_id}")
             return new_id
         except Exception as e:
-            logging.error(f"サブフォルダ作成レスポンス解析失敗: {str(e)}")
+            logger.error(f"サブフォルダ作成レスポンス解析失敗: {str(e)}")
             return ""
     else:
-        logging.error(f"サブフォルダ作成失敗: {r_sub.text}")
+        logger.error(f"サブフォルダ作成失敗: {r_sub.text}")
         return ""
 
 
 # -----------------------------------------------------------------------------
-# 画像保存処理
+# Eagle用: 送信アウトボックス
 # -----------------------------------------------------------------------------
-def save_image_to_drive(
-    image: Image.Image,
-    png_metadata: PngImagePlugin.PngInfo,
-    filename: str,
-    params: script_callbacks.ImageSaveParams,
-    main_folder_id: str = "1NuzFVjymjx5ByHPVqYKTDjDj6R3BlKvU",
-) -> None:
-    """Google Driveに画像を保存します。
-
-    Args:
-        image: 保存する画像オブジェクト
-        png_metadata: PNGメタデータ
-        filename: ファイル名
-        params: 画像保存パラメータ
-        main_folder_id: メインフォルダID
-    """
-    date_str = datetime.now().strftime("%Y-%m-%d")
-    temp_image_path = os.path.join("/tmp", "temp_" + filename)
-    try:
-        image.save(temp_image_path, pnginfo=png_metadata)
-        logging.info(f"一時画像ファイルを保存しました: {temp_image_path}")
-    except Exception as e:
-        logging.error("一時画像ファイルの保存に失敗しました")
-        logging.error(str(e))
-        return
-    try:
-        credentials = service_account.Credentials.from_service_account_file(
-            os.path.join(PATH_ROOT, "service_account.json"),
-            scopes=["https://www.googleapis.com/auth/drive"],
-        )
-        drive_service = build("drive", "v3", credentials=credentials)
-        query = f"name='{date_str}' and mimeType='application/vnd.google-apps.folder' and '{main_folder_id}' in parents and trashed=false"
-        response = (
-            drive_service.files()
-            .list(q=query, spaces="drive", fields="files(id, name)")
-            .execute()
-        )
-        files = response.get("files", [])
-        if files:
-            date_folder_id = files[0]["id"]
-            logging.info(f"既存の日付フォルダが見つかりました: {date_str}")
-        else:
-            folder_metadata = {
-                "name": date_str,
-                "mimeType": "application/vnd.google-apps.folder",
-                "parents": [main_folder_id],
-            }
-            folder = (
-                drive_service.files()
-                .create(body=folder_metadata, fields="id")
-                .execute()
-            )
-            date_folder_id = folder.get("id")
-            logging.info(f"日付フォルダを作成しました: {date_str}")
-        file_metadata = {"name": filename, "parents": [date_folder_id]}
-        media = MediaFileUpload(temp_image_path, mimetype="image/png")
-        file = (
-            drive_service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
-        )
-        logging.info(f"Google Driveにアップロード完了 (ID): {file.get('id')}")
-    except Exception as e:
-        logging.error("Google Driveへのアップロードに失敗しました")
-        logging.error(str(e))
-    finally:
-        try:
-            os.remove(temp_image_path)
-            logging.info(f"一時画像ファイルを削除しました: {temp_image_path}")
-        except Exception as e:
-            logging.error("一時画像ファイルの削除に失敗しました")
-            logging.error(str(e))
-
-
-def save_image_to_mounted_drive(
-    image: Image.Image, png_metadata: PngImagePlugin.PngInfo, filename: str
-) -> None:
-    """マウント済みDriveに画像を保存します。
-
-    Args:
-        image: 保存する画像オブジェクト
-        png_metadata: PNGメタデータ
-        filename: ファイル名
-    """
-    date_str = datetime.now().strftime("%Y-%m-%d")
-    drive_date_folder = os.path.join(MOUNTED_DRIVE_FOLDER, date_str)
-    if not os.path.exists(drive_date_folder):
-        os.makedirs(drive_date_folder, exist_ok=True)
-        logging.info(f"日付フォルダを作成しました: {drive_date_folder}")
-    destination_path = os.path.join(drive_date_folder, filename)
-    try:
-        image.save(destination_path, pnginfo=png_metadata)
-        logging.info(f"Colabのマウント済みDriveに保存しました: {destination_path}")
-    except Exception as e:
-        logging.error("Colabのマウント済みDriveへの保存に失敗しました")
-        logging.error(str(e))
+_outbox = None
+_outbox_lock = threading.Lock()
 
 
-def send_image_to_eagle(
-    fullfn: str,
-    filename: str,
-    annotation: Optional[str],
-    tags: List[str],
-    server_url: str = EAGLE_SERVER_URL,
-    port: int = EAGLE_PORT,
-) -> None:
-    """Eagle APIを使用して画像を送信します。
+def resolve_eagle_folder(folder: str, server_url: str, port: int) -> str:
+    """アウトボックスのフォルダ指定 (日付文字列) をフォルダIDに解決します。
 
     Args:
-        fullfn: 画像のフルパス
-        filename: ファイル名
-        annotation: アノテーション
-        tags: タグのリスト
+        folder: stable diffusionフォルダ配下のサブフォルダ名
         server_url: EagleサーバーのURL
         port: Eagleサーバーのポート
+
+    Returns:
+        サブフォルダID (失敗時は空文字)
     """
-    if not shared.opts.use_local_env:
-        logging.info("ローカル環境でEagle転送が無効です")
-        return
-    logging.info("ローカル環境でEagle転送を試みます")
     stable_folder_id = fetch_or_create_stable_diffusion_folder(
         server_url=server_url, port=port
     )
     if not stable_folder_id:
-        logging.error("stable diffusionフォルダの取得または作成に失敗")
-        return
-    date_str = datetime.now().strftime("%Y-%m-%d")
+        logger.error("stable diffusionフォルダの取得または作成に失敗")
+        return ""
     target_folder_id = find_or_create_subfolder(
-        stable_folder_id, date_str, server_url=server_url, port=port
+        stable_folder_id, folder, server_url=server_url, port=port
     )
     if not target_folder_id:
-        logging.error(f"日付サブフォルダ '{date_str}' の作成に失敗")
-        return
-    logging.info(f"日付サブフォルダ '{date_str}' を取得しました (ID={target_folder_id})")
-    item = api_item.EAGLE_ITEM_PATH(
-        filefullpath=fullfn, filename=filename, annotation=annotation, tags=tags
-    )
-    _ret = api_item.add_from_path(item=item, folderId=target_folder_id)
-    if _ret.status_code == 200:
-        logging.info(f"Eagle転送成功: {fullfn}")
-    else:
-        logging.error(f"Eagle転送失敗: {_ret.status_code}, {_ret.content}")
+        logger.error(f"日付サブフォルダ '{folder}' の作成に失敗")
+    return target_folder_id
+
+
+def get_outbox() -> "outbox.Outbox":
+    """送信アウトボックスを取得します (初回呼び出し時にリプレイヤーを起動)。
+
+    Returns:
+        Outboxオブジェクト
+    """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = outbox.Outbox(OUTBOX_DB_FILE, resolve_eagle_folder)
+            _outbox.start()
+        return _outbox
+
+
+_relay_outbox = None
+
+
+def get_eagle_queue():
+    """Eagle への送信ジョブの積み先を返します。
+
+    中継デーモンの URL が設定されていればそちらへ渡し (停止中はローカルのアウトボックスへ)、
+    無ければローカルのアウトボックスを使います。
+
+    Returns:
+        enqueue(item, folder, server_url=, port=) を持つオブジェクト
+    """
+    global _relay_outbox
+    relay_url = getattr(shared.opts, "eagle_relay_url", "").strip()
+    if not relay_url:
+        return get_outbox()
+    with _outbox_lock:
+        if _relay_outbox is None or _relay_outbox.client.url != relay_url.rstrip("/"):
+            _relay_outbox = relay.RelayOutbox(relay.RelayClient(relay_url), get_outbox)
+        return _relay_outbox
+
+
+# -----------------------------------------------------------------------------
+# Eagle用: 複数サーバーへの振り分け
+# -----------------------------------------------------------------------------
+_shard_router = None
+_shard_router_conf = None
+_shard_router_lock = threading.Lock()
+
+
+def get_shard_router() -> "shards.ShardRouter":
+    """設定の送信先一覧と振り分けルールから ShardRouter を取得します。
+
+    Returns:
+        ShardRouterオブジェクト (送信先が未設定ならローカルのEagleのみ)
+    """
+    global _shard_router, _shard_router_conf
+    conf = (shared.opts.eagle_shard_endpoints, shared.opts.eagle_shard_rule)
+    with _shard_router_lock:
+        if _shard_router is None or _shard_router_conf != conf:
+            shard_list = shards.parse_endpoints(conf[0] or "")
+            if not shard_list:
+                shard_list = [shards.EagleShard(EAGLE_SERVER_URL, EAGLE_PORT)]
+            rule = conf[1] if conf[1] in shards.RULES else shards.RULE_SEED
+            _shard_router = shards.ShardRouter(shard_list, rule=rule)
+            _shard_router_conf = conf
+            logger.info(f"Eagle送信先: {shard_list} (rule={rule})")
+        return _shard_router
+
+
+def route_hints(params: script_callbacks.ImageSaveParams) -> dict:
+    """送信先サーバーの振り分けに使う情報を取り出します。
+
+    Args:
+        params: 画像保存パラメータ
+
+    Returns:
+        {"seed", "prompt", "model"} の辞書
+    """
+    try:
+        model = shared.sd_model.sd_checkpoint_info.model_name
+    except Exception:
+        model = None
+    return {
+        "seed": getattr(params.p, "seed", None),
+        "prompt": getattr(params.p, "prompt", None),
+        "model": model,
+    }
+
+
+def route_eagle_shard(**hints) -> "shards.EagleShard":
+    """振り分け情報から送信先の Eagle サーバーを決定します。"""
+    return get_shard_router().route(**hints)
 
 
 # -----------------------------------------------------------------------------
 # 画像保存処理の統合
 # -----------------------------------------------------------------------------
+_dispatcher = sinks.SinkDispatcher()
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def _get_sink(name: str, factory):
+    with _sinks_lock:
+        sink = _sinks.get(name)
+        if sink is None:
+            sink = factory()
+            _sinks[name] = sink
+        return sink
+
+
+_archive_encoder = None
+
+
+def get_archive_encoder() -> encoder.ImageEncoder:
+    """Drive / アーカイブ系の送信先で使うエンコード設定を返します。
+
+    Returns:
+        ImageEncoderオブジェクト
+    """
+    global _archive_encoder
+    conf = (
+        shared.opts.eagle_archive_format,
+        int(shared.opts.eagle_png_compress_level),
+        int(shared.opts.eagle_encode_process_workers),
+    )
+    if _archive_encoder is None or (
+        _archive_encoder.fmt,
+        _archive_encoder.compress_level,
+        _archive_encoder.process_workers,
+    ) != conf:
+        _archive_encoder = encoder.ImageEncoder(*conf)
+    return _archive_encoder
+
+
+def get_bundle_limits() -> Optional[bundles.BundleLimits]:
+    """Drive 系の送信先でアーカイブにまとめる条件を返します (無効なら None)。"""
+    if not getattr(shared.opts, "eagle_drive_bundle", False):
+        return None
+    return bundles.BundleLimits(
+        max_count=int(getattr(shared.opts, "eagle_drive_bundle_max_count", 500)),
+        max_bytes=int(getattr(shared.opts, "eagle_drive_bundle_max_mb", 256)) * 1024 * 1024,
+        max_seconds=float(getattr(shared.opts, "eagle_drive_bundle_max_seconds", 300)),
+    )
+
+
+def configured_sinks() -> List[sinks.Sink]:
+    """設定で有効になっている送信先の一覧を返します。
+
+    Returns:
+        送信先のリスト
+    """
+    archive_encoder = get_archive_encoder()
+    bundle_limits = get_bundle_limits()
+    bundle_dir = DRIVE_BUNDLE_DIR if bundle_limits else None
+    # 条件を変えたら新しい送信先を作る (古い方の開いているアーカイブは時間切れで閉じて送られる)
+    bundle_key = f":bundle{bundle_limits.key()}" if bundle_limits else ""
+    result = []
+    if shared.opts.use_local_env:
+        result.append(
+            _get_sink(
+                "eagle", lambda: sinks.EagleSink(get_eagle_queue, route_eagle_shard)
+            )
+        )
+    if shared.opts.use_paperspace_env:
+        result.append(
+            _get_sink(
+                "drive_api" + bundle_key,
+                lambda: sinks.DriveApiSink(
+                    os.path.join(PATH_ROOT, "service_account.json"),
+                    DRIVE_MAIN_FOLDER_ID,
+                    bundle_dir=bundle_dir,
+                    bundle_limits=bundle_limits,
+                ),
+            )
+        )
+    if shared.opts.use_colab_env:
+        if getattr(shared.opts, "eagle_drive_staging", False):
+            result.append(
+                _get_sink(
+                    "mounted_drive:staged" + bundle_key,
+                    lambda: sinks.MountedDriveSink(
+                        MOUNTED_DRIVE_FOLDER,
+                        staging_dir=MOUNTED_DRIVE_STAGING_FOLDER,
+                        bundle_dir=bundle_dir,
+                        bundle_limits=bundle_limits,
+                    ),
+                )
+            )
+        else:
+            result.append(
+                _get_sink(
+                    "mounted_drive" + bundle_key,
+                    lambda: sinks.MountedDriveSink(
+                        MOUNTED_DRIVE_FOLDER,
+                        bundle_dir=bundle_dir,
+                        bundle_limits=bundle_limits,
+                    ),
+                )
+            )
+    archive_dir = shared.opts.local_archive_dir
+    if shared.opts.use_local_archive and archive_dir:
+        result.append(
+            _get_sink(
+                f"local_archive:{archive_dir}",
+                lambda: sinks.LocalArchiveSink(archive_dir),
+            )
+        )
+    for sink in result:
+        if hasattr(sink, "encoder"):
+            sink.encoder = archive_encoder
+    return result
+
+
 def save_or_send_image(
-    image: Image.Image,
-    png_metadata: PngImagePlugin.PngInfo,
+    payload: ImagePayload,
     filename: str,
     params: script_callbacks.ImageSaveParams,
     annotation: Optional[str],
     tags: List[str],
 ) -> None:
-    """画像を保存または送信します。
+    """有効な全送信先へ画像を並行して保存または送信します。
 
     Args:
-        image: 保存する画像オブジェクト
-        png_metadata: PNGメタデータ
+        payload: 保存する画像データ
         filename: ファイル名
         params: 画像保存パラメータ
         annotation: アノテーション
         tags: タグのリスト
     """
     fullfn = os.path.join(PATH_ROOT, params.filename)
-    logging.debug(f"画像保存処理開始: filename={filename}, fullfn={fullfn}")
-    if shared.opts.use_paperspace_env:
-        save_image_to_drive(image, png_metadata, filename, params)
-    elif shared.opts.use_colab_env:
-        save_image_to_mounted_drive(image, png_metadata, filename)
-    else:
-        send_image_to_eagle(fullfn, filename, annotation, tags)
+    logger.debug("画像保存処理開始: filename=%s, fullfn=%s", filename, fullfn)
+    targets = configured_sinks()
+    if not targets:
+        logger.debug("有効な送信先がありません")
+        return
+    job = sinks.ImageJob(
+        payload,
+        filename,
+        fullfn,
+        annotation=annotation,
+        tags=tags,
+        route=route_hints(params),
+    )
+    _dispatcher.dispatch(job, targets)
+
+
+# -----------------------------------------------------------------------------
+# 日付フォルダの事前作成
+# -----------------------------------------------------------------------------
+def prewarm_eagle_folder(shard: "shards.EagleShard", date_str: str) -> bool:
+    """Eagle サーバーの stable diffusion フォルダと日付サブフォルダを用意します。"""
+    # 急ぎではないので、画像の送信より後回しにする
+    with scheduler.priority(scheduler.BACKFILL):
+        return bool(resolve_eagle_folder(date_str, shard.server_url, shard.port))
+
+
+def prewarm_targets() -> List[prewarm.PrewarmTarget]:
+    """有効な送信先ごとの日付フォルダ事前作成の対象を返します。"""
+    targets = []
+    for sink in configured_sinks():
+        if isinstance(sink, sinks.EagleSink):
+            for shard in get_shard_router().shards:
+                targets.append(
+                    (f"eagle:{shard.name}", functools.partial(prewarm_eagle_folder, shard))
+                )
+        elif hasattr(sink, "prewarm"):
+            root = getattr(sink, "root", None)
+            targets.append((f"{sink.name}:{root}" if root else sink.name, sink.prewarm))
+    return targets
+
+
+_prewarm_scheduler = prewarm.PrewarmScheduler(
+    prewarm_targets, lead_seconds=PREWARM_LEAD_SECONDS
+)
 
 
 # -----------------------------------------------------------------------------
@@ -458,24 +661,68 @@ def on_image_saved(params: script_callbacks.ImageSaveParams) -> None:
     Args:
         params: 画像保存パラメータ
     """
-    logging.info("画像処理を開始します。")
-    image_path = os.path.join(PATH_ROOT, params.filename)
-    filename = os.path.basename(image_path)
-    logging.debug(f"Image path: {image_path}, filename: {filename}")
+    configure_logging()
+    configure_tracing()
+    configure_profiling()
+    configure_scheduler()
+    profiler.profile_call("on_image_saved", _handle_image_saved, params)
 
-    info, positive_prompt, negative_prompt = extract_prompt_info(params)
-    annotation, tags = generate_tags(params, positive_prompt, negative_prompt)
 
-    try:
-        image_obj = Image.open(image_path)
-        logging.debug(f"画像ファイルを開きました: {image_path}")
-    except Exception as e:
-        logging.error("画像ファイルのオープンに失敗しました")
-        logging.error(str(e))
-        return
-
-    png_metadata = create_png_metadata(annotation, tags, info, params)
-    save_or_send_image(image_obj, png_metadata, filename, params, annotation, tags)
+def _handle_image_saved(params: script_callbacks.ImageSaveParams) -> None:
+    image_path = os.path.join(PATH_ROOT, params.filename)
+    filename = os.path.basename(image_path)
+    logger.debug("画像処理を開始します: %s", image_path)
+
+    with tracing.trace("on_image_saved", filename=filename):
+        with tracing.span("extract"):
+            info, positive_prompt, negative_prompt = extract_prompt_info(params)
+        with tracing.span("tag"):
+            annotation, tags = generate_tags(params, positive_prompt, negative_prompt)
+
+        # webuiが書き出したファイルを読み直さず、メモリ上の params.image を使う
+        image_obj = params.image
+        if image_obj is None:
+            try:
+                with tracing.span("open"), Image.open(image_path) as im:
+                    im.load()
+                    image_obj = im.copy()
+            except Exception as e:
+                logger.error("画像ファイルのオープンに失敗しました: %s", e)
+                return
+
+        with tracing.span("metadata"):
+            png_metadata = create_png_metadata(annotation, tags, info, params)
+        # Annotation/Tags を追加しない場合は保存済みファイルと同じ内容なので、再エンコードせず使う
+        reuse_source = (
+            not annotation
+            and not tags
+            and bool(info)
+            and image_path.lower().endswith(".png")
+        )
+        with ImagePayload(
+            image_obj, png_metadata, source_path=image_path, reuse_source=reuse_source
+        ) as payload:
+            save_or_send_image(payload, filename, params, annotation, tags)
+
+
+def on_app_started(demo, app) -> None:
+    """起動時間を報告し、前回の未送信ジョブの再送と日付フォルダの事前作成を開始します。"""
+    configure_logging()
+    configure_tracing()
+    configure_profiling()
+    configure_scheduler()
+    profiler.install_signal_handler()
+    profiler.watch_control_file(PROFILE_CONTROL_FILE)
+    startup.check_budget("extension")
+    logger.info(startup.format_report())
+    # ルートと今日の日付フォルダを解決し、0時前には翌日分を作っておく
+    _prewarm_scheduler.start()
+    # 中継デーモンを使う設定なら、前回ローカルに積んだジョブが残っているときだけ開く
+    relay_url = getattr(shared.opts, "eagle_relay_url", "").strip()
+    if shared.opts.use_local_env and (not relay_url or os.path.exists(OUTBOX_DB_FILE)):
+        pending = get_outbox().pending_count()
+        if pending:
+            logger.info(f"未送信のEagleジョブを再送します: {pending}件")
 
 
 # -----------------------------------------------------------------------------
@@ -495,10 +742,206 @@ def on_ui_settings() -> None:
             False, "Paperspace Gradient環境", section=("eagle_pnginfo", "Eagle Pnginfo")
         ),
     )
+    shared.opts.add_option(
+        "eagle_drive_staging",
+        shared.OptionInfo(
+            False,
+            "Google Colab: ローカルに保存してからDriveへまとめて同期する",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_drive_bundle",
+        shared.OptionInfo(
+            False,
+            "Google Drive: 画像をまとめてアーカイブ (tar) で転送する (監視スクリプトが展開して取り込む)",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_drive_bundle_max_count",
+        shared.OptionInfo(
+            500,
+            "アーカイブ1つあたりの画像数の上限",
+            gr.Slider,
+            {"minimum": 10, "maximum": 5000, "step": 10},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_drive_bundle_max_mb",
+        shared.OptionInfo(
+            256,
+            "アーカイブ1つあたりのサイズの上限 (MB)",
+            gr.Slider,
+            {"minimum": 16, "maximum": 4096, "step": 16},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_drive_bundle_max_seconds",
+        shared.OptionInfo(
+            300,
+            "アーカイブを閉じて転送するまでの最大待ち時間 (秒)",
+            gr.Slider,
+            {"minimum": 10, "maximum": 3600, "step": 10},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
     shared.opts.add_option(
         "use_local_env",
         shared.OptionInfo(False, "ローカル環境", section=("eagle_pnginfo", "Eagle Pnginfo")),
     )
+    shared.opts.add_option(
+        "eagle_relay_url",
+        shared.OptionInfo(
+            "",
+            "中継デーモンのURL (例: http://127.0.0.1:41600、空ならEagleへ直接送信)",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "use_local_archive",
+        shared.OptionInfo(
+            False, "ローカルアーカイブに保存", section=("eagle_pnginfo", "Eagle Pnginfo")
+        ),
+    )
+    shared.opts.add_option(
+        "local_archive_dir",
+        shared.OptionInfo(
+            "", "ローカルアーカイブの保存先", section=("eagle_pnginfo", "Eagle Pnginfo")
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_archive_format",
+        shared.OptionInfo(
+            encoder.FORMAT_PNG,
+            "Drive/アーカイブの保存形式",
+            gr.Radio,
+            {"choices": encoder.FORMATS},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_png_compress_level",
+        shared.OptionInfo(
+            6,
+            "Drive/アーカイブのPNG圧縮レベル",
+            gr.Slider,
+            {"minimum": 0, "maximum": 9, "step": 1},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_encode_process_workers",
+        shared.OptionInfo(
+            0,
+            "エンコード用プロセス数 (0ならwebuiプロセス内でエンコード)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 8, "step": 1},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_shard_endpoints",
+        shared.OptionInfo(
+            "",
+            "Eagleサーバー一覧 (url:port をカンマ区切り、空ならローカルのみ)",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_shard_rule",
+        shared.OptionInfo(
+            SHARD_RULES[0],
+            "複数サーバーへの振り分けルール",
+            gr.Radio,
+            {"choices": SHARD_RULES},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_rate_limit",
+        shared.OptionInfo(
+            0,
+            "Eagleサーバーごとのリクエスト数の上限 (件/秒、0で無制限)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 100, "step": 1},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_adaptive_throttle",
+        shared.OptionInfo(
+            False,
+            "Eagleの応答が遅くなったらバックグラウンドの送信を絞る",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_log_json",
+        shared.OptionInfo(
+            False, "ログをJSON形式で出力", section=("eagle_pnginfo", "Eagle Pnginfo")
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_log_rate_limit",
+        shared.OptionInfo(
+            5,
+            "同じログ行の出力上限 (件/秒、0で無制限)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 100, "step": 1},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_log_sample_rate",
+        shared.OptionInfo(
+            1.0,
+            "INFOログの出力割合 (1で全件)",
+            gr.Slider,
+            {"minimum": 0.01, "maximum": 1.0, "step": 0.01},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_trace_sample_rate",
+        shared.OptionInfo(
+            0.0,
+            "処理トレースを記録する割合 (0で無効、extensions/.../traces に出力)",
+            gr.Slider,
+            {"minimum": 0.0, "maximum": 1.0, "step": 0.01},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_trace_format",
+        shared.OptionInfo(
+            tracing.FORMAT_JSONL,
+            "処理トレースの形式 (chrome: chrome://tracing / Perfetto で開ける)",
+            gr.Radio,
+            {"choices": tracing.FORMATS},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_profile_every_n",
+        shared.OptionInfo(
+            0,
+            "N枚に1枚をcProfileで計測 (0で無効、extensions/.../profiles に出力)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 1000, "step": 1},
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
+    shared.opts.add_option(
+        "eagle_profile_sampler",
+        shared.OptionInfo(
+            False,
+            "スタックサンプラーを有効にする (SIGUSR2 / eagle_profile.enable でも切替可)",
+            section=("eagle_pnginfo", "Eagle Pnginfo"),
+        ),
+    )
     shared.opts.add_option(
         "embed_generation_info",
         shared.OptionInfo(
@@ -534,3 +977,6 @@ def on_ui_settings() -> None:
 # -----------------------------------------------------------------------------
 script_callbacks.on_image_saved(on_image_saved)
 script_callbacks.on_ui_settings(on_ui_settings)
+script_callbacks.on_app_started(on_app_started)
+
+startup.record("extension", "import", time.perf_counter() - _IMPORT_START)
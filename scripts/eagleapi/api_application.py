@@ -2,7 +2,7 @@
 #
 import requests
 
-from . import api_util
+from . import api_util, circuit, transport
 
 def info(server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10):
     """EAGLE API:/api/application/info
@@ -11,10 +11,10 @@ def info(server_url="http://localhost", port=41595, timeout_connect=3, timeout_r
         Response: return of requests.post
     """
 
-    API_URL = f"{server_url}:{port}/api/application/info"
+    API_PATH = "/api/application/info"
 
     try:
-        r_get = requests.get(API_URL, timeout=(timeout_connect, timeout_read))
+        r_get = transport.get(server_url, port, API_PATH, timeout=(timeout_connect, timeout_read))
     except requests.exceptions.Timeout as e:
         print("Error: api_application.info")
         print(e)
@@ -28,6 +28,10 @@ def info(server_url="http://localhost", port=41595, timeout_connect=3, timeout_r
 def is_alive(server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10):
     if not port or type(port) != int or port == "":
         port=41595
+    # open 中や直近の結果があれば、リクエストせずにキャッシュ済みの状態を返す
+    cached = circuit.get_breaker(server_url, port).cached_health()
+    if cached is not None:
+        return cached
     try:
         r_get = info(server_url, port, timeout_connect, timeout_read)
     except Exception as e:
@@ -2,8 +2,10 @@
 #
 import requests
 import sys
+import threading
+import time
 
-from . import api_util
+from . import transport
 
 
 def create(
@@ -21,7 +23,7 @@ def create(
     Returns:
         list(response dict): return list of response.json()
     """
-    API_URL = f"{server_url}:{port}/api/folder/create"
+    API_PATH = "/api/folder/create"
 
     def _init_data(newfoldername):
         _data = {}
@@ -33,16 +35,20 @@ def create(
 
     # check duplicate if needed
     if not allow_duplicate_name:
-        r_post = list()
-        _ret = api_util.findFolderByName(r_post, newfoldername)
-        if _ret != None or len(_ret) > 0:
+        mirror = get_mirror(server_url, port)
+        mirror.ensure_loaded(timeout_connect=timeout_connect, timeout_read=timeout_read)
+        if mirror.find_by_name(newfoldername) is not None:
             print(
                 f'ERROR: create folder with same name is forbidden by option. [eagleapi.folder.create] foldername="{newfoldername}"',
                 file=sys.stderr,
             )
             return
 
-    r_post = requests.post(API_URL, json=data, timeout=(timeout_connect, timeout_read))
+    r_post = transport.post(
+        server_url, port, API_PATH, json=data, timeout=(timeout_connect, timeout_read)
+    )
+    if r_post.status_code == 200:
+        get_mirror(server_url, port).apply_created(r_post)
     return r_post
 
 
@@ -62,7 +68,7 @@ def create_subfolder(
     このサンプルでは、親フォルダは "stable diffusion" フォルダを想定。
     重複チェックは extendTags に 'stable diffusion' が含まれる & フォルダ名一致 として判定。
     """
-    API_URL = f"{server_url}:{port}/api/folder/create"
+    API_PATH = "/api/folder/create"
 
     data = {"folderName": newfoldername}
     if parent_id:
@@ -72,14 +78,21 @@ def create_subfolder(
     # allow_duplicate_name=False のときは重複をチェック (extendTags+name)
     # -------------------------------------------------------
     if not allow_duplicate_name:
-        resp_list = list(server_url=server_url, port=port)
-        if resp_list.status_code != 200:
+        mirror = get_mirror(server_url, port)
+        if not mirror.ensure_loaded(
+            timeout_connect=timeout_connect, timeout_read=timeout_read
+        ):
             print("ERROR: cannot get folder list", file=sys.stderr)
-            return resp_list
+            r_fake = requests.models.Response()
+            r_fake.status_code = 503
+            r_fake._content = b'{"error":"Folder list unavailable"}'
+            return r_fake
 
-        existing = api_util.findFolderByNameAndExtendTag(
-            resp_list, "stable diffusion", newfoldername
-        )
+        existing = mirror.find_child(parent_id, newfoldername)
+        if existing is None:
+            existing = mirror.find_by_name_and_extend_tag(
+                "stable diffusion", newfoldername
+            )
         if existing is not None:
             print(
                 f'ERROR: extendTags に "stable diffusion" があり、かつ同名フォルダ "{newfoldername}" が既に存在します。',
@@ -92,7 +105,11 @@ def create_subfolder(
             return r_fake
 
     # 新規作成
-    r_post = requests.post(API_URL, json=data, timeout=(timeout_connect, timeout_read))
+    r_post = transport.post(
+        server_url, port, API_PATH, json=data, timeout=(timeout_connect, timeout_read)
+    )
+    if r_post.status_code == 200:
+        get_mirror(server_url, port).apply_created(r_post, parent_id=parent_id)
     return r_post
 
 
@@ -112,8 +129,12 @@ def rename(
         list(response dict): return list of response.json()
     """
     data = {"folderId": folderId, "newName": newName}
-    API_URL = f"{server_url}:{port}/api/folder/rename"
-    r_post = requests.post(API_URL, json=data, timeout=(timeout_connect, timeout_read))
+    API_PATH = "/api/folder/rename"
+    r_post = transport.post(
+        server_url, port, API_PATH, json=data, timeout=(timeout_connect, timeout_read)
+    )
+    if r_post.status_code == 200:
+        get_mirror(server_url, port).apply_renamed(folderId, newName)
     return r_post
 
 
@@ -126,8 +147,218 @@ def list(server_url="http://localhost", port=41595, timeout_connect=3, timeout_r
         Response: return of requests.post
     """
 
-    API_URL = f"{server_url}:{port}/api/folder/list"
+    API_PATH = "/api/folder/list"
 
-    r_get = requests.get(API_URL, timeout=(timeout_connect, timeout_read))
+    r_get = transport.get(
+        server_url, port, API_PATH, timeout=(timeout_connect, timeout_read)
+    )
 
     return r_get
+
+
+def list_recent(
+    server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10
+):
+    """EAGLE API:/api/folder/listRecent
+
+    Method: GET
+
+    Returns:
+        Response: return of requests.get
+    """
+
+    API_PATH = "/api/folder/listRecent"
+
+    r_get = transport.get(
+        server_url, port, API_PATH, timeout=(timeout_connect, timeout_read)
+    )
+
+    return r_get
+
+
+#
+# Local mirror of folder tree
+#
+class FolderMirror:
+    """Eagle のフォルダツリーをローカルに保持するミラー。
+
+    自分で行った create / rename の結果は即座に反映し、サーバーとの突き合わせは
+    バックグラウンドで listRecent (軽量) と定期的なフルの list で行う。
+    これにより、保存処理がフォルダツリー全体のダウンロードを待つのは
+    ミラーが空のときの初回だけになる。
+    """
+
+    def __init__(self, server_url="http://localhost", port=41595):
+        self.server_url = server_url
+        self.port = port
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._folders = {}  # {folderId: {"id", "name", "parent", "extendTags", ...}}
+        self._loaded = False
+        self._last_full_sync = 0.0
+        self._sync_thread = None
+        self._stop = threading.Event()
+
+    # --- 読み出し --------------------------------------------------------
+    def is_loaded(self):
+        return self._loaded
+
+    def find_by_id(self, folder_id):
+        with self._lock:
+            return self._folders.get(folder_id)
+
+    def find_by_name(self, name):
+        if not name:
+            return None
+        with self._lock:
+            for fd in self._folders.values():
+                if fd.get("name") == name:
+                    return fd
+        return None
+
+    def find_child(self, parent_id, name):
+        """parent_id 直下の name フォルダを返す (parent_id が空ならルート直下)"""
+        parent_id = parent_id or None
+        with self._lock:
+            for fd in self._folders.values():
+                if fd.get("name") == name and fd.get("parent") == parent_id:
+                    return fd
+        return None
+
+    def find_by_name_and_extend_tag(self, extend_tag, name):
+        with self._lock:
+            for fd in self._folders.values():
+                if fd.get("name") == name and extend_tag in fd.get("extendTags", []):
+                    return fd
+        return None
+
+    def all_folders(self):
+        with self._lock:
+            return [dict(fd) for fd in self._folders.values()]
+
+    # --- サーバーとの同期 ------------------------------------------------
+    def refresh(self, timeout_connect=3, timeout_read=10):
+        """/api/folder/list でツリー全体を取得し、ミラーを作り直す"""
+        try:
+            r_get = list(
+                server_url=self.server_url,
+                port=self.port,
+                timeout_connect=timeout_connect,
+                timeout_read=timeout_read,
+            )
+            _posts = r_get.json() if r_get.status_code == 200 else None
+        except Exception as e:
+            print(f"ERROR: FolderMirror.refresh failed: {e}", file=sys.stderr)
+            return False
+        if not _posts or _posts.get("status") != "success":
+            return False
+
+        folders = {}
+
+        def _walk(data, parent_id, depth):
+            if depth > 10:
+                return
+            folders[data.get("id")] = self._strip(data, parent_id)
+            for _child in data.get("children", None) or []:
+                _walk(_child, data.get("id"), depth + 1)
+
+        for _data in _posts.get("data", None) or []:
+            _walk(_data, None, 0)
+
+        with self._lock:
+            self._folders = folders
+            self._loaded = True
+            self._last_full_sync = time.time()
+        return True
+
+    def ensure_loaded(self, timeout_connect=3, timeout_read=10):
+        """ミラーが空のときだけフル同期する。複数スレッドが同時に来ても取得は1回"""
+        if self._loaded:
+            return True
+        with self._load_lock:
+            if self._loaded:
+                return True
+            return self.refresh(timeout_connect=timeout_connect, timeout_read=timeout_read)
+
+    def reconcile_recent(self, timeout_connect=3, timeout_read=10):
+        """/api/folder/listRecent の結果をミラーへマージする (親は既知の値を維持)"""
+        try:
+            r_get = list_recent(
+                server_url=self.server_url,
+                port=self.port,
+                timeout_connect=timeout_connect,
+                timeout_read=timeout_read,
+            )
+            _posts = r_get.json() if r_get.status_code == 200 else None
+        except Exception as e:
+            print(f"ERROR: FolderMirror.reconcile_recent failed: {e}", file=sys.stderr)
+            return False
+        if not _posts or _posts.get("status") != "success":
+            return False
+        with self._lock:
+            for _data in _posts.get("data", None) or []:
+                known = self._folders.get(_data.get("id"))
+                parent_id = known.get("parent") if known else _data.get("parent")
+                self._folders[_data.get("id")] = self._strip(_data, parent_id)
+        return True
+
+    # --- 自分の操作による差分 --------------------------------------------
+    def apply_created(self, r_post, parent_id=None):
+        try:
+            _data = r_post.json()["data"]
+        except Exception:
+            return
+        with self._lock:
+            self._folders[_data.get("id")] = self._strip(_data, parent_id or None)
+
+    def apply_renamed(self, folder_id, new_name):
+        with self._lock:
+            fd = self._folders.get(folder_id)
+            if fd is not None:
+                fd["name"] = new_name
+
+    # --- バックグラウンド同期 --------------------------------------------
+    def start_background_sync(self, recent_interval=30, full_interval=600):
+        """低頻度のデーモンスレッドで listRecent / list による突き合わせを行う"""
+        with self._lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                return
+            self._stop.clear()
+            self._sync_thread = threading.Thread(
+                target=self._sync_loop,
+                args=(recent_interval, full_interval),
+                name=f"eagle-folder-mirror-{self.port}",
+                daemon=True,
+            )
+            self._sync_thread.start()
+
+    def stop_background_sync(self):
+        self._stop.set()
+
+    def _sync_loop(self, recent_interval, full_interval):
+        while not self._stop.wait(recent_interval):
+            if not self._loaded or time.time() - self._last_full_sync >= full_interval:
+                self.refresh()
+            else:
+                self.reconcile_recent()
+
+    @staticmethod
+    def _strip(data, parent_id):
+        fd = {k: v for k, v in data.items() if k != "children"}
+        fd["parent"] = parent_id
+        return fd
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(server_url="http://localhost", port=41595):
+    """(server_url, port) ごとに共有される FolderMirror を返す"""
+    key = (server_url, port)
+    with _mirrors_lock:
+        mirror = _mirrors.get(key)
+        if mirror is None:
+            mirror = FolderMirror(server_url=server_url, port=port)
+            _mirrors[key] = mirror
+        return mirror
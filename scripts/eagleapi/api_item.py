@@ -1,10 +1,16 @@
 # seealso: https://api.eagle.cool/item/add-from-path
 # seealso: https://api.eagle.cool/item/add-from-paths
 #
-import requests
 import os
 
 import base64
+import ipaddress
+import json
+import mimetypes
+import socket
+import threading
+
+from . import transport
 
 DEBUG = False
 def dprint(str):
@@ -82,7 +88,7 @@ class EAGLE_ITEM_URL:
         try:
             with open(filepath, "rb") as file:
                 enc_file = base64.urlsafe_b64encode(file.read())
-                self.url = f"data:image/png;base64, {enc_file.decode('utf-8')}"
+                self.url = f"data:{guess_mimetype(filepath)};base64, {enc_file.decode('utf-8')}"
         except Exception as e:
             print("Error convert_file_to_base64url: eocode failed")
             print(e)
@@ -114,35 +120,155 @@ class EAGLE_ITEM_URL:
         return _data
 
 
-def add_from_URL(item:EAGLE_ITEM_URL, folderId=None, server_url="http://localhost", port=41595):
-    API_URL = f"{server_url}:{port}/api/item/addFromURL"
+def guess_mimetype(filepath):
+    """MIME type for a data URL, from the file extension (defaults to application/octet-stream)."""
+    _type, _ = mimetypes.guess_type(filepath)
+    return _type or "application/octet-stream"
+
+
+class Base64JsonBody:
+    """File-like request body: JSON for addFromURL with the file streamed as a base64 data URL.
+
+    The file is read and encoded in chunks while requests sends the body, so peak memory
+    does not depend on the image size. len() is known in advance (Content-Length is sent),
+    and seek(0) rewinds the body so the transport can retry the request.
+
+    Args:
+        filepath : local file to embed.
+        fields   : other addFromURL fields (name, website, tags, annotation, folderId, ...).
+        mimetype : defaults to guess_mimetype(filepath).
+    """
+    CHUNK_SIZE = 3 * 16384  # 3 の倍数なら途中で "=" が入らない
+    _MARKER = "__eagle_base64_data__"
+
+    def __init__(self, filepath, fields, mimetype=None):
+        self.filepath = filepath
+        _data = {"url": f"data:{mimetype or guess_mimetype(filepath)};base64,{self._MARKER}"}
+        _data.update({k: v for k, v in fields.items() if k != "url"})
+        _text = json.dumps(_data, ensure_ascii=False)
+        # "url" を先頭に置いているので、最初に現れる目印が data URL の位置
+        _pos = _text.index(self._MARKER)
+        self._prefix = _text[:_pos].encode("utf-8")
+        self._suffix = _text[_pos + len(self._MARKER):].encode("utf-8")
+        self._file_size = os.path.getsize(filepath)
+        self._length = len(self._prefix) + 4 * ((self._file_size + 2) // 3) + len(self._suffix)
+        self._file = None
+        self.seek(0)
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise OSError("Base64JsonBody can only be rewound to the start")
+        self.close()
+        self._pos = 0
+        self._stage = 0  # 0: prefix, 1: file, 2: suffix, 3: done
+        self._buf = bytearray()
+        return 0
+
+    def _fill(self):
+        if self._stage == 0:
+            self._buf += self._prefix
+            self._file = open(self.filepath, "rb")
+            self._stage = 1
+        elif self._stage == 1:
+            raw = self._file.read(self.CHUNK_SIZE)
+            # 通常のファイルは EOF 以外で CHUNK_SIZE 未満を返さないが、念のため端数は次へ回す
+            while raw and len(raw) % 3:
+                more = self._file.read(3 - len(raw) % 3)
+                if not more:
+                    break
+                raw += more
+            if raw:
+                self._buf += base64.b64encode(raw)
+            if len(raw) < self.CHUNK_SIZE:
+                self.close()
+                self._stage = 2
+        elif self._stage == 2:
+            self._buf += self._suffix
+            self._stage = 3
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        while len(self._buf) < size and self._stage < 3:
+            self._fill()
+        chunk = bytes(self._buf[:size])
+        del self._buf[:size]
+        self._pos += len(chunk)
+        return chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def add_from_path_base64(item:EAGLE_ITEM_PATH, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=60):
+    """EAGLE API:/api/item/addFromURL with a local file sent as a base64 data URL.
+
+    For Eagle servers that cannot read our filesystem. The body is streamed (see Base64JsonBody).
+
+    Returns:
+        Response: return of requests.post
+    """
+    API_PATH = "/api/item/addFromURL"
+    _data = item.output_data()
+    filepath = _data.pop("path")
+    if folderId and folderId != "":
+        _data.update({"folderId": folderId})
+    body = Base64JsonBody(filepath, _data)
+    try:
+        r_post = transport.post(server_url, port, API_PATH, data=body, headers={"Content-Type": "application/json"}, timeout=(timeout_connect, timeout_read))
+    finally:
+        body.close()
+    return r_post
+
+
+def add_from_URL(item:EAGLE_ITEM_URL, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10):
+    API_PATH = "/api/item/addFromURL"
     _data = item.output_data()
     if folderId and folderId != "":
         _data.update({"folderId": folderId})
-    r_post = requests.post(API_URL, json=_data)
+    r_post = transport.post(server_url, port, API_PATH, json=_data, timeout=(timeout_connect, timeout_read))
     return r_post
 
 
-def add_from_URL_base64(item:EAGLE_ITEM_URL, folderId=None, server_url="http://localhost", port=41595):
-    API_URL = f"{server_url}:{port}/api/item/addFromURL"
-    item.url = item.convert_file_to_base64url()
+def add_from_URL_base64(item:EAGLE_ITEM_URL, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10):
+    API_PATH = "/api/item/addFromURL"
     _data = item.output_data()
+    filepath = _data.pop("url")
+    if not filepath or not os.path.exists(filepath):
+        item.url = item.convert_file_to_base64url()
+        _data = item.output_data()
+        if folderId and folderId != "":
+            _data.update({"folderId": folderId})
+        return transport.post(server_url, port, API_PATH, json=_data, timeout=(timeout_connect, timeout_read))
     if folderId and folderId != "":
         _data.update({"folderId": folderId})
-    r_post = requests.post(API_URL, json=_data)
+    # ファイルを丸ごと読み込まず、送信しながら base64 にする
+    body = Base64JsonBody(filepath, _data)
+    try:
+        r_post = transport.post(server_url, port, API_PATH, data=body, headers={"Content-Type": "application/json"}, timeout=(timeout_connect, timeout_read))
+    finally:
+        body.close()
     return r_post
 
 
-def add_from_path(item:EAGLE_ITEM_PATH, folderId=None, server_url="http://localhost", port=41595):
-    API_URL = f"{server_url}:{port}/api/item/addFromPath"
+def add_from_path(item:EAGLE_ITEM_PATH, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=10):
+    API_PATH = "/api/item/addFromPath"
     _data = item.output_data()
     if folderId and folderId != "":
         _data.update({"folderId": folderId})
-    r_post = requests.post(API_URL, json=_data)
+    r_post = transport.post(server_url, port, API_PATH, json=_data, timeout=(timeout_connect, timeout_read))
     return r_post
 
 
-def add_from_paths(files, folderId=None, server_url="http://localhost", port=41595, step=None):
+def add_from_paths(files, folderId=None, server_url="http://localhost", port=41595, step=None, timeout_connect=3, timeout_read=30):
     """EAGLE API:/api/item/addFromPaths
 
     Method: POST
@@ -155,11 +281,13 @@ def add_from_paths(files, folderId=None, server_url="http://localhost", port=415
         tags: Tags for the images.
         folderId: If this parameter is defined, the image will be added to the corresponding folder.
         step: interval image num of doing POST. Defaults is None (disabled)
+        timeout_connect: Defaults to 3.
+        timeout_read: Defaults to 30.
 
     Returns:
         Response: return of requests.posts
     """
-    API_URL = f"{server_url}:{port}/api/item/addFromPaths"
+    API_PATH = "/api/item/addFromPaths"
 
     if step:
         step = int(step)
@@ -179,17 +307,135 @@ def add_from_paths(files, folderId=None, server_url="http://localhost", port=415
             data["items"].append(_data)
         if step and step > 0:
             if ((_index + 1) - ((_index + 1) // step) * step) == 0:
-                _ret = requests.post(API_URL, json=data)
+                _ret = transport.post(server_url, port, API_PATH, json=data, timeout=(timeout_connect, timeout_read))
                 try:
                     r_posts.append(_ret.json())
                 except:
                     r_posts.append(_ret)
                 data = _init_data()
     if (len(data["items"]) > 0) or (not step or step <= 0):
-        _ret = requests.post(API_URL, json=data)
+        _ret = transport.post(server_url, port, API_PATH, json=data, timeout=(timeout_connect, timeout_read))
         try:
             r_posts.append(_ret.json())
         except:
             r_posts.append(_ret)
 
     return [ x for x in r_posts if x != "" ]
+
+
+MODE_AUTO = "auto"
+MODE_PATH = "path"
+MODE_URL = "url"
+
+_upload_modes = {}  # {(server_url, port): MODE_PATH / MODE_URL}
+_upload_modes_lock = threading.Lock()
+
+
+def _is_local_host(host):
+    if host in ("localhost", ""):
+        return True
+    try:
+        addr = ipaddress.ip_address(socket.gethostbyname(host))
+    except (OSError, ValueError):
+        return False
+    if addr.is_loopback:
+        return True
+    try:
+        return str(addr) in socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        return False
+
+
+def set_upload_mode(server_url, port, mode=MODE_AUTO):
+    """Override how files are sent to this server: "path" (addFromPath), "url" (base64) or "auto"."""
+    with _upload_modes_lock:
+        if mode == MODE_AUTO:
+            _upload_modes.pop((server_url, port), None)
+        else:
+            _upload_modes[(server_url, port)] = mode
+
+
+def upload_mode(server_url="http://localhost", port=41595):
+    """"path" if the Eagle server runs on this machine (can read our files), otherwise "url"."""
+    key = (server_url, port)
+    with _upload_modes_lock:
+        mode = _upload_modes.get(key)
+    if mode:
+        return mode
+    host = server_url.split("://", 1)[-1].split("/", 1)[0].strip("[]")
+    mode = MODE_PATH if _is_local_host(host) else MODE_URL
+    with _upload_modes_lock:
+        return _upload_modes.setdefault(key, mode)
+
+
+def add_item(item:EAGLE_ITEM_PATH, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=None):
+    """Add a local file by path or by base64 data URL, whichever the server supports (see upload_mode).
+
+    Returns:
+        Response: return of requests.post
+    """
+    if upload_mode(server_url, port) == MODE_URL:
+        return add_from_path_base64(item, folderId=folderId, server_url=server_url, port=port, timeout_connect=timeout_connect, timeout_read=timeout_read or 60)
+    return add_from_path(item, folderId=folderId, server_url=server_url, port=port, timeout_connect=timeout_connect, timeout_read=timeout_read or 10)
+
+
+def add_items(files, folderId=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=None):
+    """add_from_paths for local servers, one streamed addFromURL per file for remote ones.
+
+    Returns:
+        list: one result per file, in order: response json, Response, or {"status": "error", ...}
+              if the POST raised. addFromPaths is a single POST, so its result is repeated for
+              every file. Check each with is_success() and retry only the failed files.
+    """
+    files = [_item for _item in files]
+    if upload_mode(server_url, port) != MODE_URL:
+        r_posts = add_from_paths(files, folderId=folderId, server_url=server_url, port=port, timeout_connect=timeout_connect, timeout_read=timeout_read or 30)
+        _ret = r_posts[0] if len(r_posts) == 1 else {"status": "error", "message": f"unexpected response: {r_posts}"}
+        return [_ret] * len(files)
+    r_posts = []
+    for _item in files:
+        # ファイルごとに別の POST なので、途中で失敗しても送れた分の結果は返す (送り直すと二重登録になる)
+        try:
+            _ret = add_from_path_base64(_item, folderId=folderId, server_url=server_url, port=port, timeout_connect=timeout_connect, timeout_read=timeout_read or 60)
+        except Exception as e:
+            r_posts.append({"status": "error", "message": str(e)})
+            continue
+        try:
+            r_posts.append(_ret.json())
+        except:
+            r_posts.append(_ret)
+    return r_posts
+
+
+def is_success(r_post):
+    """True if an add_items result (response json) reports success."""
+    return isinstance(r_post, dict) and r_post.get("status") == "success"
+
+
+def list(limit=200, offset=0, orderBy=None, keyword=None, ext=None, tags=None, folders=None, server_url="http://localhost", port=41595, timeout_connect=3, timeout_read=30):
+    """EAGLE API:/api/item/list
+
+    Method: GET
+
+    Args:
+        limit: The number of items to be displayed. Defaults to 200.
+        offset: Offset a collection of results from the api. Start with 0.
+        orderBy: CREATEDATE / FILESIZE / NAME / RESOLUTION, "-" prefix for descending.
+        keyword: Filter by the keyword.
+        ext: Filter by the extension type, e.g. "png".
+        tags: Filter by tags. Use "," to divide different tags.
+        folders: Filter by folder ids. Use "," to divide folder IDs.
+        timeout_connect: Defaults to 3.
+        timeout_read: Defaults to 30.
+
+    Returns:
+        Response: return of requests.get
+    """
+    API_PATH = "/api/item/list"
+
+    params = {"limit": limit, "offset": offset}
+    for _key, _value in (("orderBy", orderBy), ("keyword", keyword), ("ext", ext), ("tags", tags), ("folders", folders)):
+        if _value:
+            params[_key] = _value
+    r_get = transport.get(server_url, port, API_PATH, params=params, timeout=(timeout_connect, timeout_read))
+    return r_get
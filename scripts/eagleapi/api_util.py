@@ -2,7 +2,7 @@ import requests
 import ipaddress
 from urllib.parse import urlparse
 
-from . import api_folder
+from . import api_folder, singleflight
 
 
 def get_url_port(server_url_port=""):
@@ -11,8 +11,11 @@ def get_url_port(server_url_port=""):
     o = urlparse(server_url_port)
     _url = f"http://{o.hostname}"
     if o.hostname != "localhost":
-        _ip = ipaddress.ip_address(o.hostname)
-        if _ip.version == 6:
+        try:
+            _ip = ipaddress.ip_address(o.hostname)
+        except ValueError:
+            _ip = None  # host name
+        if _ip and _ip.version == 6:
             _url = f"http://[{o.hostname}]"
     port = o.port
     return _url, port
@@ -123,33 +126,103 @@ def find_or_create_folder(
     """
     _eagle_folderid = ""
     if folder_name_or_id and folder_name_or_id != "":
-        _ret_folder_list = api_folder.list(
-            server_url=server_url,
-            port=port,
-            timeout_connect=timeout_connect,
-            timeout_read=timeout_read,
-        )
+        mirror = api_folder.get_mirror(server_url, port)
+        mirror.ensure_loaded(timeout_connect=timeout_connect, timeout_read=timeout_read)
 
         # serach by name
-        _ret = findFolderByName(_ret_folder_list, folder_name_or_id)
-        if _ret and len(_ret) > 0:
+        _ret = mirror.find_by_name(folder_name_or_id)
+        if _ret:
             _eagle_folderid = _ret.get("id", "")
         # serach by ID
         if _eagle_folderid == "":
-            _ret = findFolderByID(_ret_folder_list, folder_name_or_id)
-            if _ret and len(_ret) > 0:
+            _ret = mirror.find_by_id(folder_name_or_id)
+            if _ret:
                 _eagle_folderid = _ret.get("id", "")
         if _eagle_folderid == "":
             if allow_create_new_folder:  # allow new
-                _r_get = api_folder.create(
+                _eagle_folderid = singleflight.folders.do(
+                    (server_url, port, None, folder_name_or_id),
+                    _create_root_folder,
                     folder_name_or_id,
-                    server_url=server_url,
-                    port=port,
-                    timeout_connect=timeout_connect,
-                    timeout_read=timeout_read,
+                    server_url,
+                    port,
+                    timeout_connect,
+                    timeout_read,
                 )
-                try:
-                    _eagle_folderid = _r_get.json().get("data").get("id")
-                except:
-                    _eagle_folderid = ""
     return _eagle_folderid
+
+
+def _create_root_folder(folder_name, server_url, port, timeout_connect, timeout_read):
+    # 待っている間に他の呼び出しが作成していればそれを使う
+    _ret = api_folder.get_mirror(server_url, port).find_by_name(folder_name)
+    if _ret:
+        return _ret.get("id", "")
+    _r_get = api_folder.create(
+        folder_name,
+        server_url=server_url,
+        port=port,
+        timeout_connect=timeout_connect,
+        timeout_read=timeout_read,
+    )
+    try:
+        return _r_get.json().get("data").get("id")
+    except:
+        return ""
+
+
+def find_or_create_subfolder(
+    parent_id,
+    folder_name,
+    server_url="http://localhost",
+    port=41595,
+    timeout_connect=3,
+    timeout_read=10,
+):
+    """
+    Find or Create sub folder named folder_name directly under parent_id.
+    Concurrent calls for the same (server, parent, name) are coalesced into one.
+
+    Args:
+        parent_id (str): folderId of the parent folder.
+        folder_name (str): name of the sub folder.
+        server_url (str, optional): Defaults to "http://localhost".
+        port (int, optional): Defaults to 41595.
+        timeout_connect (int, optional): Defaults to 3.
+        timeout_read (int, optional): Defaults to 10.
+    Return:
+        folderId or ""
+    """
+    return singleflight.folders.do(
+        (server_url, port, parent_id, folder_name),
+        _find_or_create_subfolder,
+        parent_id,
+        folder_name,
+        server_url,
+        port,
+        timeout_connect,
+        timeout_read,
+    )
+
+
+def _find_or_create_subfolder(
+    parent_id, folder_name, server_url, port, timeout_connect, timeout_read
+):
+    mirror = api_folder.get_mirror(server_url, port)
+    if not mirror.ensure_loaded(timeout_connect=timeout_connect, timeout_read=timeout_read):
+        return ""
+    _ret = mirror.find_child(parent_id, folder_name)
+    if _ret:
+        return _ret.get("id", "")
+    _r_post = api_folder.create_subfolder(
+        folder_name,
+        parent_id,
+        server_url=server_url,
+        port=port,
+        allow_duplicate_name=False,
+        timeout_connect=timeout_connect,
+        timeout_read=timeout_read,
+    )
+    try:
+        return _r_post.json().get("data").get("id")
+    except:
+        return ""
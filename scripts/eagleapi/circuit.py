@@ -0,0 +1,178 @@
+# Circuit breaker shared by every call to one Eagle server
+#
+# closed    : 通常通りリクエストを通す。連続失敗が閾値を超えたら open へ
+# open      : リクエストを即座に失敗させる (CircuitOpenError)。
+#             バックグラウンドのヘルスプローブがバックオフ間隔で復旧を確認する
+# half_open : 試行リクエストを 1 本だけ通し、成功なら closed、失敗なら open に戻す
+#
+import threading
+import time
+
+import requests
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request while the circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        server_url="http://localhost",
+        port=41595,
+        failure_threshold=3,
+        base_backoff=1.0,
+        max_backoff=60.0,
+        health_ttl=5.0,
+        probe_timeout=(1, 2),
+    ):
+        """
+        Args:
+            server_url, port  : Eagle server guarded by this breaker.
+            failure_threshold : consecutive failures that open the circuit.
+            base_backoff      : first wait before probing an open circuit (sec).
+            max_backoff       : upper limit of the probe backoff (sec).
+            health_ttl        : how long a probe/request result answers is_alive (sec).
+            probe_timeout     : (connect, read) timeout of health probes.
+        """
+        self.server_url = server_url
+        self.port = port
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.health_ttl = health_ttl
+        self.probe_timeout = probe_timeout
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._backoff = base_backoff
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._last_result_at = 0.0
+        self._last_result_ok = None
+        self._prober = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow_request(self):
+        """リクエストを送ってよいか。open 中は時間が来るまで False"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == OPEN and now >= self._open_until:
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def check(self):
+        """allow_request() が False なら CircuitOpenError を送出する"""
+        if not self.allow_request():
+            raise CircuitOpenError(
+                f"Eagle circuit is open: {self.server_url}:{self.port}"
+            )
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._backoff = self.base_backoff
+            self._trial_in_flight = False
+            self._last_result_at = time.monotonic()
+            self._last_result_ok = True
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._last_result_at = time.monotonic()
+            self._last_result_ok = False
+            if self._state == OPEN:
+                # open になる前に送られていたリクエストの失敗。バックオフは伸ばさない
+                return
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._trip()
+
+    def cached_health(self):
+        """直近 health_ttl 秒以内の結果があれば True/False、無ければ None"""
+        with self._lock:
+            if self._state == OPEN:
+                return False
+            if (
+                self._last_result_ok is not None
+                and time.monotonic() - self._last_result_at < self.health_ttl
+            ):
+                return self._last_result_ok
+            return None
+
+    def _trip(self):
+        # self._lock を保持した状態で呼ぶこと
+        if self._state == CLOSED:
+            self._backoff = self.base_backoff
+        else:
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        self._state = OPEN
+        self._trial_in_flight = False
+        self._open_until = time.monotonic() + self._backoff
+        if self._prober is None or not self._prober.is_alive():
+            self._prober = threading.Thread(
+                target=self._probe_loop,
+                name=f"eagle-health-probe-{self.port}",
+                daemon=True,
+            )
+            self._prober.start()
+
+    def _probe_loop(self):
+        while True:
+            with self._lock:
+                if self._state == CLOSED:
+                    return
+                wait = self._open_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            if not self.allow_request():
+                # 別スレッドの試行リクエストが結果を出すのを待つ
+                time.sleep(self.base_backoff)
+                continue
+            try:
+                r_get = requests.get(
+                    f"{self.server_url}:{self.port}/api/application/info",
+                    timeout=self.probe_timeout,
+                )
+                ok = r_get.status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                self.record_success()
+                return
+            with self._lock:
+                self._last_result_at = time.monotonic()
+                self._last_result_ok = False
+                self._state = HALF_OPEN
+                self._trip()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(server_url="http://localhost", port=41595):
+    """(server_url, port) ごとに共有される CircuitBreaker を返す"""
+    key = (server_url, port)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(server_url=server_url, port=port)
+            _breakers[key] = breaker
+        return breaker
@@ -0,0 +1,33 @@
+# Optional instrumentation hooks
+#
+# eagleapi は単体のライブラリとして使えるよう、呼び出し側 (拡張機能や監視スクリプト) の
+# トレース機構に依存しない。set_tracer() に trace(name, **args) と span(name, **args)
+# (どちらも with で使え、span は args を追加できる dict を yield する) を持つオブジェクトを
+# 渡すと、HTTP 呼び出しやアウトボックスの送信がそこに記録される。既定では何もしない。
+#
+import contextlib
+
+
+class NullTracer:
+    @staticmethod
+    @contextlib.contextmanager
+    def trace(name, **args):
+        yield None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, **args):
+        yield dict(args)
+
+
+_tracer = NullTracer()
+
+
+def set_tracer(tracer=None):
+    """Install tracer (e.g. scripts.pipeline.tracing). None restores the no-op tracer."""
+    global _tracer
+    _tracer = tracer if tracer is not None else NullTracer()
+
+
+def tracer():
+    return _tracer
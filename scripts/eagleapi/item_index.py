@@ -0,0 +1,155 @@
+# Local index of items already in the Eagle library
+#
+# アップロード前の重複チェック用。/api/item/list で一括して読み込み、以降は
+# 自分が追加した結果で更新する (新しい順に読み直して差分も取り込める)。
+# Eagle の一覧はファイルの内容ハッシュを返さないので、一覧から得た項目は
+# (名前, 拡張子, サイズ) で照合する。自分が追加した項目にはハッシュも記録し、
+# ハッシュが分かっていて一致しない場合は別の画像として扱う。
+#
+import os
+import threading
+
+from . import api_item
+
+
+def item_key(name, ext, size):
+    return (name, (ext or "").lower().lstrip("."), int(size))
+
+
+def file_key(path, size=None):
+    """ローカルのファイルから照合キーを作る (Eagle の name は拡張子を除いたファイル名)"""
+    base, ext = os.path.splitext(os.path.basename(path))
+    return item_key(base, ext, os.path.getsize(path) if size is None else size)
+
+
+class ItemIndex:
+    def __init__(self, server_url="http://localhost", port=41595, page_size=1000):
+        self.server_url = server_url
+        self.port = port
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._items = {}  # {(name, ext, size): {"id": str, "md5": str or None}}
+        self._ids = set()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._loaded
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def _add_listed(self, data):
+        if data.get("isDeleted"):
+            return False
+        try:
+            key = item_key(data.get("name", ""), data.get("ext", ""), data.get("size", 0))
+        except (TypeError, ValueError):
+            return False
+        item_id = data.get("id")
+        with self._lock:
+            known = item_id in self._ids
+            self._ids.add(item_id)
+            entry = self._items.get(key)
+            if entry is None:
+                self._items[key] = {"id": item_id, "md5": None}
+            elif not entry.get("id"):
+                entry["id"] = item_id
+        return not known
+
+    def _fetch_page(self, page, order_by=None, timeout_read=60):
+        r_get = api_item.list(
+            limit=self.page_size,
+            offset=page,  # Eagle の offset はページ番号 (offset * limit 件目から)
+            orderBy=order_by,
+            server_url=self.server_url,
+            port=self.port,
+            timeout_read=timeout_read,
+        )
+        if r_get.status_code != 200:
+            return None
+        _posts = r_get.json()
+        if not _posts or _posts.get("status") != "success":
+            return None
+        return _posts.get("data") or []
+
+    def fill(self):
+        """ライブラリ全体の一覧を読み込みます。成功したら True を返します。"""
+        page = 0
+        while True:
+            data = self._fetch_page(page)
+            if data is None:
+                return False
+            new = sum(1 for d in data if self._add_listed(d))
+            # 件数が足りないか、全て既知 (offset の解釈違いなどで同じページが返った) なら終わり
+            if len(data) < self.page_size or new == 0:
+                break
+            page += 1
+        self._loaded = True
+        return True
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return True
+        with self._load_lock:
+            if self._loaded:
+                return True
+            return self.fill()
+
+    def refresh_recent(self, max_pages=10):
+        """新しく作られた順に読み、既知の項目に行き当たるまでの差分を取り込みます。"""
+        for page in range(max_pages):
+            data = self._fetch_page(page, order_by="-CREATEDATE")
+            if data is None:
+                return False
+            new = [d for d in data if self._add_listed(d)]
+            if len(new) < len(data) or len(data) < self.page_size:
+                break
+        return True
+
+    def find(self, name, ext, size, md5=None):
+        """登録済みなら Eagle の item id (不明なら "") を、無ければ None を返します。"""
+        key = item_key(name, ext, size)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            known_md5 = entry.get("md5")
+            if md5 and known_md5 and known_md5 != md5:
+                return None  # 名前とサイズは同じだが中身が違う
+            return entry.get("id") or ""
+
+    def find_file(self, path, md5=None, size=None):
+        key = file_key(path, size)
+        return self.find(*key, md5=md5)
+
+    def record_added(self, name, ext, size, md5=None, item_id=None):
+        """自分が追加した項目を記録します (Eagle の一覧を読み直さずに済ませる)。"""
+        key = item_key(name, ext, size)
+        with self._lock:
+            entry = self._items.setdefault(key, {"id": None, "md5": None})
+            if md5:
+                entry["md5"] = md5
+            if item_id:
+                entry["id"] = item_id
+                self._ids.add(item_id)
+
+    def record_added_file(self, path, md5=None, item_id=None, size=None):
+        self.record_added(*file_key(path, size), md5=md5, item_id=item_id)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(server_url="http://localhost", port=41595):
+    """(server_url, port) ごとに共有される ItemIndex を返す"""
+    key = (server_url, port)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = ItemIndex(server_url=server_url, port=port)
+            _indexes[key] = index
+        return index
@@ -0,0 +1,90 @@
+# Per-endpoint latency tracking for eagleapi calls
+#
+# エンドポイント (server_url, port, path) ごとに応答時間の EWMA 平均と分散を保持し、
+# p99 の推定値から read タイムアウトを決める。
+#
+import math
+import threading
+
+# 正規分布近似で p99 = mean + 2.326 * stddev
+_Z_P99 = 2.326
+
+
+class LatencyTracker:
+    def __init__(
+        self,
+        alpha=0.1,
+        min_samples=10,
+        headroom=2.0,
+        min_timeout=1.0,
+        max_timeout=60.0,
+    ):
+        """
+        Args:
+            alpha       : EWMA weight of the newest sample.
+            min_samples : samples required before timeouts become adaptive.
+            headroom    : read timeout = p99 * headroom.
+            min_timeout : lower limit of adaptive read timeout (sec).
+            max_timeout : upper limit of adaptive read timeout (sec).
+        """
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._mean = 0.0
+        self._var = 0.0
+        self._count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._count += 1
+            if self._count == 1:
+                self._mean = seconds
+                self._var = 0.0
+                return
+            diff = seconds - self._mean
+            incr = self.alpha * diff
+            self._mean += incr
+            self._var = (1 - self.alpha) * (self._var + diff * incr)
+
+    @property
+    def count(self):
+        return self._count
+
+    def mean(self):
+        with self._lock:
+            return self._mean
+
+    def p99(self):
+        with self._lock:
+            return self._mean + _Z_P99 * math.sqrt(max(self._var, 0.0))
+
+    def read_timeout(self, default):
+        """十分なサンプルが無い間は default、以降は p99 * headroom を上下限で丸めた値"""
+        if self._count < self.min_samples:
+            return default
+        return min(max(self.p99() * self.headroom, self.min_timeout), self.max_timeout)
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(server_url, port, path):
+    """エンドポイントごとに共有される LatencyTracker を返す"""
+    key = (server_url, port, path)
+    with _trackers_lock:
+        tracker = _trackers.get(key)
+        if tracker is None:
+            tracker = LatencyTracker()
+            _trackers[key] = tracker
+        return tracker
+
+
+def snapshot():
+    """{(server_url, port, path): (count, mean, p99)} を返す (監視・デバッグ用)"""
+    with _trackers_lock:
+        items = [(k, t) for k, t in _trackers.items()]
+    return {k: (t.count, t.mean(), t.p99()) for k, t in items}
@@ -0,0 +1,351 @@
+# Durable outbox for /api/item/addFromPaths
+#
+# 送信ジョブをまず SQLite のジャーナルに書き込み、バックグラウンドのリプレイヤーが
+# レート制限とバッチ化を行いながら Eagle へ流し込む。Eagle が停止していても
+# 呼び出し側 (画像生成スレッド) は待たされず、ジョブも失われない。
+# ファイルが消えたジョブや max_attempts 回失敗したジョブは 'failed' にして再送をやめる
+# (retry_failed() で pending に戻せる)。
+#
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from . import api_item, hooks, scheduler
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key        TEXT PRIMARY KEY,
+    server_url TEXT NOT NULL,
+    port       INTEGER NOT NULL,
+    folder     TEXT NOT NULL,
+    payload    TEXT NOT NULL,
+    state      TEXT NOT NULL DEFAULT 'pending',
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    next_at    REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (state, server_url, port, next_at);
+"""
+
+
+def make_idempotency_key(item: api_item.EAGLE_ITEM_PATH, server_url, port, folder):
+    """同じ画像を同じ送信先へ二重に積まないためのキー (パス + サイズ + 更新時刻)"""
+    try:
+        st = os.stat(item.filefullpath)
+        stamp = f"{st.st_size}:{st.st_mtime_ns}"
+    except OSError:
+        stamp = ""
+    src = f"{server_url}:{port}|{folder}|{item.filefullpath}|{stamp}"
+    return hashlib.sha1(src.encode("utf-8")).hexdigest()
+
+
+class Outbox:
+    def __init__(
+        self,
+        db_path,
+        resolve_folder,
+        batch_size=20,
+        rate_per_sec=10.0,
+        retry_interval=5.0,
+        max_retry_interval=300.0,
+        keep_done_sec=7 * 24 * 3600,
+        max_attempts=10,
+    ):
+        """Persistent queue of addFromPath jobs, drained by one replayer thread per server.
+
+        Args:
+            db_path            : path of SQLite journal file.
+            resolve_folder     : callable(folder, server_url, port) -> folderId.
+                                 return "" (or raise) to retry the batch later.
+            batch_size         : max items per addFromPaths POST.
+            rate_per_sec       : max items per second sent to Eagle.
+            retry_interval     : first backoff after a failed batch (sec).
+            max_retry_interval : upper limit of backoff (sec).
+            keep_done_sec      : how long sent keys are kept for idempotency.
+            max_attempts       : failed batches after which a job is moved to 'failed'.
+        """
+        self.db_path = db_path
+        self.resolve_folder = resolve_folder
+        self.batch_size = batch_size
+        self.rate_per_sec = rate_per_sec
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.keep_done_sec = keep_done_sec
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeups = {}  # {(server_url, port): Event}
+        self._threads = {}  # {(server_url, port): Thread}
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    # --- 積み込み ----------------------------------------------------------
+    def enqueue(
+        self,
+        item: api_item.EAGLE_ITEM_PATH,
+        folder,
+        server_url="http://localhost",
+        port=41595,
+        key=None,
+    ):
+        """ジョブをジャーナルへ追記する。既に同じキーがあれば何もしない
+
+        Returns:
+            bool: True if newly queued
+        """
+        if not key:
+            key = make_idempotency_key(item, server_url, port, folder)
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox"
+                " (key, server_url, port, folder, payload, next_at, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    server_url,
+                    port,
+                    folder,
+                    json.dumps(item.output_data(), ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            )
+            self._conn.commit()
+        self._ensure_replayer(server_url, port)
+        self._wakeups[(server_url, port)].set()
+        return cur.rowcount > 0
+
+    def pending_count(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE state = 'pending'"
+            ).fetchone()
+        return row[0]
+
+    def failed_count(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE state = 'failed'"
+            ).fetchone()
+        return row[0]
+
+    def retry_failed(self):
+        """'failed' のジョブを pending に戻し、その件数を返す"""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE outbox SET state = 'pending', attempts = 0, next_at = ?"
+                " WHERE state = 'failed'",
+                (now,),
+            )
+            self._conn.commit()
+            servers = self._conn.execute(
+                "SELECT DISTINCT server_url, port FROM outbox WHERE state = 'pending'"
+            ).fetchall()
+        for server_url, port in servers:
+            self._ensure_replayer(server_url, port)
+            self._wakeups[(server_url, port)].set()
+        return cur.rowcount
+
+    # --- リプレイヤー (送信先サーバーごとに 1 スレッド) ---------------------
+    def start(self):
+        """未送信ジョブが残っている全サーバーのリプレイヤーを起動する"""
+        self._stop.clear()
+        self._prune()
+        with self._lock:
+            servers = self._conn.execute(
+                "SELECT DISTINCT server_url, port FROM outbox WHERE state = 'pending'"
+            ).fetchall()
+        for server_url, port in servers:
+            self._ensure_replayer(server_url, port)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for ev in self._wakeups.values():
+            ev.set()
+        for th in self._threads.values():
+            th.join(timeout)
+
+    def _ensure_replayer(self, server_url, port):
+        key = (server_url, port)
+        with self._lock:
+            if key not in self._wakeups:
+                self._wakeups[key] = threading.Event()
+            th = self._threads.get(key)
+            if th is not None and th.is_alive():
+                return
+            th = threading.Thread(
+                target=self._run,
+                args=(server_url, port),
+                name=f"eagle-outbox-replayer-{port}",
+                daemon=True,
+            )
+            self._threads[key] = th
+            th.start()
+
+    def _run(self, server_url, port):
+        # 再送は保存操作の待ち時間に関わらないので、既定 (拡張機能では INTERACTIVE) を使わず
+        # 監視スクリプトの送信と同じ LIVE としてバックグラウンドの上限に従わせる
+        with scheduler.priority(scheduler.LIVE):
+            self._replay(server_url, port)
+
+    def _replay(self, server_url, port):
+        wakeup = self._wakeups[(server_url, port)]
+        while not self._stop.is_set():
+            sent = 0
+            try:
+                sent = self.drain_once(server_url, port)
+            except Exception as e:
+                print(f"ERROR: eagle outbox replay failed: {e}", file=sys.stderr)
+            if sent == 0:
+                wakeup.wait(self._seconds_until_next(server_url, port))
+                wakeup.clear()
+            elif self.rate_per_sec and self.rate_per_sec > 0:
+                # レート制限: 送った件数に見合う時間だけ間を空ける
+                self._stop.wait(sent / self.rate_per_sec)
+
+    def drain_once(self, server_url="http://localhost", port=41595):
+        """期限の来た pending ジョブを 1 バッチ送信し、送信成功件数を返す"""
+        now = time.time()
+        with self._lock:
+            head = self._conn.execute(
+                "SELECT folder FROM outbox"
+                " WHERE state = 'pending' AND next_at <= ?"
+                " AND server_url = ? AND port = ?"
+                " ORDER BY created_at LIMIT 1",
+                (now, server_url, port),
+            ).fetchone()
+            if head is None:
+                return 0
+            rows = self._conn.execute(
+                "SELECT key, payload, attempts FROM outbox"
+                " WHERE state = 'pending' AND next_at <= ?"
+                " AND server_url = ? AND port = ? AND folder = ?"
+                " ORDER BY created_at LIMIT ?",
+                (now, server_url, port, head[0], self.batch_size),
+            ).fetchall()
+        folder = head[0]
+        # 元のファイルが消えたジョブは何度送っても失敗し、同じバッチの他のジョブも巻き込む
+        missing = [r for r in rows if not os.path.exists(json.loads(r[1]).get("path") or "")]
+        if missing:
+            self._mark_dead(missing, "file not found")
+            rows = [r for r in rows if r not in missing]
+            if not rows:
+                return 0
+        keys = [r[0] for r in rows]
+
+        # 送信は画像の保存とは別スレッドで行うので、バッチごとに別の trace にする
+        with hooks.tracer().trace(
+            "outbox_drain", server=f"{server_url}:{port}", folder=folder, items=len(rows)
+        ):
+            return self._send_batch(server_url, port, folder, rows, keys)
+
+    def _send_batch(self, server_url, port, folder, rows, keys):
+        try:
+            with hooks.tracer().span("resolve_folder", folder=folder):
+                folder_id = self.resolve_folder(folder, server_url, port)
+            if not folder_id:
+                raise RuntimeError(f"cannot resolve folder '{folder}'")
+            items = []
+            for _key, payload, _attempts in rows:
+                _data = json.loads(payload)
+                items.append(
+                    api_item.EAGLE_ITEM_PATH(
+                        filefullpath=_data.get("path"),
+                        filename=_data.get("name", ""),
+                        website=_data.get("website", ""),
+                        tags=_data.get("tags", []),
+                        annotation=_data.get("annotation", ""),
+                    )
+                )
+            r_posts = api_item.add_items(
+                items, folderId=folder_id, server_url=server_url, port=port
+            )
+        except Exception as e:
+            self._mark_failed(rows, str(e))
+            return 0
+
+        # リモートの Eagle へは 1 件ずつ送るので、送れたものは done にして失敗したものだけ再送する
+        r_posts = list(r_posts) + [None] * (len(rows) - len(r_posts))
+        done = [k for k, r in zip(keys, r_posts) if api_item.is_success(r)]
+        failed = [row for row, r in zip(rows, r_posts) if not api_item.is_success(r)]
+        if done:
+            self._mark_done(done)
+        if failed:
+            errors = [r for r in r_posts if not api_item.is_success(r)]
+            self._mark_failed(failed, f"addFromPaths failed: {errors}")
+        return len(done)
+
+    def _mark_done(self, keys):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET state = 'done', last_error = NULL WHERE key = ?",
+                [(k,) for k in keys],
+            )
+            self._conn.commit()
+
+    def _mark_failed(self, rows, error):
+        now = time.time()
+        updates = []
+        dead = []
+        for row in rows:
+            key, _payload, attempts = row
+            if self.max_attempts and attempts + 1 >= self.max_attempts:
+                dead.append(row)
+                continue
+            delay = min(self.retry_interval * (2 ** attempts), self.max_retry_interval)
+            updates.append((now + delay, error[:500], key))
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, next_at = ?, last_error = ?"
+                " WHERE key = ?",
+                updates,
+            )
+            self._conn.commit()
+        if dead:
+            self._mark_dead(dead, error)
+
+    def _mark_dead(self, rows, error):
+        """再送をやめて 'failed' にする (pending_count には数えない)"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET state = 'failed', attempts = attempts + 1, last_error = ?"
+                " WHERE key = ?",
+                [(error[:500], r[0]) for r in rows],
+            )
+            self._conn.commit()
+        print(
+            f"ERROR: eagle outbox gave up on {len(rows)} job(s): {error[:200]}",
+            file=sys.stderr,
+        )
+
+    def _seconds_until_next(self, server_url, port):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_at) FROM outbox WHERE state = 'pending'"
+                " AND server_url = ? AND port = ?",
+                (server_url, port),
+            ).fetchone()
+        if not row or row[0] is None:
+            return self.max_retry_interval
+        return min(max(row[0] - time.time(), 0.05), self.max_retry_interval)
+
+    def _prune(self):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM outbox WHERE state = 'done' AND created_at < ?",
+                (time.time() - self.keep_done_sec,),
+            )
+            self._conn.commit()
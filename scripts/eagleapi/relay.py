@@ -0,0 +1,195 @@
+# Client of the local relay daemon (utils/eagle_relay.py)
+#
+# 同じマシンで複数の webui と監視スクリプトが 1 つの Eagle に送る場合、各プロセスが
+# 個別に Eagle へ接続する代わりに、ジョブを localhost の中継デーモンへ渡す。
+# フォルダのキャッシュ、コネクションプール、バッチ化、レート制限は中継デーモンが
+# まとめて持つので、プロセスを増やしても Eagle から見た負荷は変わらない。
+#
+# プロトコル (localhost の HTTP / JSON):
+#   POST /api/enqueue  {"jobs": [{"item": {...}, "folder": "2024-01-01",
+#                                 "server_url": "...", "port": 41595, "key": "..."}]}
+#                      -> {"status": "success", "data": [true, false, ...]}  (新規に積んだら true)
+#   GET  /api/health   -> {"status": "success", "data": {"pending": 0}}
+#
+# 中継デーモンに接続できない (接続拒否・ConnectTimeout) ときだけローカルのアウトボックスへ切り替える。
+# 接続後の読み込みタイムアウトや切断 ("Connection aborted") などは、デーモンがジョブを受け取った可能性があるので
+# 同じ冪等キーで送り直すだけにする (ローカルへ積むと Eagle に二重登録される)。
+#
+import logging
+import threading
+import time
+
+import requests
+
+from . import api_item, outbox
+
+# scripts.pipeline.log.get_logger("relay") と同じ名前 (eagleapi からは pipeline を import しない)
+logger = logging.getLogger("eagle_pnginfo.relay")
+
+DEFAULT_URL = "http://127.0.0.1:41600"
+
+
+class RelayError(Exception):
+    """The relay daemon failed or rejected the jobs (they may still have been queued)."""
+
+
+class RelayUnavailable(RelayError):
+    """The relay daemon could not be reached, so the jobs were certainly not queued."""
+
+
+def _never_sent(error):
+    """True if the request failed before a connection was made (so nothing reached the relay)."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # requests の ConnectionError は urllib3 の MaxRetryError(reason=NewConnectionError) を包んでいる
+    seen = set()
+    stack = [error]
+    while stack:
+        _e = stack.pop()
+        if _e is None or id(_e) in seen:
+            continue
+        seen.add(id(_e))
+        if isinstance(_e, ConnectionRefusedError) or type(_e).__name__ == "NewConnectionError":
+            return True
+        stack += [_e.__cause__, _e.__context__, getattr(_e, "reason", None)]
+        stack += [a for a in getattr(_e, "args", ()) if isinstance(a, BaseException)]
+    return False
+
+
+def make_job(item: api_item.EAGLE_ITEM_PATH, folder, server_url="http://localhost", port=41595, key=None):
+    _job = {
+        "item": item.output_data(),
+        "folder": folder,
+        "server_url": server_url,
+        "port": port,
+    }
+    if key:
+        _job["key"] = key
+    return _job
+
+
+class RelayClient:
+    def __init__(self, url=DEFAULT_URL, timeout=(1, 5), retry_after=30.0):
+        """
+        Args:
+            url         : relay daemon, e.g. "http://127.0.0.1:41600".
+            timeout     : (connect, read) timeout.
+            retry_after : after a failure, report the relay as down for this long (sec)
+                          so callers fall back without waiting for a timeout every time.
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+
+    def is_available(self):
+        with self._lock:
+            return time.monotonic() >= self._down_until
+
+    def _mark_down(self):
+        with self._lock:
+            self._down_until = time.monotonic() + self.retry_after
+
+    def enqueue_many(self, jobs):
+        """Hand jobs (see make_job) to the relay.
+
+        Raises:
+            RelayUnavailable: the relay is down (or marked down); nothing was sent.
+            RelayError: the relay timed out or returned an error after the jobs were sent.
+
+        Returns:
+            list of bool: True for each job newly queued.
+        """
+        if not self.is_available():
+            raise RelayUnavailable(f"relay {self.url} is marked down")
+        try:
+            r_post = self._session.post(f"{self.url}/api/enqueue", json={"jobs": jobs}, timeout=self.timeout)
+            _posts = r_post.json()
+        except requests.exceptions.RequestException as e:
+            # 接続できなかった (拒否・ConnectTimeout) ときだけ「送っていない」と言える。
+            # "Connection aborted" などの ConnectionError は送信後にも起きるので RelayError にする
+            if not _never_sent(e):
+                raise RelayError(f"relay {self.url}: {e}") from e
+            self._mark_down()
+            raise RelayUnavailable(f"relay {self.url}: {e}") from e
+        except ValueError as e:
+            raise RelayError(f"relay {self.url}: {e}") from e
+        if r_post.status_code != 200 or _posts.get("status") != "success":
+            raise RelayError(f"relay {self.url}: status={r_post.status_code}, {_posts}")
+        return _posts.get("data") or []
+
+    def enqueue(self, item: api_item.EAGLE_ITEM_PATH, folder, server_url="http://localhost", port=41595, key=None):
+        """Same signature as outbox.Outbox.enqueue. Returns True if newly queued."""
+        _ret = self.enqueue_many([make_job(item, folder, server_url, port, key)])
+        return bool(_ret and _ret[0])
+
+    def health(self):
+        """{"pending": n} from the relay, or None if it is unreachable."""
+        try:
+            r_get = self._session.get(f"{self.url}/api/health", timeout=self.timeout)
+            return r_get.json().get("data")
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+
+class RelayOutbox:
+    def __init__(self, client: RelayClient, get_local_outbox):
+        """Outbox-compatible front: jobs go to the relay, or to the local outbox while it is down.
+
+        Args:
+            client           : RelayClient.
+            get_local_outbox : callable returning the process's own outbox.Outbox (created lazily).
+        """
+        self.client = client
+        self.get_local_outbox = get_local_outbox
+        self._lock = threading.Lock()
+        self._local = None
+        self._warned_until = 0.0
+
+    def enqueue(self, item: api_item.EAGLE_ITEM_PATH, folder, server_url="http://localhost", port=41595, key=None):
+        """Same as outbox.Outbox.enqueue.
+
+        Raises:
+            RelayError: the relay may have queued the job but did not confirm it twice in a row.
+        """
+        if not key:
+            # ローカルへ切り替えても、送り直しても同じジョブと分かるようにキーを固定する
+            key = outbox.make_idempotency_key(item, server_url, port, folder)
+        try:
+            try:
+                return self.client.enqueue(item, folder, server_url=server_url, port=port, key=key)
+            except RelayUnavailable:
+                raise
+            except RelayError as e:
+                # 受け取られていれば中継デーモン側の INSERT OR IGNORE で 1 件にまとまる
+                logger.warning("中継デーモンの応答が得られないため送り直します: %s", e)
+                return self.client.enqueue(item, folder, server_url=server_url, port=port, key=key)
+        except RelayUnavailable as e:
+            self._warn_fallback(e)
+        return self._local_outbox().enqueue(item, folder, server_url=server_url, port=port, key=key)
+
+    def _warn_fallback(self, error):
+        # 停止中は保存のたびに呼ばれるので、警告は停止とみなす期間 (retry_after) ごとに 1 回
+        now = time.monotonic()
+        with self._lock:
+            warn = now >= self._warned_until
+            if warn:
+                self._warned_until = now + self.client.retry_after
+        if warn:
+            logger.warning("中継デーモンに接続できないため、ローカルのアウトボックスに積みます: %s", error)
+        else:
+            logger.debug("中継デーモンの停止中: %s", error)
+
+    def _local_outbox(self):
+        with self._lock:
+            if self._local is None:
+                self._local = self.get_local_outbox()
+            return self._local
+
+    def pending_count(self):
+        """ローカルのアウトボックスに残っている件数 (切り替えたことが無ければ 0)"""
+        with self._lock:
+            local = self._local
+        return local.pending_count() if local is not None else 0
@@ -0,0 +1,257 @@
+# Priority scheduling and rate limiting of requests to one Eagle server
+#
+# transport._send は送信前にサーバーごとのスケジューラーから許可を受け取る。
+# - 優先度: INTERACTIVE (webui の保存) > LIVE (監視で見つけた新規ファイル) > BACKFILL
+#   待っている要求は優先度順 (同じ優先度なら到着順) に通す
+# - トークンバケット: サーバーごとの秒間リクエスト数の上限 (rate=0 なら無制限)。
+#   INTERACTIVE は待たずに前借りでき、その分は後続のバックグラウンド要求が待つ
+# - バックグラウンド (LIVE / BACKFILL) の同時実行数の上限。adaptive を有効にすると
+#   エンドポイントごとの平常時の応答時間に比べて遅くなったら上限を下げ (AIMD)、
+#   戻れば少しずつ上げる。INTERACTIVE は同時実行数の制限を受けない
+#
+# 優先度はスレッド (context) ごとに priority() で指定し、指定が無ければ
+# プロセスの既定値 (set_default_priority) を使う。
+# 別プロセス (拡張機能と監視スクリプト) の間では直接調整できないが、
+# adaptive による応答時間の監視で、相手の負荷が上がると自分のバックグラウンド送信を絞る。
+#
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+INTERACTIVE = 0
+LIVE = 1
+BACKFILL = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", LIVE: "live", BACKFILL: "backfill"}
+
+_current = contextvars.ContextVar("eagle_priority", default=None)
+_default_priority = INTERACTIVE
+
+
+def set_default_priority(level):
+    """priority() で指定していない呼び出しの優先度 (プロセス全体)"""
+    global _default_priority
+    _default_priority = level
+
+
+def current_priority():
+    level = _current.get()
+    return _default_priority if level is None else level
+
+
+@contextlib.contextmanager
+def priority(level):
+    """この中で行う Eagle への要求の優先度を指定する"""
+    token = _current.set(level)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate=0.0, burst=20.0):
+        """
+        Args:
+            rate  : tokens per second. 0 or less means unlimited.
+            burst : bucket size.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self._tokens + (now - self._last) * self.rate, self.burst)
+        self._last = now
+
+    def take(self, now, borrow=False):
+        """Take one token. Returns seconds to wait before retrying (0 = taken).
+
+        borrow=True always takes, letting the bucket go negative (down to -burst).
+        Caller must hold the scheduler lock.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self._tokens >= 1.0 or borrow:
+            self._tokens = max(self._tokens - 1.0, -self.burst)
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+
+class _Latency:
+    __slots__ = ("fast", "base")
+
+    def __init__(self, seconds):
+        self.fast = seconds
+        self.base = seconds
+
+
+class Ticket:
+    __slots__ = ("priority", "path", "waited")
+
+    def __init__(self, priority, path, waited):
+        self.priority = priority
+        self.path = path
+        self.waited = waited
+
+
+class Scheduler:
+    def __init__(
+        self,
+        rate=0.0,
+        burst=20.0,
+        background_limit=6,
+        adaptive=False,
+        tolerance=2.0,
+        min_limit=1.0,
+        decrease=0.7,
+        cooldown=1.0,
+    ):
+        """
+        Args:
+            rate             : requests per second for this server (0 = unlimited).
+            burst            : token bucket size.
+            background_limit : max concurrent LIVE / BACKFILL requests.
+            adaptive         : lower the background limit while Eagle is slow.
+            tolerance        : "slow" = recent latency > normal latency * tolerance.
+            min_limit        : adaptive lower bound of the background limit.
+            decrease         : multiplicative decrease factor when slow.
+            cooldown         : min seconds between two decreases.
+        """
+        self._cond = threading.Condition()
+        self._bucket = TokenBucket(rate, burst)
+        self._seq = itertools.count()
+        self._waiters = []  # heap of (priority, seq)
+        self._background = 0
+        self._latency = {}  # {path: _Latency}
+        self._last_decrease = 0.0
+        self.max_limit = float(background_limit)
+        self.limit = float(background_limit)
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+    def configure(self, rate=None, burst=None, background_limit=None, adaptive=None):
+        with self._cond:
+            if rate is not None:
+                self._bucket.rate = rate
+            if burst is not None:
+                self._bucket.burst = burst
+            if background_limit is not None:
+                self.max_limit = float(background_limit)
+                self.limit = min(self.limit, self.max_limit) if self.adaptive else self.max_limit
+            if adaptive is not None:
+                self.adaptive = adaptive
+                if not adaptive:
+                    self.limit = self.max_limit
+            self._cond.notify_all()
+
+    def _may_start(self, level):
+        return level == INTERACTIVE or self._background < int(self.limit)
+
+    def acquire(self, level, path=""):
+        """Wait until a request of this priority may be sent.
+
+        Returns:
+            Ticket: pass it to release() when the request has finished.
+        """
+        started = time.perf_counter()
+        me = (level, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiters[0] == me and self._may_start(level):
+                        wait = self._bucket.take(
+                            time.monotonic(), borrow=level == INTERACTIVE
+                        )
+                        if wait <= 0:
+                            break
+                        timeout = wait
+                    self._cond.wait(timeout)
+            finally:
+                self._waiters.remove(me)
+                heapq.heapify(self._waiters)
+                # 先頭が変わったので次の待ち手を起こす
+                self._cond.notify_all()
+            if level != INTERACTIVE:
+                self._background += 1
+        return Ticket(level, path, time.perf_counter() - started)
+
+    def release(self, ticket, elapsed=None):
+        """Finish a request. elapsed (sec) feeds adaptive throttling; None = no sample."""
+        with self._cond:
+            if ticket.priority != INTERACTIVE:
+                self._background -= 1
+            if elapsed is not None:
+                self._observe(ticket.path, elapsed)
+            self._cond.notify_all()
+
+    def _observe(self, path, seconds):
+        lat = self._latency.get(path)
+        if lat is None:
+            self._latency[path] = _Latency(seconds)
+            return
+        lat.fast += 0.3 * (seconds - lat.fast)
+        # 平常時の値は最小値を基本とし、ゆっくり上方向にも追従させる (環境の変化に追従)
+        lat.base = min(lat.base * 1.001, lat.fast) if lat.fast > 0 else lat.base
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        if lat.fast > max(lat.base, 0.001) * self.tolerance:
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+        elif self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "background": self._background,
+                "waiting": len(self._waiters),
+                "rate": self._bucket.rate,
+            }
+
+
+_defaults = {}
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """全サーバーのスケジューラー (今後作られる分も含む) の設定を変える。
+
+    引数は Scheduler.configure と同じ (rate, burst, background_limit, adaptive)。
+    """
+    with _schedulers_lock:
+        _defaults.update({k: v for k, v in kwargs.items() if v is not None})
+        existing = list(_schedulers.values())
+    for sched in existing:
+        sched.configure(**kwargs)
+
+
+def get_scheduler(server_url, port):
+    """(server_url, port) ごとに共有される Scheduler を返す"""
+    key = (server_url, port)
+    with _schedulers_lock:
+        sched = _schedulers.get(key)
+        if sched is None:
+            sched = Scheduler(**_defaults)
+            _schedulers[key] = sched
+        return sched
+
+
+def snapshot():
+    """{(server_url, port): stats} を返す (監視・デバッグ用)"""
+    with _schedulers_lock:
+        items = list(_schedulers.items())
+    return {k: s.stats() for k, s in items}
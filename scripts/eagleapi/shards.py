@@ -0,0 +1,103 @@
+# Route images across several Eagle servers
+#
+# 複数の Eagle ライブラリ (サーバー) へ画像を振り分ける。
+# 各シャードは transport のサーバー別コネクションプールと api_folder のフォルダミラーを
+# それぞれ専用に持つので、取り込みのスループットはサーバー数に比例して伸びる。
+#
+import bisect
+import hashlib
+import itertools
+import threading
+
+from . import api_folder, api_util, transport
+
+RULE_SEED = "seed"
+RULE_PROMPT = "prompt"
+RULE_MODEL = "model"
+RULE_ROUND_ROBIN = "round_robin"
+RULES = [RULE_SEED, RULE_PROMPT, RULE_MODEL, RULE_ROUND_ROBIN]
+
+
+class EagleShard:
+    def __init__(self, server_url="http://localhost", port=41595):
+        self.server_url = server_url
+        self.port = port
+
+    @property
+    def name(self):
+        return f"{self.server_url}:{self.port}"
+
+    @property
+    def session(self):
+        return transport.get_session(self.server_url, self.port)
+
+    @property
+    def folders(self):
+        return api_folder.get_mirror(self.server_url, self.port)
+
+    def __repr__(self):
+        return f"EagleShard({self.name})"
+
+
+def parse_endpoints(endpoints):
+    """"http://a:41595, http://b:41596" のような文字列 (または list) から EagleShard の list を作る"""
+    if isinstance(endpoints, str):
+        endpoints = endpoints.replace("\n", ",").split(",")
+    shards = []
+    for _ep in endpoints:
+        _ep = _ep.strip()
+        if not _ep:
+            continue
+        if "://" not in _ep:
+            _ep = f"http://{_ep}"
+        server_url, port = api_util.get_url_port(_ep)
+        if not server_url or not port:
+            continue
+        if any(s.server_url == server_url and s.port == port for s in shards):
+            continue
+        shards.append(EagleShard(server_url, port))
+    return shards
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardRouter:
+    def __init__(self, shards, rule=RULE_SEED, vnodes=64):
+        """
+        Args:
+            shards : list of EagleShard (at least one).
+            rule   : "seed" / "prompt" / "model" (consistent hash of the value)
+                     or "round_robin".
+            vnodes : virtual nodes per shard on the hash ring.
+        """
+        if not shards:
+            raise ValueError("ShardRouter needs at least one shard")
+        if rule not in RULES:
+            raise ValueError(f"unknown shard rule: {rule}")
+        self.shards = shards
+        self.rule = rule
+        self._ring = sorted(
+            (_hash(f"{shard.name}#{i}"), idx)
+            for idx, shard in enumerate(shards)
+            for i in range(vnodes)
+        )
+        self._ring_keys = [k for k, _ in self._ring]
+        self._rr = itertools.count()
+        self._rr_lock = threading.Lock()
+
+    def route(self, seed=None, prompt=None, model=None):
+        """ルールに従って送信先の EagleShard を返す"""
+        if len(self.shards) == 1:
+            return self.shards[0]
+        if self.rule == RULE_ROUND_ROBIN:
+            with self._rr_lock:
+                return self.shards[next(self._rr) % len(self.shards)]
+        value = {RULE_SEED: seed, RULE_PROMPT: prompt, RULE_MODEL: model}[self.rule]
+        if value is None or value == "":
+            # 振り分けキーが無い画像はラウンドロビンで散らす
+            with self._rr_lock:
+                return self.shards[next(self._rr) % len(self.shards)]
+        pos = bisect.bisect(self._ring_keys, _hash(str(value))) % len(self._ring)
+        return self.shards[self._ring[pos][1]]
@@ -0,0 +1,69 @@
+# Single-flight call coalescing
+#
+# 同じキーの処理が同時に呼ばれたとき、最初の呼び出しだけが実際に処理を行い、
+# 後から来た呼び出しはその結果 (または例外) を待って共有する。
+# フォルダの find-or-create を (server, parent, name) ごとに 1 本にまとめ、
+# 一覧の取得と作成リクエストの重複、および同名フォルダの重複作成を防ぐ。
+#
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # {key: _Call}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn once per key among concurrent callers and share its result.
+
+        Args:
+            key : hashable key, e.g. (server_url, port, parent_id, name).
+            fn  : function to run. args / kwargs are passed to it.
+
+        Raises:
+            Exception: whatever fn raised, re-raised in every waiting caller.
+
+        Returns:
+            return value of fn (the leader's result for waiting callers).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # 終わった呼び出しは外す。以降の呼び出しは (ミラーに反映済みの) 最新状態で処理する
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+# フォルダの find-or-create 用 (キーは (server_url, port, parent_id, name))
+folders = Group()
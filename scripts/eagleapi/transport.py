@@ -0,0 +1,212 @@
+# Common HTTP path for all eagleapi calls
+#
+# 各 api_* モジュールは requests を直接呼ばずにここを通す。
+# - サーバーごとのサーキットブレーカーで結果を記録し、open 中は即座に失敗させる
+# - エンドポイントごとの応答時間 (EWMA) から read タイムアウトを決める。再送すると
+#   二重登録になる POST では呼び出し側の指定より短くしない
+# - 接続はサーバーごとの Session (コネクションプール) を使い回す
+# - 一時的な失敗はジッター付き指数バックオフで再試行する。ただし再試行は
+#   全体で共有するリトライ予算の範囲内に限り、過負荷の Eagle に再試行が殺到しない
+# - 送信前にサーバーごとのスケジューラー (優先度・レート制限・同時実行数) の許可を待つ
+#
+import random
+import threading
+import time
+
+import requests
+
+from . import circuit, hooks, latency, scheduler
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, min_per_sec=1.0, max_tokens=10.0):
+        """Token bucket shared by all retries.
+
+        Args:
+            ratio       : tokens earned by each first attempt (0.2 = +20% retries).
+            min_per_sec : tokens earned per second regardless of traffic.
+            max_tokens  : bucket size.
+        """
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._tokens + (now - self._last) * self.min_per_sec, self.max_tokens
+        )
+        self._last = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def try_withdraw(self):
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+
+retry_budget = RetryBudget()
+
+POOL_MAXSIZE = 8
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(server_url, port):
+    """(server_url, port) ごとに専用のコネクションプールを持つ Session を返す"""
+    key = (server_url, port)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=POOL_MAXSIZE
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 5.0
+
+
+def _is_retryable(exc, response, idempotent):
+    if isinstance(exc, circuit.CircuitOpenError):
+        return False
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        # 接続できていないので POST でも送信されていない
+        return True
+    if not idempotent:
+        return False
+    if exc is not None:
+        return isinstance(
+            exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        )
+    return response is not None and response.status_code >= 500
+
+
+def _send(method, server_url, port, path, timeout, kwargs, idempotent=True):
+    breaker = circuit.get_breaker(server_url, port)
+    tracker = latency.get_tracker(server_url, port, path)
+    breaker.check()
+    connect_timeout, read_timeout = timeout
+    if idempotent:
+        read_timeout = tracker.read_timeout(read_timeout)
+    elif read_timeout is not None:
+        # 遅いだけで成功する addFromPaths などを打ち切ると、呼び出し側が送り直して二重登録になる
+        read_timeout = max(read_timeout, tracker.read_timeout(read_timeout))
+    level = scheduler.current_priority()
+    sched = scheduler.get_scheduler(server_url, port)
+    ticket = sched.acquire(level, path)
+    elapsed = None
+    start = time.perf_counter()
+    with hooks.tracer().span(
+        "http",
+        method=method,
+        endpoint=path,
+        server=f"{server_url}:{port}",
+        priority=scheduler.PRIORITY_NAMES.get(level, level),
+        queued_ms=round(ticket.waited * 1000, 3),
+    ) as span_args:
+        try:
+            r = get_session(server_url, port).request(
+                method,
+                f"{server_url}:{port}{path}",
+                timeout=(connect_timeout, read_timeout),
+                **kwargs,
+            )
+        except requests.exceptions.ReadTimeout:
+            # 打ち切られたサンプルとして記録し、推定値を引き上げる
+            tracker.observe(read_timeout)
+            breaker.record_failure()
+            elapsed = read_timeout
+            raise
+        except BaseException:
+            # 想定外の例外でも記録して half_open の試行枠を解放する
+            breaker.record_failure()
+            raise
+        else:
+            elapsed = time.perf_counter() - start
+        finally:
+            sched.release(ticket, elapsed)
+        span_args["status"] = r.status_code
+    tracker.observe(elapsed)
+    if r.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return r
+
+
+def request(
+    method, server_url, port, path, timeout=(3, 10), idempotent=None, **kwargs
+):
+    """Send one request to Eagle through the server's circuit breaker.
+
+    Args:
+        method     : "GET" or "POST".
+        server_url : e.g. "http://localhost".
+        port       : e.g. 41595.
+        path       : API path, e.g. "/api/folder/list".
+        timeout    : (connect, read) timeout. read is used until the endpoint's
+                     latency tracker has enough samples, then replaced by p99-based value.
+                     For non-idempotent requests the p99-based value only ever extends it.
+        idempotent : allow retry after the request may have reached Eagle.
+                     Defaults to True for GET, False otherwise.
+        kwargs     : passed to requests (json=, data=, headers=, ...).
+
+    Raises:
+        circuit.CircuitOpenError: the circuit is open (no request was sent).
+        requests.exceptions.RequestException: connection error / timeout.
+
+    Returns:
+        Response: return of requests.Session.request
+    """
+    if idempotent is None:
+        idempotent = method.upper() == "GET"
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        exc = None
+        r = None
+        try:
+            r = _send(method, server_url, port, path, timeout, kwargs, idempotent)
+        except Exception as e:
+            exc = e
+        if (
+            attempt >= MAX_RETRIES
+            or not _is_retryable(exc, r, idempotent)
+            or not retry_budget.try_withdraw()
+        ):
+            if exc is not None:
+                raise exc
+            return r
+        attempt += 1
+        # full jitter
+        time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2**attempt))))
+        # ストリーミングの本文 (api_item.Base64JsonBody など) は先頭から送り直す
+        body = kwargs.get("data")
+        if hasattr(body, "seek"):
+            body.seek(0)
+
+
+def get(server_url, port, path, timeout=(3, 10), **kwargs):
+    return request("GET", server_url, port, path, timeout=timeout, **kwargs)
+
+
+def post(server_url, port, path, timeout=(3, 10), **kwargs):
+    return request("POST", server_url, port, path, timeout=timeout, **kwargs)
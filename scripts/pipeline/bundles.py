@@ -0,0 +1,421 @@
+# Rolling uncompressed archives for high-volume Drive transfers
+#
+# Colab / Paperspace で大量の小さな画像を 1 枚ずつ Drive へ送ると、ファイルごとの
+# オーバーヘッド (API 呼び出し・FUSE の書き込み) が支配的になる。
+# BundleWriter は画像をローカルの無圧縮 tar に追記していき、件数・サイズ・経過時間の
+# どれかが上限に達したら末尾に manifest.json (各画像の注釈・タグ・MD5・サイズ) を加えて閉じ、
+# deliver(path, date_str) で 1 ファイルとして送る。
+# - 書き込み中の tar は ".part"。画像を 1 枚追記するごとに終端の位置とメタ情報を ".jsonl" に
+#   記録するので、途中で終了しても起動時に最後の完全な画像まで切り詰めて閉じ直せる
+# - 閉じた tar の送信はバックグラウンドスレッドで行い、失敗したら間隔を空けて再試行する
+#   (終了時の flush は呼び出し元のスレッドで送る)
+# - 受け取り側 (utils/google_drive_eagle_transfer.py) は manifest だけを読んで未処理の画像を
+#   取り出し、画像を開き直さずにまとめて Eagle へ登録する
+#
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from scripts.pipeline import log
+
+logger = log.get_logger("bundles")
+
+BUNDLE_SUFFIX = ".eagle.tar"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+IMAGE_DIR = "images"
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".jsonl"
+
+
+def is_bundle(path: str) -> bool:
+    """アーカイブか (同期やコピーの途中の ".syncing-" などの隠しファイルは除く)"""
+    name = os.path.basename(path)
+    return name.lower().endswith(BUNDLE_SUFFIX) and not name.startswith(".")
+
+
+def read_manifest(tar: tarfile.TarFile) -> dict:
+    """開いたアーカイブから manifest を読みます (無圧縮 tar なのでヘッダーをたどるだけで済む)。"""
+    member = tar.getmember(MANIFEST_NAME)
+    with tar.extractfile(member) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"unsupported bundle version: {manifest.get('version')}")
+    return manifest
+
+
+class BundleLimits:
+    def __init__(
+        self,
+        max_count: int = 500,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_seconds: float = 300.0,
+    ):
+        """アーカイブを閉じる条件。どれか 1 つに達したら閉じます (0 は無制限)。
+
+        Args:
+            max_count: 1 つのアーカイブに入れる画像の数
+            max_bytes: 1 つのアーカイブの大きさ (バイト)
+            max_seconds: 最初の画像を入れてから閉じるまでの時間 (秒)
+        """
+        self.max_count = int(max_count)
+        self.max_bytes = int(max_bytes)
+        self.max_seconds = float(max_seconds)
+
+    def key(self) -> Tuple[int, int, float]:
+        return (self.max_count, self.max_bytes, self.max_seconds)
+
+
+class _OpenBundle:
+    def __init__(self, path: str, date_str: str, entries: Optional[List[dict]] = None):
+        """書き込み中のアーカイブ。entries を渡すと中断したアーカイブの続きから書きます。"""
+        self.path = path
+        self.date_str = date_str
+        self.part = path + PART_SUFFIX
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.entries = list(entries or [])
+        self.names = {e["member"] for e in self.entries}
+        self.opened_at = time.time()
+        if self.entries:
+            self._file = open(self.part, "r+b")
+            self._file.seek(self.entries[-1]["offset"])
+            self._file.truncate()
+            # 壊れているかもしれない最後の行を除いて書き直す
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+            for entry in self.entries:
+                self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._journal.flush()
+        else:
+            self._file = open(self.part, "wb")
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+        self._tar = tarfile.open(fileobj=self._file, mode="w", format=tarfile.PAX_FORMAT)
+
+    @property
+    def size(self) -> int:
+        return self._tar.offset
+
+    def _member_name(self, filename: str) -> str:
+        name = f"{IMAGE_DIR}/{filename}"
+        base, ext = os.path.splitext(name)
+        n = 1
+        while name in self.names:
+            name = f"{base}-{n}{ext}"
+            n += 1
+        self.names.add(name)
+        return name
+
+    def add(self, filename: str, data: bytes, meta: dict) -> str:
+        now = time.time()
+        info = tarfile.TarInfo(self._member_name(filename))
+        info.size = len(data)
+        info.mtime = int(now)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._file.flush()
+        entry = dict(
+            meta,
+            member=info.name,
+            filename=filename,
+            date=self.date_str,
+            md5=hashlib.md5(data).hexdigest(),
+            size=len(data),
+            mtime=now,
+            offset=self._tar.offset,
+        )
+        self.entries.append(entry)
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        return info.name
+
+    def full(self, limits: BundleLimits) -> bool:
+        return bool(
+            (limits.max_count and len(self.entries) >= limits.max_count)
+            or (limits.max_bytes and self.size >= limits.max_bytes)
+        )
+
+    def expired(self, limits: BundleLimits) -> bool:
+        return bool(limits.max_seconds and time.time() - self.opened_at >= limits.max_seconds)
+
+    def seal(self) -> str:
+        """manifest を加えて閉じ、完成したアーカイブのパスを返します。"""
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "created": time.time(),
+            "date": self.date_str,
+            "entries": [
+                {k: v for k, v in e.items() if k != "offset"} for e in self.entries
+            ],
+        }
+        data = json.dumps(manifest, ensure_ascii=False).encode("utf-8")
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+        self._tar.close()
+        self._file.close()
+        self._journal.close()
+        os.replace(self.part, self.path)
+        os.remove(self.journal_path)
+        return self.path
+
+    def discard(self) -> None:
+        self._tar.close()
+        self._file.close()
+        self._journal.close()
+        for path in (self.part, self.journal_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _read_journal(path: str) -> List[dict]:
+    entries = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # 書き込み途中で終了した最後の行
+    except OSError:
+        pass
+    return entries
+
+
+class BundleWriter:
+    def __init__(
+        self,
+        work_dir: str,
+        deliver: Callable[[str, str], None],
+        limits: Optional[BundleLimits] = None,
+        prefix: str = "eagle",
+        retry_interval: float = 30.0,
+    ):
+        """
+        Args:
+            work_dir: アーカイブを組み立てるローカルディレクトリ (work_dir/<日付>/)
+            deliver: 閉じたアーカイブのパスと日付を受け取り、送信先へ届ける関数。
+                戻った時点でファイルが残っていれば削除する。例外なら後で再試行する
+            limits: アーカイブを閉じる条件
+            prefix: アーカイブのファイル名の接頭辞
+            retry_interval: 送信に失敗したアーカイブを再試行するまでの時間 (秒)
+        """
+        self.work_dir = work_dir
+        self.deliver = deliver
+        self.limits = limits or BundleLimits()
+        self.prefix = prefix
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._current: Optional[_OpenBundle] = None
+        self._sealed: Dict[str, Tuple[str, float]] = {}  # {path: (日付, 次に試す時刻)}
+        self._in_flight = 0
+        self._seq = 0
+        self._token = uuid.uuid4().hex[:8]
+        self._thread: Optional[threading.Thread] = None
+
+    # --- 追記 -------------------------------------------------------------------
+    def _new_path(self, date_str: str) -> str:
+        date_dir = os.path.join(self.work_dir, date_str)
+        os.makedirs(date_dir, exist_ok=True)
+        self._seq += 1
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        # 複数の webui が同じ Drive フォルダへ送っても名前が衝突しないようにする
+        name = f"{self.prefix}-{stamp}-{self._token}-{self._seq:04d}{BUNDLE_SUFFIX}"
+        return os.path.join(date_dir, name)
+
+    def add(
+        self,
+        date_str: str,
+        filename: str,
+        data: bytes,
+        annotation: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+    ) -> str:
+        """画像をアーカイブに追記し、書き込み先のアーカイブのパスを返します。"""
+        meta = {"annotation": annotation or "", "tags": list(tags or [])}
+        if width and height:
+            meta.update(width=int(width), height=int(height))
+        with self._lock:
+            # 日付フォルダごとに分けるので、日付が変わったら閉じる
+            if self._current is not None and self._current.date_str != date_str:
+                self._seal_locked()
+            if self._current is None:
+                self._current = _OpenBundle(self._new_path(date_str), date_str)
+            bundle = self._current
+            bundle.add(filename, data, meta)
+            if bundle.full(self.limits):
+                self._seal_locked()
+        self.start()
+        self._wakeup.set()
+        return bundle.path
+
+    def _seal_locked(self) -> None:
+        bundle, self._current = self._current, None
+        if bundle is None:
+            return
+        if not bundle.entries:
+            bundle.discard()
+            return
+        path = bundle.seal()
+        self._sealed[path] = (bundle.date_str, 0.0)
+        logger.info(
+            "アーカイブを閉じました: %s (%d件, %d bytes)",
+            os.path.basename(path),
+            len(bundle.entries),
+            bundle.size,
+        )
+
+    def seal(self) -> None:
+        """書き込み中のアーカイブを閉じて送信待ちにします。"""
+        with self._lock:
+            self._seal_locked()
+        self._wakeup.set()
+
+    def pending_count(self) -> int:
+        """送信が終わっていないアーカイブの数 (書き込み中のものを含む)"""
+        with self._lock:
+            return len(self._sealed) + self._in_flight + (1 if self._current else 0)
+
+    def recover(self) -> int:
+        """前回の残り (閉じていない / 送れていないアーカイブ) を送信待ちに戻し、その数を返します。"""
+        found = 0
+        if not os.path.isdir(self.work_dir):
+            return 0
+        for date_str in sorted(os.listdir(self.work_dir)):
+            date_dir = os.path.join(self.work_dir, date_str)
+            if not os.path.isdir(date_dir):
+                continue
+            for name in sorted(os.listdir(date_dir)):
+                path = os.path.join(date_dir, name)
+                if name.endswith(BUNDLE_SUFFIX + PART_SUFFIX):
+                    base = path[: -len(PART_SUFFIX)]
+                    entries = _read_journal(base + JOURNAL_SUFFIX)
+                    entries = [e for e in entries if "offset" in e]
+                    bundle = _OpenBundle(base, date_str, entries)
+                    with self._lock:
+                        if entries:
+                            # 最後の完全な画像まで切り詰め、manifest を付けて閉じ直す
+                            self._current, current = bundle, self._current
+                            self._seal_locked()
+                            self._current = current
+                            found += 1
+                        else:
+                            bundle.discard()
+                elif name.endswith(BUNDLE_SUFFIX):
+                    with self._lock:
+                        if path not in self._sealed:
+                            self._sealed[path] = (date_str, 0.0)
+                            found += 1
+        if found:
+            self.start()
+            self._wakeup.set()
+        return found
+
+    # --- バックグラウンド送信 ----------------------------------------------------
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="eagle-bundle-writer", daemon=True
+            )
+            self._thread.start()
+
+    def _take_due(self) -> List[Tuple[str, str]]:
+        now = time.time()
+        with self._lock:
+            if self._current is not None and self._current.expired(self.limits):
+                self._seal_locked()
+            due = sorted(
+                (path, date_str)
+                for path, (date_str, at) in self._sealed.items()
+                if at <= now
+            )
+            for path, _date_str in due:
+                del self._sealed[path]
+            self._in_flight += len(due)
+            return due
+
+    def deliver_once(self) -> int:
+        """期限の来たアーカイブを送り、成功した数を返します。"""
+        due = self._take_due()
+        done = 0
+        for path, date_str in due:
+            try:
+                self.deliver(path, date_str)
+                if os.path.exists(path):
+                    os.remove(path)
+                done += 1
+            except Exception as e:
+                logger.warning(
+                    "アーカイブの送信に失敗しました (後で再試行): %s: %s",
+                    os.path.basename(path),
+                    e,
+                )
+                with self._lock:
+                    self._sealed[path] = (date_str, time.time() + self.retry_interval)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+        return done
+
+    def _seconds_until_next(self) -> float:
+        now = time.time()
+        waits = [1.0]
+        with self._lock:
+            if self._sealed:
+                waits.append(min(at for _d, at in self._sealed.values()) - now)
+            if self._current is not None and self.limits.max_seconds:
+                waits.append(self._current.opened_at + self.limits.max_seconds - now)
+        return max(min(waits), 0.05)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                if self.deliver_once():
+                    continue
+            except Exception as e:
+                logger.error("アーカイブの送信でエラー: %s", e)
+            self._wakeup.wait(self._seconds_until_next())
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """書き込み中のアーカイブを閉じ、送信待ちのアーカイブを呼び出したスレッドで送ります。
+
+        終了時 (atexit) はバックグラウンドのスレッドに頼れないので、ここで deliver を呼ぶ。
+        再試行待ちのアーカイブも 1 回はすぐに試し、それでも失敗したものは待ちません。
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._seal_locked()
+            for path, (date_str, _at) in self._sealed.items():
+                self._sealed[path] = (date_str, 0.0)
+        self.deliver_once()
+        # バックグラウンドで送信中のものが終わるのを待つ
+        with self._lock:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(0.1 if remaining is None else min(remaining, 0.1))
+        return True
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
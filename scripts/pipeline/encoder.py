@@ -0,0 +1,153 @@
+# Image encoding for archive sinks
+#
+# Drive / マウント済みDrive / ローカルアーカイブへ書き出す画像のエンコード。
+# 圧縮レベルや出力形式 (PNG / 最適化PNG / ロスレスWebP) を選べ、
+# 必要ならプロセスプールでエンコードして webui プロセスの GIL と CPU を空ける。
+#
+import concurrent.futures
+import io
+import multiprocessing
+import threading
+import zlib
+from typing import Dict, Optional
+
+from PIL import Image, PngImagePlugin
+
+FORMAT_PNG = "png"
+FORMAT_PNG_OPTIMIZE = "png_optimize"
+FORMAT_WEBP_LOSSLESS = "webp_lossless"
+FORMATS = [FORMAT_PNG, FORMAT_PNG_OPTIMIZE, FORMAT_WEBP_LOSSLESS]
+
+_EXIF_IFD = 0x8769
+_EXIF_USER_COMMENT = 0x9286
+
+
+class EncodedImage:
+    def __init__(self, data: bytes, mimetype: str, ext: str):
+        self.data = data
+        self.mimetype = mimetype
+        self.ext = ext
+
+
+def pnginfo_text(pnginfo: Optional[PngImagePlugin.PngInfo]) -> Dict[str, str]:
+    """PngInfo に追加済みのテキストチャンク (tEXt / zTXt / iTXt) を辞書で返します。"""
+    text = {}
+    if pnginfo is None:
+        return text
+    for chunk in pnginfo.chunks:
+        cid, data = chunk[0], chunk[1]
+        try:
+            if cid == b"tEXt":
+                k, v = data.split(b"\0", 1)
+                text[k.decode("latin-1")] = v.decode("latin-1")
+            elif cid == b"zTXt":
+                k, v = data.split(b"\0", 1)
+                text[k.decode("latin-1")] = zlib.decompress(v[1:]).decode("latin-1")
+            elif cid == b"iTXt":
+                k, rest = data.split(b"\0", 1)
+                compressed, rest = rest[0], rest[2:]
+                _lang, rest = rest.split(b"\0", 1)
+                _tkey, v = rest.split(b"\0", 1)
+                if compressed:
+                    v = zlib.decompress(v)
+                text[k.decode("latin-1")] = v.decode("utf-8")
+        except Exception:
+            continue
+    return text
+
+
+def encode_image(
+    image: Image.Image,
+    pnginfo: Optional[PngImagePlugin.PngInfo],
+    fmt: str = FORMAT_PNG,
+    compress_level: int = 6,
+) -> EncodedImage:
+    """画像をエンコードします (プロセスプールからも呼ばれるトップレベル関数)。
+
+    Args:
+        image: 画像
+        pnginfo: PNGメタデータ
+        fmt: 出力形式 (png / png_optimize / webp_lossless)
+        compress_level: PNGのzlib圧縮レベル (0-9)
+
+    Returns:
+        EncodedImageオブジェクト
+    """
+    buf = io.BytesIO()
+    if fmt == FORMAT_WEBP_LOSSLESS:
+        # WebP にはテキストチャンクが無いので、webui と同じく parameters を EXIF UserComment に入れる
+        exif = Image.Exif()
+        parameters = pnginfo_text(pnginfo).get("parameters")
+        if parameters:
+            exif.get_ifd(_EXIF_IFD)[_EXIF_USER_COMMENT] = (
+                b"UNICODE\0" + parameters.encode("utf-16-be")
+            )
+        image.save(
+            buf, format="WEBP", lossless=True, quality=100, method=6, exif=exif.tobytes()
+        )
+        return EncodedImage(buf.getvalue(), "image/webp", ".webp")
+    image.save(
+        buf,
+        format="PNG",
+        pnginfo=pnginfo,
+        compress_level=compress_level,
+        optimize=(fmt == FORMAT_PNG_OPTIMIZE),
+    )
+    return EncodedImage(buf.getvalue(), "image/png", ".png")
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_process_pool(max_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """エンコード用のプロセスプールを返します (webui をフォークしないよう spawn で起動)。"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != max_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_workers = max_workers
+        return _pool
+
+
+class ImageEncoder:
+    def __init__(
+        self, fmt: str = FORMAT_PNG, compress_level: int = 6, process_workers: int = 0
+    ):
+        """
+        Args:
+            fmt: 出力形式 (png / png_optimize / webp_lossless)
+            compress_level: PNGのzlib圧縮レベル (0-9)
+            process_workers: 1以上ならその数のプロセスプールでエンコード、0なら同一プロセス
+        """
+        self.fmt = fmt if fmt in FORMATS else FORMAT_PNG
+        self.compress_level = min(max(int(compress_level), 0), 9)
+        self.process_workers = max(int(process_workers), 0)
+
+    @property
+    def key(self):
+        """出力バイト列が同じになる設定を同一視するためのキー"""
+        return (self.fmt, self.compress_level)
+
+    @property
+    def is_default_png(self) -> bool:
+        return self.fmt == FORMAT_PNG and self.compress_level == 6
+
+    def encode(
+        self, image: Image.Image, pnginfo: Optional[PngImagePlugin.PngInfo]
+    ) -> EncodedImage:
+        if self.process_workers > 0:
+            future = get_process_pool(self.process_workers).submit(
+                encode_image, image, pnginfo, self.fmt, self.compress_level
+            )
+            return future.result()
+        return encode_image(image, pnginfo, self.fmt, self.compress_level)
+
+
+DEFAULT_ENCODER = ImageEncoder()
@@ -0,0 +1,148 @@
+# Generation info parsing and tag rules without webui
+#
+# 拡張機能 (generate_tags) とバックフィル用コマンドで共通のタグ生成ルール。
+# webui の modules に依存しないので、webui の外からも使える。
+# parse_parameters は webui が PNG の "parameters" チャンクに書く生成情報を
+# 正のプロンプト / 負のプロンプト / パラメータ辞書に分解する。
+#
+import json
+import re
+from typing import Dict, List, Tuple
+
+NEGATIVE_PROMPT_PREFIX = "negative prompt:"
+
+# webui (generation_parameters_copypaste) と同じ "Key: value," の並び。値は "..." で囲まれることがある
+_RE_PARAM = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+
+# additional_tags に指定できる項目 (scripts.tag_generator TagGenerator.replacements と同じ)
+PARAM_TAG_KEYS = (
+    "Steps",
+    "Sampler",
+    "CFG scale",
+    "Seed",
+    "Face restoration",
+    "Size",
+    "Model hash",
+    "Model",
+    "Hypernet",
+    "Hypernet strength",
+    "Variation seed",
+    "Variation seed strength",
+    "Seed resize from",
+    "Denoising strength",
+    "Conditional mask weight",
+    "Eta",
+    "Clip skip",
+    "ENSD",
+)
+
+
+def split_prompt(prompt: str) -> List[str]:
+    """プロンプトをトークンに分割します。
+
+    Args:
+        prompt: 分割するプロンプト文字列
+
+    Returns:
+        分割されたトークンのリスト
+    """
+    tokens = re.split(r",|\s*(?i:break)\s*", prompt)
+    return [token.strip() for token in tokens if token.strip()]
+
+
+def process_prompt(prompt: str, prefix: str = "") -> List[str]:
+    """プロンプトを処理し、接頭辞を付けてリストを返します。
+
+    Args:
+        prompt: 処理するプロンプト文字列
+        prefix: トークンに付ける接頭辞 (デフォルトは空)
+
+    Returns:
+        処理されたトークンのリスト
+    """
+    tokens = split_prompt(prompt)
+    return [f"{prefix}{token}" for token in tokens] if prefix else tokens
+
+
+def parse_parameters(text: str) -> Tuple[str, str, Dict[str, str]]:
+    """webui の生成情報 (parameters チャンク) を分解します。
+
+    Args:
+        text: 生成情報の文字列
+
+    Returns:
+        positive_prompt, negative_prompt, {"Steps": "30", ...} のタプル
+    """
+    lines = [line.strip() for line in (text or "").strip().split("\n")]
+    params = {}
+    # 最終行が "Key: value" を 3 つ以上含む場合だけパラメータ行とみなす
+    if lines and len(_RE_PARAM.findall(lines[-1])) >= 3:
+        for key, value in _RE_PARAM.findall(lines.pop()):
+            if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key.strip()] = value.strip()
+    positive, negative = [], []
+    target = positive
+    for line in lines:
+        if line.lower().startswith(NEGATIVE_PROMPT_PREFIX):
+            target = negative
+            line = line[len(NEGATIVE_PROMPT_PREFIX) :].strip()
+        if line:
+            target.append(line)
+    return ", ".join(positive), ", ".join(negative), params
+
+
+def prompt_tags(
+    positive_prompt: str,
+    negative_prompt: str,
+    save_positive: bool,
+    save_negative: str,
+) -> List[str]:
+    """プロンプトからタグを作ります (設定 save_positive_prompt_tags / save_negative_prompt_tags と同じ規則)。
+
+    Args:
+        positive_prompt: 正のプロンプト
+        negative_prompt: 負のプロンプト
+        save_positive: 正のプロンプトをタグにする
+        save_negative: "None" / "tag" / "n:tag"
+
+    Returns:
+        タグのリスト
+    """
+    tags = []
+    if save_positive and positive_prompt:
+        tags += process_prompt(positive_prompt)
+    if negative_prompt:
+        if save_negative == "tag":
+            tags += process_prompt(negative_prompt)
+        elif save_negative == "n:tag":
+            tags += process_prompt(negative_prompt, prefix="n:")
+    return tags
+
+
+def param_tags(tags_to_eagle: str, params: Dict[str, str]) -> List[str]:
+    """設定 additional_tags に挙げた項目を "Key: value" のタグにします。
+
+    TagGenerator.generate_from_p と同じ規則で、PARAM_TAG_KEYS に無い項目と値の無い項目は除き、
+    Model は名前から ',' と ':' を取り除きます。
+
+    Args:
+        tags_to_eagle: カンマ区切りの項目名 (例: "Steps, Sampler, Model")
+        params: parse_parameters が返すパラメータ辞書
+
+    Returns:
+        タグのリスト
+    """
+    tags = []
+    for key in (x.strip() for x in (tags_to_eagle or "").split(",")):
+        if key not in PARAM_TAG_KEYS:
+            continue
+        value = params.get(key)
+        if value and key == "Model":
+            value = value.replace(",", "").replace(":", "")
+        if value:
+            tags.append(f"{key}: {value}")
+    return tags
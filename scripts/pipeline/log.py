@@ -0,0 +1,181 @@
+# Namespaced, asynchronous logging for the extension and the watcher
+#
+# ルートロガーを奪わず "eagle_pnginfo" 配下のロガーだけを設定する。
+# - QueueHandler でレコードをキューに積むだけにし、整形と書き込みは別スレッドで行う
+# - 呼び出し箇所 (ファイル名 + 行番号) ごとのレート制限で大量バッチ時の洪水を防ぐ
+# - INFO 以下はサンプリングで間引ける (WARNING 以上は常に出力)
+# - JSON 形式 (1行1レコード) でも出力できる
+#
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+LOGGER_NAME = "eagle_pnginfo"
+
+DEFAULT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+
+
+def get_logger(name=None):
+    """拡張機能用の名前空間付きロガーを返す ("eagle_pnginfo" または "eagle_pnginfo.<name>")"""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, per_sec=5.0, burst=20):
+        """呼び出し箇所ごとのトークンバケット。抑制した件数は次に通した行に付記する。
+
+        Args:
+            per_sec : 1 呼び出し箇所あたり 1 秒に通す件数 (0 以下で無効)
+            burst   : バケットの大きさ
+        """
+        super().__init__()
+        self.per_sec = per_sec
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}  # {(pathname, lineno): [tokens, last, suppressed]}
+
+    def filter(self, record):
+        if self.per_sec <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(self.burst), now, 0]
+                self._buckets[key] = bucket
+            bucket[0] = min(bucket[0] + (now - bucket[1]) * self.per_sec, self.burst)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate=1.0):
+        """INFO 以下のレコードを rate の確率で通す (WARNING 以上は常に通す)"""
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            data["suppressed"] = record.suppressed
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _SuppressedCountFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" (+{suppressed} similar messages suppressed)"
+        return text
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 標準の QueueHandler は呼び出し側スレッドで整形してしまうので、
+        # 例外のトレースバックだけ文字列化してレコードはそのまま渡す
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+_output_handler = None
+
+
+def setup_logging(
+    level=logging.INFO,
+    json_format=False,
+    rate_limit_per_sec=5.0,
+    rate_limit_burst=20,
+    sample_rate=1.0,
+    handler=None,
+):
+    """"eagle_pnginfo" ロガーに非同期ハンドラとフィルタを設定する。何度呼んでもよい。
+
+    Args:
+        level              : ログレベル
+        json_format        : True なら 1 行 1 JSON で出力
+        rate_limit_per_sec : 呼び出し箇所ごとのレート制限 (0 以下で無効)
+        rate_limit_burst   : レート制限のバースト量
+        sample_rate        : INFO 以下を出力する確率 (1.0 で全件)
+        handler            : 出力先ハンドラ (省略時は stderr)
+
+    Returns:
+        Logger: "eagle_pnginfo" ロガー
+    """
+    global _listener, _queue_handler, _output_handler
+    logger = get_logger()
+    with _lock:
+        if _listener is None:
+            q = queue.SimpleQueue()
+            _queue_handler = _DeferredQueueHandler(q)
+            _output_handler = handler or logging.StreamHandler()
+            _listener = logging.handlers.QueueListener(
+                q, _output_handler, respect_handler_level=True
+            )
+            _listener.start()
+            atexit.register(shutdown_logging)
+            logger.addHandler(_queue_handler)
+            logger.propagate = False
+        elif handler is not None and handler is not _output_handler:
+            _listener.handlers = (handler,)
+            _output_handler = handler
+
+        _output_handler.setFormatter(
+            JsonFormatter() if json_format else _SuppressedCountFormatter(DEFAULT_FORMAT)
+        )
+        # 子ロガーから伝播したレコードにも効くようキュー側ハンドラに付ける。
+        # 捨てるレコードはキューに積む前 (整形前) に落ちる
+        for f in list(_queue_handler.filters):
+            _queue_handler.removeFilter(f)
+        if sample_rate < 1.0:
+            _queue_handler.addFilter(SamplingFilter(sample_rate))
+        if rate_limit_per_sec > 0:
+            _queue_handler.addFilter(
+                RateLimitFilter(rate_limit_per_sec, rate_limit_burst)
+            )
+        logger.setLevel(level)
+    return logger
+
+
+def shutdown_logging():
+    """キューに残ったレコードを書き出してリスナーを止める"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            get_logger().removeHandler(_queue_handler)
+            get_logger().propagate = True
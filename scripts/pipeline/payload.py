@@ -0,0 +1,96 @@
+# In-memory image payload shared by every sink
+#
+# webui が params.image から書き出した PNG を読み直さず、メモリ上の画像から
+# 必要になった時点で 1 回だけエンコードし、そのバイト列を全ての送信先で共有する。
+# 送信先ごとに出力形式が違う場合も、同じ設定のエンコードは 1 回に限る。
+#
+import io
+import threading
+from typing import Optional
+
+from PIL import Image, PngImagePlugin
+
+from scripts.pipeline import tracing
+from scripts.pipeline.encoder import DEFAULT_ENCODER, EncodedImage, ImageEncoder
+
+
+class ImagePayload:
+    def __init__(
+        self,
+        image: Image.Image,
+        pnginfo: Optional[PngImagePlugin.PngInfo] = None,
+        source_path: Optional[str] = None,
+        reuse_source: bool = False,
+    ):
+        """送信先で共有する画像データ。
+
+        Args:
+            image: メモリ上の画像 (params.image)
+            pnginfo: 埋め込むPNGメタデータ
+            source_path: webuiが保存済みの画像ファイル
+            reuse_source: True なら既定のPNG出力では再エンコードせず source_path のバイト列を使う
+                          (埋め込むメタデータが保存済みファイルと同じ場合)
+        """
+        self.image = image
+        self.pnginfo = pnginfo
+        self.source_path = source_path
+        self.reuse_source = reuse_source and bool(source_path)
+        self._lock = threading.Lock()
+        self._encoded = {}  # {encoder.key: EncodedImage}
+        self._key_locks = {}  # {encoder.key: Lock}
+        self._closed = False
+
+    def encoded(self, encoder: Optional[ImageEncoder] = None) -> EncodedImage:
+        """エンコード済みの画像を返します。同じ設定のエンコード (または読み込み) は初回の1回のみです。"""
+        encoder = encoder or DEFAULT_ENCODER
+        with self._lock:
+            if self._closed:
+                raise ValueError("ImagePayload is closed")
+            cached = self._encoded.get(encoder.key)
+            if cached is not None:
+                return cached
+            key_lock = self._key_locks.setdefault(encoder.key, threading.Lock())
+        # 別の設定のエンコードとは並行して進められるよう、設定ごとのロックで待つ
+        with key_lock:
+            cached = self._encoded.get(encoder.key)
+            if cached is not None:
+                return cached
+            if self.reuse_source and encoder.is_default_png:
+                with tracing.span("read_source"), open(self.source_path, "rb") as f:
+                    result = EncodedImage(f.read(), "image/png", ".png")
+            else:
+                with tracing.span(
+                    "encode", format=encoder.fmt, compress_level=encoder.compress_level
+                ) as span_args:
+                    result = encoder.encode(self.image, self.pnginfo)
+                    span_args["bytes"] = len(result.data)
+            with self._lock:
+                if not self._closed:
+                    self._encoded[encoder.key] = result
+            return result
+
+    def png_bytes(self) -> bytes:
+        """既定の設定でエンコードしたPNGのバイト列を返します。"""
+        return self.encoded().data
+
+    def open_stream(self, encoder: Optional[ImageEncoder] = None) -> io.BytesIO:
+        """共有バイト列を読むための新しいストリームを返します。"""
+        return io.BytesIO(self.encoded(encoder).data)
+
+    def write_to(self, path: str, encoder: Optional[ImageEncoder] = None) -> int:
+        """画像をファイルに書き出し、書き込んだバイト数を返します。"""
+        data = self.encoded(encoder).data
+        with open(path, "wb") as f:
+            f.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        with self._lock:
+            self._encoded.clear()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,129 @@
+# Date folder prewarming
+#
+# 日付フォルダ (Eagle のサブフォルダ / Drive のフォルダ / 保存先ディレクトリ) を
+# 画像の処理経路で初めて作るのではなく、バックグラウンドで先に用意しておく。
+# - 起動時: ルートと今日のフォルダを解決する
+# - 0時の lead_seconds 前: 明日のフォルダを作成しておく
+# 失敗した分は retry_interval ごとにやり直す。日付の切り替わりで処理が待たされず、
+# 複数のワーカーが同時に同じフォルダを作りに行く競合も起きにくくなる。
+#
+import datetime
+import threading
+from typing import Callable, Iterable, Optional, Tuple
+
+from scripts.pipeline import log
+
+logger = log.get_logger("prewarm")
+
+# (名前, 日付文字列を受け取りフォルダを用意する関数)。関数は成功時に True を返す
+PrewarmTarget = Tuple[str, Callable[[str], bool]]
+
+MAX_SLEEP = 3600.0
+
+
+def date_str(day: datetime.date) -> str:
+    return day.strftime("%Y-%m-%d")
+
+
+class PrewarmScheduler:
+    def __init__(
+        self,
+        get_targets: Callable[[], Iterable[PrewarmTarget]],
+        lead_seconds: float = 600.0,
+        retry_interval: float = 60.0,
+    ):
+        """
+        Args:
+            get_targets: 実行のたびに呼ばれ、その時点で有効な対象の一覧を返す関数
+            lead_seconds: 0時の何秒前に翌日のフォルダを作るか
+            retry_interval: 失敗した対象をやり直す間隔 (秒)
+        """
+        self.get_targets = get_targets
+        self.lead_seconds = lead_seconds
+        self.retry_interval = retry_interval
+        self._done = set()  # {(target_name, date_str)}
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="eagle-prewarm", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            thread.join()
+
+    def wakeup(self) -> None:
+        """設定変更などで対象が変わったときに、次の予定を待たずに実行させます。"""
+        self._wakeup.set()
+
+    def due_dates(self, now: Optional[datetime.datetime] = None):
+        """now の時点で用意しておくべき日付 (今日と、0時直前なら明日) を返します。"""
+        now = now or datetime.datetime.now()
+        today = now.date()
+        tomorrow = today + datetime.timedelta(days=1)
+        dates = [date_str(today)]
+        midnight = datetime.datetime.combine(tomorrow, datetime.time.min)
+        if (midnight - now).total_seconds() <= self.lead_seconds:
+            dates.append(date_str(tomorrow))
+        return dates
+
+    def run_once(self, now: Optional[datetime.datetime] = None) -> bool:
+        """期限の来た日付のフォルダを用意します。全て成功したら True を返します。"""
+        dates = self.due_dates(now)
+        ok = True
+        for name, fn in self.get_targets():
+            for d in dates:
+                if (name, d) in self._done:
+                    continue
+                try:
+                    warmed = fn(d)
+                except Exception as e:
+                    logger.warning("%s: フォルダの事前作成に失敗しました (%s): %s", name, d, e)
+                    warmed = False
+                if warmed:
+                    self._done.add((name, d))
+                    logger.info("%s: フォルダを事前に用意しました: %s", name, d)
+                else:
+                    ok = False
+        # 過ぎた日付の記録は捨てる
+        self._done = {(n, d) for n, d in self._done if d >= dates[0]}
+        return ok
+
+    def seconds_until_next(self, now: Optional[datetime.datetime] = None) -> float:
+        """次に実行すべき時刻 (翌日分を作る時刻、または日付が変わる時刻) までの秒数"""
+        now = now or datetime.datetime.now()
+        midnight = datetime.datetime.combine(
+            now.date() + datetime.timedelta(days=1), datetime.time.min
+        )
+        until_midnight = (midnight - now).total_seconds()
+        if until_midnight > self.lead_seconds:
+            return until_midnight - self.lead_seconds
+        # 翌日分は作成済み。日付が変わった直後に次の周期を始める
+        return until_midnight + 1.0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                ok = self.run_once()
+            except Exception as e:
+                logger.error("フォルダの事前作成で予期しないエラー: %s", e)
+                ok = False
+            # スリープや時刻の変更でずれないよう、長くても MAX_SLEEP ごとに見直す
+            wait = min(self.seconds_until_next(), MAX_SLEEP)
+            if not ok:
+                wait = min(wait, self.retry_interval)
+            self._wakeup.wait(wait)
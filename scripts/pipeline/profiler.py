@@ -0,0 +1,259 @@
+# Built-in profiling hooks for the extension and the watcher
+#
+# 再起動せずに本番環境でプロファイルを取るための 2 つの仕組み。
+# - CallProfiler  : N 回に 1 回だけ処理を cProfile で包み、.pstats と collapsed stack を書き出す
+# - StackSampler  : 全スレッドのスタックを一定間隔で採取する低負荷のサンプラー。
+#                   設定・シグナル (SIGUSR2)・制御ファイルで実行中に ON/OFF できる
+# collapsed stack ("a;b;c 123" 形式) は flamegraph.pl / speedscope などでそのまま読める。
+#
+import cProfile
+import collections
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+_lock = threading.Lock()
+_out_dir = None
+
+
+def _output_path(prefix: str, ext: str) -> str:
+    os.makedirs(_out_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(_out_dir, f"{prefix}-{stamp}-{os.getpid()}{ext}")
+
+
+def _frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+
+def _func_label(func) -> str:
+    filename, lineno, name = func
+    if filename == "~":
+        return name  # 組み込み関数 ("<built-in method ...>")
+    return f"{os.path.basename(filename)}:{name}:{lineno}"
+
+
+def write_collapsed(path: str, counts) -> None:
+    """{stack: weight} を collapsed stack 形式で書き出します。"""
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, weight in sorted(counts.items()):
+            if weight > 0:
+                f.write(f"{stack} {int(weight)}\n")
+
+
+def pstats_to_collapsed(stats: pstats.Stats, max_depth: int = 64) -> dict:
+    """cProfile の結果を collapsed stack ({stack: マイクロ秒}) に変換します。
+
+    cProfile は呼び出し元と呼び出し先の組しか記録しないので、各関数の自己時間を
+    呼び出し元ごとの累積時間の比で按分しながら根までたどった近似になります。
+    """
+    raw = stats.stats  # {func: (cc, nc, tt, ct, callers)}
+    counts = collections.Counter()
+
+    def walk(func, weight, path, depth):
+        callers = raw.get(func, (0, 0, 0, 0, {}))[4]
+        callers = {c: v for c, v in callers.items() if c not in path}
+        total = sum(v[3] for v in callers.values())
+        # 1 マイクロ秒未満まで按分された枝はそれ以上たどらない (経路数の爆発を防ぐ)
+        if not callers or total <= 0 or depth >= max_depth or weight < 1.0:
+            counts[";".join(_func_label(f) for f in reversed(path))] += weight
+            return
+        for caller, v in callers.items():
+            walk(caller, weight * v[3] / total, path + (caller,), depth + 1)
+
+    for func, (_cc, _nc, tt, _ct, _callers) in raw.items():
+        if tt > 0:
+            walk(func, tt * 1e6, (func,), 0)
+    return counts
+
+
+class CallProfiler:
+    def __init__(self, every_n: int = 0):
+        """名前ごとの呼び出し回数を数え、every_n 回に 1 回だけ cProfile で計測する。
+
+        Args:
+            every_n: 計測する間隔 (0 以下で無効)
+        """
+        self.every_n = every_n
+        self._counters = collections.defaultdict(itertools.count)
+        # cProfile は同時に 1 つしか有効にできないので、計測中の呼び出しがあれば見送る
+        self._running = threading.Lock()
+
+    def call(self, name: str, fn, *args, **kwargs):
+        every_n = self.every_n
+        if every_n <= 0 or _out_dir is None:
+            return fn(*args, **kwargs)
+        n = next(self._counters[name]) + 1
+        if n % every_n or not self._running.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._dump(name, n, profile)
+        finally:
+            self._running.release()
+
+    def _dump(self, name, n, profile):
+        try:
+            path = _output_path(f"{name}-{n}", ".pstats")
+            profile.dump_stats(path)
+            stats = pstats.Stats(profile)
+            write_collapsed(path[: -len(".pstats")] + ".collapsed", pstats_to_collapsed(stats))
+        except OSError:
+            pass
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005):
+        """全スレッドのスタックを interval 秒ごとに採取して集計する。
+
+        Args:
+            interval: サンプリング間隔 (秒)
+        """
+        self.interval = interval
+        self._counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._counts = collections.Counter()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="eagle-stack-sampler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> Optional[str]:
+        """採取を止め、collapsed stack を書き出したファイルのパスを返します。"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return None
+        self._stop.set()
+        thread.join()
+        if not self._counts or _out_dir is None:
+            return None
+        path = _output_path("sampler", ".collapsed")
+        write_collapsed(path, self._counts)
+        return path
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                self._counts[";".join(reversed(stack))] += 1
+
+
+_call_profiler = CallProfiler()
+_sampler = StackSampler()
+_control_file = None
+_control_thread = None
+_requested = {"setting": False, "signal": False, "file": False}
+
+
+def configure(
+    out_dir: str,
+    every_n: int = 0,
+    sampler_interval: float = 0.005,
+    sampler_enabled: Optional[bool] = None,
+) -> None:
+    """出力先と計測間隔を設定します。
+
+    Args:
+        out_dir: .pstats / .collapsed の出力先
+        every_n: N 回に 1 回 cProfile で計測する (0 で無効)
+        sampler_interval: スタックサンプラーの間隔 (秒)
+        sampler_enabled: 設定によるサンプラーの ON/OFF (None なら変更しない)
+    """
+    global _out_dir
+    _out_dir = out_dir
+    _call_profiler.every_n = int(every_n)
+    _sampler.interval = sampler_interval
+    if sampler_enabled is not None:
+        _request("setting", bool(sampler_enabled))
+
+
+def profile_call(name: str, fn, *args, **kwargs):
+    """fn を呼び出します。N 回に 1 回は cProfile で計測して結果を書き出します。"""
+    return _call_profiler.call(name, fn, *args, **kwargs)
+
+
+def _request(source: str, enabled: bool) -> None:
+    # 設定・シグナル・制御ファイルのどれかが ON ならサンプラーを動かす
+    with _lock:
+        _requested[source] = enabled
+        want = any(_requested.values())
+    if want and not _sampler.running:
+        _sampler.start()
+    elif not want and _sampler.running:
+        _sampler.stop()
+
+
+def sampler_running() -> bool:
+    return _sampler.running
+
+
+def install_signal_handler(signum: Optional[int] = None) -> bool:
+    """シグナル (既定は SIGUSR2) を受けるたびにサンプラーを ON/OFF します。
+
+    Returns:
+        bool: 登録できたかどうか (Windows やメインスレッド以外では False)
+    """
+    signum = signum or getattr(signal, "SIGUSR2", None)
+    if signum is None:
+        return False
+
+    def _toggle(_signum, _frame):
+        # シグナルハンドラ内でスレッドを join しないよう別スレッドで切り替える
+        threading.Thread(
+            target=_request, args=("signal", not _requested["signal"]), daemon=True
+        ).start()
+
+    try:
+        signal.signal(signum, _toggle)
+    except ValueError:
+        return False
+    return True
+
+
+def watch_control_file(path: str, poll_interval: float = 1.0) -> None:
+    """path が存在する間だけサンプラーを動かします (消すと停止して結果を書き出す)。"""
+    global _control_file, _control_thread
+    _control_file = path
+    if _control_thread is not None:
+        return
+
+    def _poll():
+        while True:
+            _request("file", bool(_control_file) and os.path.exists(_control_file))
+            time.sleep(poll_interval)
+
+    _control_thread = threading.Thread(
+        target=_poll, name="eagle-profiler-control", daemon=True
+    )
+    _control_thread.start()
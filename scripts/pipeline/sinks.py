@@ -0,0 +1,467 @@
+# Image sinks and concurrent per-image dispatch
+#
+# 送信先 (Eagle / Google Drive API / マウント済みDrive / ローカルアーカイブ) を共通の
+# Sink インターフェースで扱う。設定で有効になっている送信先へ画像ごとに並行して
+# ディスパッチし、送信先ごとに専用のワーカープールを持たせて障害を分離する。
+# 1枚あたりの待ち時間は全送信先の合計ではなく、最も遅い送信先の時間になる。
+# Drive 系の送信先は画像を無圧縮 tar にまとめて送ることもできる (bundles.BundleWriter)。
+#
+import atexit
+import concurrent.futures
+import io
+import os
+import shutil
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Protocol
+
+from scripts.pipeline import log, startup, tracing
+from scripts.pipeline.bundles import BundleLimits, BundleWriter
+from scripts.pipeline.encoder import ImageEncoder
+from scripts.pipeline.payload import ImagePayload
+from scripts.pipeline.staging import StagedSyncer
+
+# 送信先のバックエンドは、その送信先が初めて使われた時点で読み込む
+api_item = startup.LazyModule("scripts.eagleapi.api_item", "eagle")
+# Paperspace Gradient環境用: Google Drive API
+service_account = startup.LazyModule("google.oauth2.service_account", "drive_api")
+discovery = startup.LazyModule("googleapiclient.discovery", "drive_api")
+googleapiclient_http = startup.LazyModule("googleapiclient.http", "drive_api")
+
+logger = log.get_logger("sinks")
+
+
+class ImageJob:
+    def __init__(
+        self,
+        payload: ImagePayload,
+        filename: str,
+        fullfn: str,
+        annotation: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        date_str: Optional[str] = None,
+        route: Optional[Dict[str, object]] = None,
+    ):
+        """1枚の画像について各送信先へ渡す情報。
+
+        Args:
+            payload: 画像データ (エンコード済みバイト列を共有)
+            filename: ファイル名
+            fullfn: webuiが保存した画像のフルパス
+            annotation: アノテーション
+            tags: タグのリスト
+            date_str: 日付フォルダ名 (省略時は現在の日付)
+            route: 振り分け用の情報 (seed / prompt / model)
+        """
+        self.payload = payload
+        self.filename = filename
+        self.fullfn = fullfn
+        self.annotation = annotation
+        self.tags = tags or []
+        self.date_str = date_str or datetime.now().strftime("%Y-%m-%d")
+        self.route = route or {}
+
+
+class Sink(Protocol):
+    """送信先のインターフェース。send は送信先専用のワーカースレッドで呼ばれる"""
+
+    name: str
+    workers: int
+
+    def send(self, job: ImageJob) -> None:
+        ...
+
+
+def archive_filename(filename: str, ext: str) -> str:
+    """出力形式に合わせてファイル名の拡張子を付け替えます。"""
+    base, old_ext = os.path.splitext(filename)
+    return filename if old_ext.lower() == ext else base + ext
+
+
+_recovered_bundle_dirs = set()
+_recovered_bundle_dirs_lock = threading.Lock()
+
+
+def open_bundler(
+    sink, bundle_dir: str, limits: Optional[BundleLimits] = None
+) -> BundleWriter:
+    """sink.deliver_bundle へ届けるアーカイブの書き手を作り、前回の残りを送り直します。"""
+    work_dir = os.path.join(bundle_dir, sink.name)
+    bundler = BundleWriter(work_dir, sink.deliver_bundle, limits)
+    # 閉じていないアーカイブは終了時に閉じて送り切る
+    atexit.register(bundler.flush, 60)
+    # 前回の残りを拾うのはプロセスで最初の 1 回だけ (設定を変えて作り直した送信先が、
+    # 古い送信先の書き込み中のアーカイブに触らないように)
+    with _recovered_bundle_dirs_lock:
+        first = work_dir not in _recovered_bundle_dirs
+        _recovered_bundle_dirs.add(work_dir)
+    recovered = bundler.recover() if first else 0
+    if recovered:
+        logger.info("%s: 未送信のアーカイブを送ります: %d件", sink.name, recovered)
+    return bundler
+
+
+def add_to_bundle(bundler: BundleWriter, job: ImageJob, encoder) -> str:
+    encoded = job.payload.encoded(encoder)
+    width, height = getattr(job.payload.image, "size", (None, None))
+    return bundler.add(
+        job.date_str,
+        archive_filename(job.filename, encoded.ext),
+        encoded.data,
+        annotation=job.annotation,
+        tags=job.tags,
+        width=width,
+        height=height,
+    )
+
+
+# -----------------------------------------------------------------------------
+# Eagle
+# -----------------------------------------------------------------------------
+class EagleSink:
+    name = "eagle"
+    workers = 2
+
+    def __init__(self, get_outbox: Callable, route: Callable):
+        """
+        Args:
+            get_outbox: 送信アウトボックス (または中継デーモンのクライアント) を返す関数
+            route: ImageJob.route (seed / prompt / model) から EagleShard を返す関数
+        """
+        self.get_outbox = get_outbox
+        self.route = route
+
+    def send(self, job: ImageJob) -> None:
+        shard = self.route(**job.route)
+        item = api_item.EAGLE_ITEM_PATH(
+            filefullpath=job.fullfn,
+            filename=job.filename,
+            annotation=job.annotation,
+            tags=job.tags,
+        )
+        if self.get_outbox().enqueue(
+            item, job.date_str, server_url=shard.server_url, port=shard.port
+        ):
+            logger.info("Eagle送信キューに追加: %s -> %s", job.fullfn, shard.name)
+        else:
+            logger.debug("Eagle送信キューに登録済み: %s", job.fullfn)
+
+
+# -----------------------------------------------------------------------------
+# Google Drive API (Paperspace Gradient)
+# -----------------------------------------------------------------------------
+class DriveApiSink:
+    name = "drive_api"
+    workers = 4
+
+    def __init__(
+        self,
+        credentials_file: str,
+        main_folder_id: str,
+        encoder: Optional[ImageEncoder] = None,
+        bundle_dir: Optional[str] = None,
+        bundle_limits: Optional[BundleLimits] = None,
+    ):
+        """
+        Args:
+            credentials_file: サービスアカウントのJSONファイル
+            main_folder_id: 日付フォルダを作る親フォルダのID
+            encoder: アップロードする画像のエンコード設定
+            bundle_dir: 指定すると画像を 1 枚ずつアップロードせず、このローカルディレクトリで
+                tar にまとめてから 1 ファイルとしてアップロードする
+            bundle_limits: アーカイブを閉じる条件 (件数・サイズ・時間)
+        """
+        self.credentials_file = credentials_file
+        self.main_folder_id = main_folder_id
+        self.encoder = encoder
+        self._local = threading.local()
+        self._folder_lock = threading.Lock()
+        self._date_folders = {}  # {date_str: folderId}
+        self.bundler = (
+            open_bundler(self, bundle_dir, bundle_limits) if bundle_dir else None
+        )
+
+    def _service(self):
+        # googleapiclient の service はスレッドセーフではないのでスレッドごとに作る
+        service = getattr(self._local, "service", None)
+        if service is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                self.credentials_file,
+                scopes=["https://www.googleapis.com/auth/drive"],
+            )
+            service = discovery.build("drive", "v3", credentials=credentials)
+            self._local.service = service
+        return service
+
+    def date_folder_id(self, date_str: str) -> str:
+        """日付フォルダのIDを返します (無ければ作成)。結果はキャッシュします。"""
+        with self._folder_lock:
+            folder_id = self._date_folders.get(date_str)
+            if folder_id:
+                return folder_id
+            drive_service = self._service()
+            query = f"name='{date_str}' and mimeType='application/vnd.google-apps.folder' and '{self.main_folder_id}' in parents and trashed=false"
+            response = (
+                drive_service.files()
+                .list(q=query, spaces="drive", fields="files(id, name)")
+                .execute()
+            )
+            files = response.get("files", [])
+            if files:
+                folder_id = files[0]["id"]
+                logger.info("既存の日付フォルダが見つかりました: %s", date_str)
+            else:
+                folder_metadata = {
+                    "name": date_str,
+                    "mimeType": "application/vnd.google-apps.folder",
+                    "parents": [self.main_folder_id],
+                }
+                folder = (
+                    drive_service.files()
+                    .create(body=folder_metadata, fields="id")
+                    .execute()
+                )
+                folder_id = folder.get("id")
+                logger.info("日付フォルダを作成しました: %s", date_str)
+            self._date_folders[date_str] = folder_id
+            return folder_id
+
+    def prewarm(self, date_str: str) -> bool:
+        """日付フォルダを先に用意します (prewarm.PrewarmScheduler から呼ばれる)。"""
+        return bool(self.date_folder_id(date_str))
+
+    def deliver_bundle(self, path: str, date_str: str) -> None:
+        """閉じたアーカイブを日付フォルダへアップロードします (BundleWriter から呼ばれる)。"""
+        date_folder_id = self.date_folder_id(date_str)
+        media = googleapiclient_http.MediaFileUpload(
+            path, mimetype="application/x-tar", chunksize=16 * 1024 * 1024, resumable=True
+        )
+        try:
+            file = (
+                self._service()
+                .files()
+                .create(
+                    body={"name": os.path.basename(path), "parents": [date_folder_id]},
+                    media_body=media,
+                    fields="id",
+                )
+                .execute()
+            )
+        finally:
+            media.stream().close()
+        logger.info(
+            "Google Driveにアーカイブをアップロード完了 (ID): %s", file.get("id")
+        )
+
+    def send(self, job: ImageJob) -> None:
+        if self.bundler is not None:
+            add_to_bundle(self.bundler, job, self.encoder)
+            return
+        date_folder_id = self.date_folder_id(job.date_str)
+        encoded = job.payload.encoded(self.encoder)
+        stream = io.BytesIO(encoded.data)
+        try:
+            file_metadata = {
+                "name": archive_filename(job.filename, encoded.ext),
+                "parents": [date_folder_id],
+            }
+            media = googleapiclient_http.MediaIoBaseUpload(
+                stream, mimetype=encoded.mimetype
+            )
+            file = (
+                self._service()
+                .files()
+                .create(body=file_metadata, media_body=media, fields="id")
+                .execute()
+            )
+            logger.info("Google Driveにアップロード完了 (ID): %s", file.get("id"))
+        finally:
+            stream.close()
+
+
+# -----------------------------------------------------------------------------
+# マウント済みDrive (Google Colab) / ローカルアーカイブ
+# -----------------------------------------------------------------------------
+class DirectorySink:
+    name = "directory"
+    workers = 2
+
+    def __init__(self, root: str, encoder: Optional[ImageEncoder] = None):
+        """root/<日付>/<ファイル名> に画像を書き出す送信先。
+
+        Args:
+            root: 保存先のルートディレクトリ
+            encoder: 書き出す画像のエンコード設定
+        """
+        self.root = root
+        self.encoder = encoder
+        self._dirs_lock = threading.Lock()
+        self._known_dirs = set()
+
+    def date_dir(self, date_str: str) -> str:
+        path = os.path.join(self.root, date_str)
+        with self._dirs_lock:
+            if path not in self._known_dirs:
+                if not os.path.exists(path):
+                    os.makedirs(path, exist_ok=True)
+                    logger.info("日付フォルダを作成しました: %s", path)
+                self._known_dirs.add(path)
+        return path
+
+    def prewarm(self, date_str: str) -> bool:
+        """日付フォルダを先に用意します (prewarm.PrewarmScheduler から呼ばれる)。"""
+        return os.path.isdir(self.date_dir(date_str))
+
+    def send(self, job: ImageJob) -> None:
+        encoded = job.payload.encoded(self.encoder)
+        destination_path = os.path.join(
+            self.date_dir(job.date_str), archive_filename(job.filename, encoded.ext)
+        )
+        with open(destination_path, "wb") as f:
+            f.write(encoded.data)
+        logger.info("%s: 保存しました: %s", self.name, destination_path)
+
+
+class MountedDriveSink(DirectorySink):
+    name = "mounted_drive"
+
+    def __init__(
+        self,
+        root: str,
+        encoder: Optional[ImageEncoder] = None,
+        staging_dir: Optional[str] = None,
+        bundle_dir: Optional[str] = None,
+        bundle_limits: Optional[BundleLimits] = None,
+    ):
+        """マウント済みDrive の root/<日付>/ に画像を書き出す送信先。
+
+        Args:
+            root: マウント済みDrive 上の保存先
+            encoder: 書き出す画像のエンコード設定
+            staging_dir: 指定するとまずこのローカルディレクトリに書き、
+                バックグラウンドでまとめて root へ同期する (生成スレッドが FUSE の書き込みを待たない)
+            bundle_dir: 指定すると画像をこのローカルディレクトリで tar にまとめ、
+                1 ファイルとして root/<日付>/ へ書き出す (staging_dir があればそちらを経由する)
+            bundle_limits: アーカイブを閉じる条件 (件数・サイズ・時間)
+        """
+        super().__init__(root, encoder)
+        self.syncer = None
+        if staging_dir:
+            self.syncer = StagedSyncer(staging_dir, root)
+            # Colab のローカルディスクはランタイムと共に消えるので、終了時に同期し切る
+            atexit.register(self.syncer.flush, 60)
+            recovered = self.syncer.recover()
+            if recovered:
+                logger.info("%s: 未同期のファイルを同期します: %d件", self.name, recovered)
+        # atexit は登録の逆順に呼ばれるので、アーカイブを閉じてから同期し切る
+        self.bundler = (
+            open_bundler(self, bundle_dir, bundle_limits) if bundle_dir else None
+        )
+
+    def prewarm(self, date_str: str) -> bool:
+        if self.syncer is None:
+            return super().prewarm(date_str)
+        self.syncer.staging_dir(date_str)
+        return os.path.isdir(self.syncer.dest_dir(date_str))
+
+    def deliver_bundle(self, path: str, date_str: str) -> None:
+        """閉じたアーカイブを root/<日付>/ へ移します (BundleWriter から呼ばれる)。"""
+        name = os.path.basename(path)
+        if self.syncer is not None:
+            shutil.move(path, os.path.join(self.syncer.staging_dir(date_str), name))
+            self.syncer.enqueue(date_str, name)
+            return
+        dest = os.path.join(self.date_dir(date_str), name)
+        # 監視スクリプトが書き込み途中のアーカイブを拾わないよう、一時名で書いてから rename
+        tmp = dest + ".part"
+        try:
+            shutil.copyfile(path, tmp)
+            if os.path.getsize(tmp) != os.path.getsize(path):
+                raise OSError(f"サイズが一致しません: {tmp}")
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        logger.info("%s: アーカイブを保存しました: %s", self.name, dest)
+
+    def send(self, job: ImageJob) -> None:
+        if self.bundler is not None:
+            staged_path = add_to_bundle(self.bundler, job, self.encoder)
+            logger.debug("%s: アーカイブに追加しました: %s", self.name, staged_path)
+            return
+        if self.syncer is None:
+            return super().send(job)
+        encoded = job.payload.encoded(self.encoder)
+        staged_path = self.syncer.write(
+            job.date_str, archive_filename(job.filename, encoded.ext), encoded.data
+        )
+        logger.info("%s: 同期待ちに追加しました: %s", self.name, staged_path)
+
+
+class LocalArchiveSink(DirectorySink):
+    name = "local_archive"
+
+
+# -----------------------------------------------------------------------------
+# ディスパッチ
+# -----------------------------------------------------------------------------
+class SinkDispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executors = {}  # {sink.name: ThreadPoolExecutor}
+        self._first_calls = startup.FirstCallTimer()
+
+    def _executor(self, sink: Sink) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            executor = self._executors.get(sink.name)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=getattr(sink, "workers", 1) or 1,
+                    thread_name_prefix=f"eagle-sink-{sink.name}",
+                )
+                self._executors[sink.name] = executor
+            return executor
+
+    def dispatch(
+        self, job: ImageJob, sinks: List[Sink], wait: bool = True
+    ) -> Dict[str, concurrent.futures.Future]:
+        """全送信先へ並行して送信します。
+
+        Args:
+            job: 送信する画像
+            sinks: 送信先のリスト
+            wait: True なら全送信先の完了 (= 最も遅い送信先) まで待つ
+
+        Returns:
+            {送信先名: Future}
+        """
+        trace = tracing.current()
+        futures = {
+            sink.name: self._executor(sink).submit(self._send, sink, job, trace)
+            for sink in sinks
+        }
+        if wait and futures:
+            concurrent.futures.wait(futures.values())
+        return futures
+
+    def _send(
+        self, sink: Sink, job: ImageJob, trace: Optional[tracing.Trace] = None
+    ) -> bool:
+        # 送信先ごとに例外を閉じ込め、他の送信先には影響させない
+        try:
+            with tracing.activate(trace), tracing.span(f"upload:{sink.name}"):
+                self._first_calls.measure(sink.name, sink.send, job)
+            return True
+        except Exception as e:
+            logger.error("%s: 送信に失敗しました: %s: %s", sink.name, job.filename, e)
+            return False
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for executor in executors:
+            executor.shutdown(wait=wait)
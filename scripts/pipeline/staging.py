@@ -0,0 +1,278 @@
+# Local staging and background sync to a slow mounted directory
+#
+# Colab の Drive (FUSE マウント) への書き込みは遅く、1枚ごとに生成スレッドを止めてしまう。
+# 画像はまず速いローカルディスクの staging_root/<日付>/ に書き、バックグラウンドの
+# StagedSyncer がまとめてマウント先 dest_root/<日付>/ へ移す。
+# - 書き込み途中のファイルは ".part" で書いてから rename するので、同期対象は完成品だけ
+# - 同期は最大 batch_size 件ずつ、workers 本の並列度でコピーする
+# - 日付フォルダの存在はキャッシュし、マウント先への exists / makedirs は日付ごとに 1 回
+# - コピー先は一時名で書き、サイズを確認してから rename。確認できたらステージング側を消す
+# - 失敗したファイルはステージングに残し、間隔を空けて再試行する。
+#   起動時には前回の残り (同期されなかったファイル) も拾う
+# - 終了時の flush はスレッドプールを使わず (atexit では submit できない)、呼び出し元でコピーする
+#
+import concurrent.futures
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from scripts.pipeline import log
+
+logger = log.get_logger("staging")
+
+PART_SUFFIX = ".part"
+SYNCING_PREFIX = ".syncing-"
+
+
+class StagedSyncer:
+    def __init__(
+        self,
+        staging_root: str,
+        dest_root: str,
+        workers: int = 4,
+        batch_size: int = 32,
+        interval: float = 2.0,
+        retry_interval: float = 30.0,
+    ):
+        """
+        Args:
+            staging_root: 一時的に書き込むローカルディレクトリ
+            dest_root: 同期先 (マウント済みDrive など)
+            workers: 同時にコピーするファイル数
+            batch_size: 1回の同期でまとめて移す最大件数
+            interval: 新しいファイルが無くても同期を確認する間隔 (秒)
+            retry_interval: 失敗したファイルを再試行するまでの時間 (秒)
+        """
+        self.staging_root = staging_root
+        self.dest_root = dest_root
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Condition(self._lock)
+        self._pending: Dict[Tuple[str, str], float] = {}  # {(日付, ファイル名): 次に試す時刻}
+        self._in_flight = 0
+        self._dest_dirs = set()
+        self._dest_dirs_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    # --- ステージングへの書き込み -------------------------------------------
+    def staging_dir(self, date_str: str) -> str:
+        path = os.path.join(self.staging_root, date_str)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write(self, date_str: str, filename: str, data: bytes) -> str:
+        """ローカルに書き込んで同期待ちに加え、ステージング上のパスを返します。"""
+        path = os.path.join(self.staging_dir(date_str), filename)
+        part = path + PART_SUFFIX
+        with open(part, "wb") as f:
+            f.write(data)
+        os.replace(part, path)
+        self.enqueue(date_str, filename)
+        return path
+
+    def enqueue(self, date_str: str, filename: str) -> None:
+        with self._lock:
+            self._pending.setdefault((date_str, filename), 0.0)
+        try:
+            self.start()
+        except RuntimeError as e:
+            # 終了処理中 (atexit) はスレッドを起動できない。同期は flush が呼び出し元で行う
+            logger.debug("同期スレッドを起動できません: %s", e)
+        self._wakeup.set()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending) + self._in_flight
+
+    # --- 同期先 ----------------------------------------------------------------
+    def dest_dir(self, date_str: str) -> str:
+        path = os.path.join(self.dest_root, date_str)
+        with self._dest_dirs_lock:
+            if path not in self._dest_dirs:
+                if not os.path.isdir(path):
+                    os.makedirs(path, exist_ok=True)
+                    logger.info("日付フォルダを作成しました: %s", path)
+                self._dest_dirs.add(path)
+        return path
+
+    def _sync_one(self, date_str: str, filename: str) -> None:
+        src = os.path.join(self.staging_root, date_str, filename)
+        dest_dir = self.dest_dir(date_str)
+        dest = os.path.join(dest_dir, filename)
+        tmp = os.path.join(dest_dir, SYNCING_PREFIX + filename)
+        size = os.path.getsize(src)
+        try:
+            shutil.copyfile(src, tmp)
+            copied = os.path.getsize(tmp)
+            if copied != size:
+                raise OSError(f"サイズが一致しません ({copied} != {size})")
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        os.remove(src)
+
+    # --- バックグラウンド同期 --------------------------------------------------
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="eagle-staging-sync"
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="eagle-staging-syncer", daemon=True
+            )
+            self._thread.start()
+
+    def recover(self) -> int:
+        """前回同期されずに残ったファイルを同期待ちに戻し、その件数を返します。"""
+        found = 0
+        if not os.path.isdir(self.staging_root):
+            return 0
+        for date_str in sorted(os.listdir(self.staging_root)):
+            date_dir = os.path.join(self.staging_root, date_str)
+            if not os.path.isdir(date_dir):
+                continue
+            for filename in os.listdir(date_dir):
+                if filename.endswith(PART_SUFFIX):
+                    continue  # 書き込み途中で終了したもの
+                with self._lock:
+                    self._pending.setdefault((date_str, filename), 0.0)
+                found += 1
+        if found:
+            self.start()
+            self._wakeup.set()
+        return found
+
+    def _take_batch(self) -> List[Tuple[str, str]]:
+        now = time.time()
+        with self._lock:
+            due = [k for k, at in self._pending.items() if at <= now]
+            due.sort()
+            batch = due[: self.batch_size]
+            for key in batch:
+                del self._pending[key]
+            self._in_flight += len(batch)
+            return batch
+
+    def _release(self, batch: List[Tuple[str, str]], left) -> None:
+        """_take_batch で取り出したバッチを返却します。left (試せなかったもの) は同期待ちに戻す"""
+        with self._lock:
+            for key in left:
+                self._pending.setdefault(key, time.time() + self.retry_interval)
+            self._in_flight -= len(batch)
+            self._idle.notify_all()
+
+    def _finish(self, key: Tuple[str, str], error: Optional[BaseException]) -> bool:
+        """1 件の同期結果を反映し、成功なら True を返します。"""
+        if error is None:
+            return True
+        if not os.path.exists(os.path.join(self.staging_root, *key)):
+            return False  # ステージング側が消えている (手動で移した場合など)
+        logger.warning("同期に失敗しました (後で再試行): %s: %s", key[1], error)
+        # マウントし直しなどで日付フォルダが消えていることもあるので確認し直す
+        with self._dest_dirs_lock:
+            self._dest_dirs.discard(os.path.join(self.dest_root, key[0]))
+        with self._lock:
+            self._pending[key] = time.time() + self.retry_interval
+        return False
+
+    def sync_once(self) -> int:
+        """期限の来たファイルを 1 バッチ同期し、成功件数を返します。"""
+        batch = self._take_batch()
+        if not batch:
+            return 0
+        left = set(batch)
+        done = 0
+        try:
+            futures = {}
+            try:
+                for key in batch:
+                    futures[self._pool.submit(self._sync_one, *key)] = key
+            finally:
+                # submit できた分は結果を待つ (終了処理中やプールの停止後は submit が失敗する)
+                for fut in concurrent.futures.as_completed(futures):
+                    key = futures[fut]
+                    left.discard(key)
+                    if self._finish(key, fut.exception()):
+                        done += 1
+        finally:
+            self._release(batch, left)
+        if done:
+            logger.debug("%d 件を %s へ同期しました", done, self.dest_root)
+        return done
+
+    def _seconds_until_next(self) -> float:
+        with self._lock:
+            if not self._pending:
+                return self.interval
+            next_at = min(self._pending.values())
+        return min(max(next_at - time.time(), 0.0), self.interval)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                if self.sync_once():
+                    continue
+            except Exception as e:
+                logger.error("ステージングの同期でエラー: %s", e)
+            self._wakeup.wait(max(self._seconds_until_next(), 0.05))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """同期待ちが無くなるまで、呼び出したスレッドで同期します。
+
+        終了時 (atexit) はスレッドプールに submit できないので、プールを使わずにコピーする。
+        再試行待ちのファイルも 1 回はすぐに試し、それでも失敗したものは待ちません。
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            for key in self._pending:
+                self._pending[key] = 0.0
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                break
+            left = set(batch)
+            try:
+                for key in batch:
+                    if deadline is not None and time.time() >= deadline:
+                        return False
+                    left.discard(key)
+                    try:
+                        self._sync_one(*key)
+                        error = None
+                    except Exception as e:
+                        error = e
+                    self._finish(key, error)
+            finally:
+                self._release(batch, left)
+        # バックグラウンドで同期中のものが終わるのを待つ
+        with self._lock:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(0.1 if remaining is None else min(remaining, 0.1))
+        return True
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
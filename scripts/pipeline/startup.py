@@ -0,0 +1,116 @@
+# Lazy backend loading and startup-time accounting
+#
+# requests / eagleapi / Google Drive API などのバックエンドは、その送信先が
+# 有効になって初めて使われた時点で読み込む。読み込み時間と初回呼び出しの時間を
+# バックエンドごとに記録し、拡張機能の起動時間を予算と比べて報告する。
+#
+import importlib
+import os
+import threading
+import time
+from typing import Dict
+
+from scripts.pipeline import log
+
+logger = log.get_logger("startup")
+
+# 拡張機能本体の import に許す時間 (ms)。環境変数で上書きできる
+STARTUP_BUDGET_MS = float(os.environ.get("EAGLE_PNGINFO_STARTUP_BUDGET_MS", "150"))
+
+_lock = threading.Lock()
+_timings = {}  # {backend: {"import": sec, "first_call": sec}}
+
+
+def record(backend: str, kind: str, seconds: float) -> None:
+    """backend の kind ("import" / "first_call") の所要時間を加算記録します。"""
+    with _lock:
+        entry = _timings.setdefault(backend, {})
+        entry[kind] = entry.get(kind, 0.0) + seconds
+
+
+def timings() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        return {k: dict(v) for k, v in _timings.items()}
+
+
+class LazyModule:
+    def __init__(self, name: str, backend: str):
+        """属性に初めてアクセスした時点で import されるモジュールの代理オブジェクト。
+
+        Args:
+            name: モジュール名 (例: "scripts.eagleapi.api_folder")
+            backend: 計測をまとめるバックエンド名 (例: "eagle")
+        """
+        self.__dict__["_name"] = name
+        self.__dict__["_backend"] = backend
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is not None:
+            return module
+        with self.__dict__["_lock"]:
+            module = self.__dict__["_module"]
+            if module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                record(self._backend, "import", time.perf_counter() - start)
+                self.__dict__["_module"] = module
+        return module
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.__dict__["_module"] is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+class FirstCallTimer:
+    def __init__(self):
+        """送信先ごとに初回呼び出しの所要時間だけを記録する"""
+        self._lock = threading.Lock()
+        self._seen = set()
+
+    def measure(self, backend: str, fn, *args, **kwargs):
+        with self._lock:
+            first = backend not in self._seen
+            self._seen.add(backend)
+        if not first:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            record(backend, "first_call", elapsed)
+            logger.info("startup: '%s' 初回呼び出し %.1f ms", backend, elapsed * 1000)
+
+
+def format_report() -> str:
+    """バックエンドごとの import / 初回呼び出し時間の一覧を文字列で返します。"""
+    lines = ["Eagle Pnginfo startup report:"]
+    for backend, entry in sorted(timings().items()):
+        parts = [f"{kind}={sec * 1000:.1f}ms" for kind, sec in sorted(entry.items())]
+        lines.append(f"  {backend}: {', '.join(parts)}")
+    return "\n".join(lines)
+
+
+def check_budget(backend: str = "extension") -> bool:
+    """backend の import 時間が STARTUP_BUDGET_MS 以内なら True (超過時は警告を出す)。"""
+    spent_ms = timings().get(backend, {}).get("import", 0.0) * 1000
+    if spent_ms > STARTUP_BUDGET_MS:
+        logger.warning(
+            f"startup: '{backend}' の読み込みに {spent_ms:.1f} ms かかりました"
+            f" (予算 {STARTUP_BUDGET_MS:.0f} ms)"
+        )
+        return False
+    return True
@@ -0,0 +1,288 @@
+# Per-image trace timeline
+#
+# 1枚の画像 (または監視スクリプトの1ファイル) の処理を trace とし、抽出・タグ生成・
+# 画像読み込み・メタデータ作成・HTTP 呼び出し・アップロードなどの各段階を span として記録する。
+# 記録はサンプリング率に従って一部の trace だけ行い、終了時にファイルへ書き出す。
+# - jsonl  : 1 trace = 1 行の JSON (ローテーションあり)
+# - chrome : Chrome trace-event 形式 (chrome://tracing / Perfetto でそのまま開ける)
+#
+# 現在の trace は contextvars で持つので、別スレッドで続きを記録する場合は activate() で渡す。
+#
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+FORMAT_JSONL = "jsonl"
+FORMAT_CHROME = "chrome"
+FORMATS = [FORMAT_JSONL, FORMAT_CHROME]
+
+# perf_counter を壁時計 (epoch 秒) に変換するためのオフセット
+_EPOCH_OFFSET = time.time() - time.perf_counter()
+_PID = os.getpid()
+_ids = itertools.count(1)
+
+_current = contextvars.ContextVar("eagle_pnginfo_trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str, args: Optional[dict] = None):
+        """1件の処理の記録。span はどのスレッドからでも追加できる。
+
+        Args:
+            name: trace 名 (例: "on_image_saved")
+            args: trace 全体に付ける情報 (ファイル名など)
+        """
+        self.trace_id = f"{_PID:x}-{next(_ids):x}"
+        self.name = name
+        self.args = dict(args or {})
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []  # [(name, start, end, thread_id, thread_name, args)]
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end, args=None):
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append((name, start, end, thread.ident, thread.name, args or {}))
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        """with ブロックの所要時間を span として記録します。yield する辞書に args を追加できます。"""
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time.perf_counter(), args)
+
+    def to_dict(self) -> dict:
+        """jsonl 形式の 1 行分 (時刻は trace 開始からのミリ秒)"""
+        end = self.end if self.end is not None else time.perf_counter()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s[1])
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "ts": self.start + _EPOCH_OFFSET,
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "args": self.args,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round((s - self.start) * 1000, 3),
+                    "duration_ms": round((e - s) * 1000, 3),
+                    "thread": tname,
+                    "args": sargs,
+                }
+                for name, s, e, _tid, tname, sargs in spans
+            ],
+        }
+
+    def to_chrome_events(self) -> list:
+        """Chrome trace-event 形式の complete event ("ph": "X") のリスト"""
+        end = self.end if self.end is not None else time.perf_counter()
+        main_tid = None
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for name, s, e, tid, _tname, sargs in spans:
+            main_tid = main_tid or tid
+            events.append(_chrome_event(name, s, e, tid, dict(sargs, trace_id=self.trace_id)))
+        events.insert(
+            0,
+            _chrome_event(
+                self.name,
+                self.start,
+                end,
+                main_tid or threading.get_ident(),
+                dict(self.args, trace_id=self.trace_id),
+            ),
+        )
+        return events
+
+
+def _chrome_event(name, start, end, tid, args):
+    return {
+        "name": name,
+        "cat": "eagle_pnginfo",
+        "ph": "X",
+        "ts": round((start + _EPOCH_OFFSET) * 1e6, 1),
+        "dur": round((end - start) * 1e6, 1),
+        "pid": _PID,
+        "tid": tid,
+        "args": args,
+    }
+
+
+class TraceWriter:
+    def __init__(
+        self,
+        path: str,
+        fmt: str = FORMAT_JSONL,
+        max_bytes: int = 20 * 1024 * 1024,
+        backup_count: int = 5,
+    ):
+        """trace をファイルへ追記する。max_bytes を超えたら path.1, path.2 ... へずらす。
+
+        Args:
+            path: 出力ファイル
+            fmt: jsonl / chrome
+            max_bytes: ローテーションするサイズ (0 でローテーションしない)
+            backup_count: 残す古いファイルの数
+        """
+        self.path = path
+        self.fmt = fmt if fmt in FORMATS else FORMAT_JSONL
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            # Chrome の JSON Array 形式は閉じ括弧を省略できるので、先頭に "[" だけ書いて追記していく
+            if self.fmt == FORMAT_CHROME and self._file.tell() == 0:
+                self._file.write("[\n")
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, trace: Trace) -> None:
+        if self.fmt == FORMAT_CHROME:
+            text = "".join(
+                json.dumps(ev, ensure_ascii=False) + ",\n"
+                for ev in trace.to_chrome_events()
+            )
+        else:
+            text = json.dumps(trace.to_dict(), ensure_ascii=False) + "\n"
+        with self._lock:
+            f = self._open()
+            f.write(text)
+            f.flush()
+            if self.max_bytes and f.tell() >= self.max_bytes:
+                self._rotate()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_lock = threading.Lock()
+_writer = None
+_sample_rate = 0.0
+
+
+def configure(
+    path: Optional[str],
+    fmt: str = FORMAT_JSONL,
+    sample_rate: float = 0.0,
+    max_bytes: int = 20 * 1024 * 1024,
+    backup_count: int = 5,
+) -> None:
+    """トレースの出力先とサンプリング率を設定します。sample_rate が 0 または path が空なら無効です。
+
+    Args:
+        path: 出力ファイル
+        fmt: jsonl / chrome
+        sample_rate: trace を記録する割合 (0.0 - 1.0)
+        max_bytes: ローテーションするサイズ
+        backup_count: 残す古いファイルの数
+    """
+    global _writer, _sample_rate
+    with _lock:
+        old = _writer
+        if (
+            old is None
+            or old.path != path
+            or old.fmt != fmt
+            or old.max_bytes != max_bytes
+            or old.backup_count != backup_count
+        ):
+            _writer = TraceWriter(path, fmt, max_bytes, backup_count) if path else None
+            if old is not None:
+                old.close()
+        _sample_rate = min(max(float(sample_rate), 0.0), 1.0) if path else 0.0
+
+
+def is_enabled() -> bool:
+    return _sample_rate > 0.0
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def trace(name: str, **args):
+    """サンプリングに当たれば新しい trace を開始して現在の trace にし、終了時に書き出します。
+
+    外れた場合は None を yield し、その中の span() は何もしません。
+    """
+    if _sample_rate <= 0.0 or random.random() >= _sample_rate:
+        token = _current.set(None)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+    t = Trace(name, args)
+    token = _current.set(t)
+    try:
+        yield t
+    except BaseException as e:
+        t.args["error"] = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        t.end = time.perf_counter()
+        writer = _writer
+        if writer is not None:
+            try:
+                writer.write(t)
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def span(name: str, **args):
+    """現在の trace に span を記録します (trace が無ければ何もしません)。
+
+    yield される辞書に status などを追加すると span の args として記録されます。
+    """
+    t = _current.get()
+    if t is None:
+        yield args
+        return
+    with t.span(name, **args) as span_args:
+        yield span_args
+
+
+@contextlib.contextmanager
+def activate(t: Optional[Trace]):
+    """別スレッドで t を現在の trace にします (ワーカースレッドへ trace を引き継ぐ)。"""
+    token = _current.set(t)
+    try:
+        yield t
+    finally:
+        _current.reset(token)
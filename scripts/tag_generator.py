@@ -1,9 +1,12 @@
 from modules import shared
 
+from scripts.pipeline.geninfo import param_tags, parse_parameters
+
 
 class TagGenerator():
     # @seealso modules.images FilenameGenerator replacements
     # @seealso modules.processing create_infotext generation_params
+    # @seealso scripts.pipeline.geninfo PARAM_TAG_KEYS (keep the keys in sync)
     replacements ={
         "Steps": lambda self: self.p.steps,
         "Sampler": lambda self: self.p.sampler_name,
@@ -30,19 +33,9 @@ class TagGenerator():
         self.image = image
 
     def generate_from_geninfo(self, tags_to_eagle, geninfo):
-        geninfo = geninfo.split("\n")
-        if len(geninfo) == 3:
-            geninfo = geninfo[2]
-        else:
-            return []
-        # generate lists from geninfo. i.e) "Steps: 30, CFG scale: 7.5" -> ["Steps: 30", "CFG scale: 7.5"]
-        geninfo_params = [ x.strip() for x in geninfo.split(",") if x.strip() != "" ]
-        geninfo_dict = {}  # {"Steps": "30", "CFG scale": "7.5"}
-        for item in geninfo_params:
-            geninfo_dict.update({item.split(":")[0]: item.split(":")[1].strip()})
-        tag_list = [ x.strip() for x in tags_to_eagle.split(",") if x.strip() != "" ]
-        _tags = [ f"{x}: {geninfo_dict.get(x)}" for x in geninfo_dict.keys() if x in tag_list ]
-        return _tags
+        # same rules as the backfill command (scripts.pipeline.geninfo.param_tags)
+        _positive, _negative, params = parse_parameters(geninfo)
+        return param_tags(tags_to_eagle, params)
 
     def generate_from_p(self, tags_to_eagle):
         tag_list = [ x.strip() for x in tags_to_eagle.split(",") if x.strip() != "" ]
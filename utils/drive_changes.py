@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+Google Drive の変更フィード (Changes API) から新しい画像を見つけてローカルに取得する
+
+同期クライアントでローカルに同期したフォルダを PollingObserver で毎回走査する代わりに、
+前回の続き (ページトークン) から「変更があったファイル」だけを受け取る。
+発見のコストはツリーの大きさではなく変更の件数に比例する。
+
+- ChangesSource   : 変更を読み、対象の画像だけを並列にダウンロードして on_file(path) に渡す。
+                    ページトークンはダウンロードが終わってからファイルに保存するので、
+                    途中で止まっても取りこぼさない (再開時に同じ変更をもう一度受け取ることはある)。
+                    Drive から消えた (404 と notFound などの 403) ファイルと max_attempts 回続けて失敗したファイルは
+                    あきらめてトークンを進める (1 つの壊れたファイルでフィード全体を止めない)
+- DriveApiBackend : Drive API v3 (サービスアカウント) で変更フィードとダウンロードを行う
+- LocalBackend    : 手元のフォルダを Drive に見立てた代替。add() で変更を積むと
+                    同じ手順で取り込まれるので、Drive 無しで動作を確認できる
+
+バックエンドは次の 3 つのメソッドを持てばよい。
+    start_page_token() -> str
+    list_changes(page_token) -> (changes, next_page_token, new_start_page_token)
+        changes は [{"fileId", "removed", "file": {"id", "name", "mimeType", "parents",
+                     "md5Checksum", "size", "modifiedTime", "trashed"}}]
+    download(file_id, dest_path)
+    parents(file_id) -> [folder_id]   (folder_ids で絞り込むときに祖先をたどる)
+"""
+import calendar
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+
+from scripts.pipeline import log
+
+logger = log.get_logger("drive_changes")
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+PART_SUFFIX = ".part"
+CHANGE_FIELDS = (
+    "nextPageToken,newStartPageToken,"
+    "changes(fileId,removed,file(id,name,mimeType,parents,md5Checksum,size,modifiedTime,trashed))"
+)
+
+
+# 403 のうち、ファイルが見えない・ダウンロードできない (再試行しても変わらない) ことを表す理由
+GONE_REASONS = frozenset(
+    ["notFound", "insufficientFilePermissions", "cannotDownloadFile", "cannotDownloadAbusiveFile"]
+)
+
+
+# 403 / 429 のうち、時間を置けば通るレート制限の理由
+RATE_LIMIT_REASONS = frozenset(
+    ["rateLimitExceeded", "userRateLimitExceeded", "dailyLimitExceeded", "sharingRateLimitExceeded"]
+)
+
+
+def http_error_reasons(error):
+    """googleapiclient の HttpError から理由 ("rateLimitExceeded" など) の集合を取り出す"""
+    reasons = set()
+    details = getattr(error, "error_details", None)
+    if isinstance(details, list):
+        reasons.update(d.get("reason") for d in details if isinstance(d, dict))
+    content = getattr(error, "content", None)
+    if content:
+        try:
+            body = json.loads(content.decode("utf-8") if isinstance(content, bytes) else content)
+            errors = body.get("error", {}).get("errors", [])
+            reasons.update(e.get("reason") for e in errors if isinstance(e, dict))
+        except (ValueError, AttributeError, UnicodeDecodeError):
+            pass
+    reasons.discard(None)
+    return reasons
+
+
+def parse_rfc3339(value):
+    """"2024-01-02T03:04:05.678Z" を UNIX 時刻にする (解釈できなければ None)"""
+    if not value:
+        return None
+    try:
+        return calendar.timegm(time.strptime(value.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
+class PageTokenStore:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("page_token")
+        except (OSError, ValueError):
+            return None
+
+    def save(self, token):
+        tmp = self.path + PART_SUFFIX
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"page_token": token, "saved_at": time.time()}, f)
+        os.replace(tmp, self.path)
+
+
+# ------------------------------------------------------------------------
+# バックエンド
+# ------------------------------------------------------------------------
+class DriveApiBackend:
+    def __init__(self, credentials_file, page_size=1000):
+        """
+        Args:
+            credentials_file: サービスアカウントのJSONファイル (監視するフォルダを共有しておく)
+            page_size: 1 回の changes.list で受け取る件数
+        """
+        self.credentials_file = credentials_file
+        self.page_size = page_size
+        self._local = threading.local()
+
+    def _service(self):
+        # googleapiclient の service はスレッドセーフではないのでスレッドごとに作る
+        service = getattr(self._local, "service", None)
+        if service is None:
+            from google.oauth2 import service_account
+            from googleapiclient import discovery
+
+            credentials = service_account.Credentials.from_service_account_file(
+                self.credentials_file,
+                scopes=["https://www.googleapis.com/auth/drive.readonly"],
+            )
+            service = discovery.build("drive", "v3", credentials=credentials, cache_discovery=False)
+            self._local.service = service
+        return service
+
+    def start_page_token(self):
+        resp = self._service().changes().getStartPageToken(supportsAllDrives=True).execute()
+        return resp["startPageToken"]
+
+    def list_changes(self, page_token):
+        resp = (
+            self._service()
+            .changes()
+            .list(
+                pageToken=page_token,
+                pageSize=self.page_size,
+                spaces="drive",
+                includeRemoved=False,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                fields=CHANGE_FIELDS,
+            )
+            .execute()
+        )
+        return (
+            resp.get("changes", []),
+            resp.get("nextPageToken"),
+            resp.get("newStartPageToken"),
+        )
+
+    def parents(self, file_id):
+        resp = (
+            self._service()
+            .files()
+            .get(fileId=file_id, fields="parents", supportsAllDrives=True)
+            .execute()
+        )
+        return resp.get("parents", [])
+
+    def download(self, file_id, dest_path):
+        from googleapiclient.http import MediaIoBaseDownload
+
+        request = self._service().files().get_media(fileId=file_id, supportsAllDrives=True)
+        with open(dest_path, "wb") as f:
+            downloader = MediaIoBaseDownload(f, request, chunksize=8 * 1024 * 1024)
+            done = False
+            while not done:
+                _status, done = downloader.next_chunk()
+
+
+class LocalBackend:
+    def __init__(self, page_size=100):
+        """ローカルのファイルを Drive のファイルに見立てた変更フィード"""
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._changes = []
+        self._paths = {}  # {file_id: 元のパス}
+        self._folders = {}  # {folder_id: [親の folder_id]}
+
+    def add_folder(self, folder_id, parents=None):
+        """フォルダの親子関係を登録する (folder_ids の祖先判定用)"""
+        with self._lock:
+            self._folders[folder_id] = list(parents or [])
+
+    def add(self, path, parents=None, file_id=None, md5=None):
+        """path が Drive に追加された (または更新された) ことにする"""
+        file_id = file_id or f"local-{len(self._paths)}"
+        st = os.stat(path)
+        with self._lock:
+            self._paths[file_id] = path
+            self._changes.append(
+                {
+                    "fileId": file_id,
+                    "removed": False,
+                    "file": {
+                        "id": file_id,
+                        "name": os.path.basename(path),
+                        "parents": list(parents or []),
+                        "md5Checksum": md5,
+                        "size": str(st.st_size),
+                        "modifiedTime": time.strftime(
+                            "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(st.st_mtime)
+                        ),
+                        "trashed": False,
+                    },
+                }
+            )
+        return file_id
+
+    def start_page_token(self):
+        with self._lock:
+            return str(len(self._changes))
+
+    def list_changes(self, page_token):
+        start = int(page_token)
+        with self._lock:
+            page = self._changes[start : start + self.page_size]
+            end = start + len(page)
+            if end < len(self._changes):
+                return page, str(end), None
+            return page, None, str(end)
+
+    def parents(self, file_id):
+        with self._lock:
+            return list(self._folders.get(file_id, []))
+
+    def download(self, file_id, dest_path):
+        shutil.copyfile(self._paths[file_id], dest_path)
+
+
+# ------------------------------------------------------------------------
+# 変更フィードの取り込み
+# ------------------------------------------------------------------------
+class ChangesSource:
+    def __init__(
+        self,
+        backend,
+        cache_dir,
+        token_path,
+        on_file,
+        folder_ids=None,
+        should_download=None,
+        workers=4,
+        poll_interval=30.0,
+        exts=IMAGE_EXTS,
+        max_attempts=5,
+    ):
+        """
+        Args:
+            backend: DriveApiBackend / LocalBackend
+            cache_dir: ダウンロード先 (cache_dir/<fileId>/<ファイル名>)
+            token_path: ページトークンを保存するファイル
+            on_file: ダウンロードしたファイルのパスを受け取る関数
+            folder_ids: 指定するとこれらのフォルダ配下 (日付フォルダなどサブフォルダも含む) のファイルだけを対象にする
+            should_download: file (変更の "file") を受け取り False ならダウンロードしない
+                             (md5Checksum で処理済みを判定するなど)
+            workers: 同時にダウンロードするファイル数
+            poll_interval: 変更を確認する間隔 (秒)
+            exts: 対象の拡張子
+            max_attempts: 同じファイルのダウンロードに続けて失敗したらあきらめる回数 (0 で無制限)
+        """
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.tokens = PageTokenStore(token_path)
+        self.on_file = on_file
+        self.folder_ids = set(folder_ids or [])
+        self._under = {}  # {folder_id: folder_ids 配下か} (祖先をたどった結果のキャッシュ)
+        self.should_download = should_download
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.exts = tuple(exts)
+        self.max_attempts = max_attempts
+        self._failures = {}  # {fileId: 続けて失敗した回数}
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="drive-changes-download"
+        )
+
+    def _wanted(self, change):
+        if change.get("removed"):
+            return None
+        f = change.get("file") or {}
+        if f.get("trashed") or not f.get("name", "").lower().endswith(self.exts):
+            return None
+        if self.folder_ids and not any(self._is_under(p) for p in f.get("parents") or []):
+            return None
+        if self.should_download is not None and not self.should_download(f):
+            return None
+        return f
+
+    def _is_under(self, folder_id, depth=0):
+        if folder_id in self.folder_ids:
+            return True
+        cached = self._under.get(folder_id)
+        if cached is not None:
+            return cached
+        if depth >= 16:
+            return False
+        result = any(self._is_under(p, depth + 1) for p in self.backend.parents(folder_id))
+        self._under[folder_id] = result
+        return result
+
+    def local_path(self, f):
+        return os.path.join(self.cache_dir, f["id"], f["name"])
+
+    def _fetch(self, f):
+        path = self.local_path(f)
+        size = f.get("size")
+        if os.path.exists(path) and (size is None or os.path.getsize(path) == int(size)):
+            return path  # 前回ダウンロード済み
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + PART_SUFFIX
+        self.backend.download(f["id"], part)
+        if size is not None and os.path.getsize(part) != int(size):
+            os.remove(part)
+            raise IOError(f"サイズが一致しません: {f['name']}")
+        os.replace(part, path)
+        # 日付フォルダはファイルの更新日時で決まるので、Drive 上の更新日時に合わせる
+        mtime = parse_rfc3339(f.get("modifiedTime"))
+        if mtime:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    @staticmethod
+    def _is_gone(error):
+        """Drive から消えた・見えなくなったファイルか (何度ダウンロードし直しても失敗する)
+
+        403 はレート制限 (rateLimitExceeded など) でも返るので、理由を見て判定する。
+        レート制限や 429 は消えたとはみなさず、再試行する (_is_rate_limited)。
+        """
+        if isinstance(error, (FileNotFoundError, KeyError)):
+            return True  # LocalBackend
+        # googleapiclient.errors.HttpError は resp.status を持つ
+        status = str(getattr(getattr(error, "resp", None), "status", None))
+        if status == "404":
+            return True
+        if status == "403":
+            return bool(http_error_reasons(error) & GONE_REASONS)
+        return False
+
+    @staticmethod
+    def _is_rate_limited(error):
+        """429 と、レート制限を理由とする 403"""
+        status = str(getattr(getattr(error, "resp", None), "status", None))
+        return status == "429" or (
+            status == "403" and bool(http_error_reasons(error) & RATE_LIMIT_REASONS)
+        )
+
+    def _give_up(self, f, error):
+        """ダウンロードの失敗を数え、あきらめるなら True を返します。"""
+        if self._is_gone(error):
+            logger.warning(f"Drive から取得できないファイルを飛ばします: {f.get('name')}, err={error}")
+            self._failures.pop(f["id"], None)
+            return True
+        if self._is_rate_limited(error):
+            # ファイルの問題ではないので max_attempts には数えず、次のポーリングで読み直す
+            logger.warning(f"Drive のレート制限のため後で再試行します: {f.get('name')}, err={error}")
+            return False
+        failures = self._failures.get(f["id"], 0) + 1
+        if self.max_attempts and failures >= self.max_attempts:
+            logger.error(
+                f"Drive からのダウンロードを {failures} 回失敗したためあきらめます: {f.get('name')}, err={error}"
+            )
+            self._failures.pop(f["id"], None)
+            return True
+        self._failures[f["id"]] = failures
+        logger.error(f"Drive からのダウンロード失敗 ({failures}回目): {f.get('name')}, err={error}")
+        return False
+
+    def poll_once(self):
+        """前回の続きから変更を読み切り、取り込んだファイル数を返します。"""
+        token = self.tokens.load()
+        if token is None:
+            # 初回は「今」から始める (既存のファイルは対象外)
+            self.tokens.save(self.backend.start_page_token())
+            logger.info("Drive の変更フィードの読み取りを開始しました")
+            return 0
+        fetched = 0
+        while token:
+            changes, next_token, new_start = self.backend.list_changes(token)
+            # 同じファイルが 1 ページに何度も現れたら最後の変更だけを見る
+            files = {}
+            for change in changes:
+                f = self._wanted(change)
+                if f is not None:
+                    files[f["id"]] = f
+            futures = {self._pool.submit(self._fetch, f): f for f in files.values()}
+            failed = False
+            for fut in concurrent.futures.as_completed(futures):
+                try:
+                    path = fut.result()
+                except Exception as e:
+                    if not self._give_up(futures[fut], e):
+                        failed = True
+                    continue
+                self._failures.pop(futures[fut]["id"], None)
+                self.on_file(path)
+                fetched += 1
+            if failed:
+                break  # トークンを進めず、次回このページをもう一度読む
+            token = next_token or new_start
+            self.tokens.save(token)
+            if not next_token:
+                break
+        if fetched:
+            logger.info("Drive から %d 件を取得しました", fetched)
+        return fetched
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="drive-changes", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error(f"Drive の変更フィードの取得失敗: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+webui の既存の出力フォルダを Eagle にまとめて取り込むバックフィル用コマンド
+
+    python utils/eagle_backfill.py /path/to/outputs/txt2img-images /path/to/outputs/img2img-images \\
+        --save-positive --save-negative n:tag --additional-tags "Steps, Sampler, Model"
+
+- フォルダを並列に走査し、各 PNG の "parameters" チャンクから正/負のプロンプトと
+  生成パラメータを取り出して、拡張機能と同じ規則でタグを作る
+- 取り込み先フォルダ (既定は "stable diffusion/<更新日>") ごとに addFromPaths でまとめて送る
+- 送信に成功したファイルはジャーナルに記録し、中断しても再実行で続きから再開できる
+- 走査・解析・送信の件数とスループットを定期的に表示する
+"""
+import argparse
+import collections
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from scripts.pipeline import log
+from scripts.pipeline.geninfo import param_tags, parse_parameters, prompt_tags
+
+logger = log.setup_logging()
+
+try:
+    from scripts.eagleapi import api_item, api_util, item_index, scheduler, singleflight
+except ImportError as e:
+    logger.error("Eagle API のインポートに失敗。: " + str(e))
+    log.shutdown_logging()
+    sys.exit(1)
+
+# ------------------------------------------------------------------------
+# 定数
+# ------------------------------------------------------------------------
+EAGLE_SERVER_URL = "http://localhost"
+EAGLE_SERVER_PORT = 41595
+STABLE_DIFFUSION_NAME = "stable diffusion"
+IMAGE_EXTS = (".png",)
+DEFAULT_JOURNAL_FILE = os.path.join(os.path.dirname(__file__), "backfill_done.txt")
+
+FOLDER_MODE_DATE = "date"  # ルートフォルダ/<ファイル更新日>
+FOLDER_MODE_ROOT = "root"  # ルートフォルダ直下
+
+
+# ------------------------------------------------------------------------
+# 再開用ジャーナル (送信済みファイルを 1 行 1 件で追記)
+# ------------------------------------------------------------------------
+def journal_key(path, st):
+    return f"{path}\t{st.st_size}\t{int(st.st_mtime)}"
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        done = set()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line:
+                        done.add(line)
+        return done
+
+    def append(self, keys):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(k + "\n" for k in keys))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+# ------------------------------------------------------------------------
+# 集計とスループット表示
+# ------------------------------------------------------------------------
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.bytes_sent = 0
+        self.start = time.monotonic()
+
+    def add(self, name, n=1, size=0):
+        with self._lock:
+            self.counts[name] += n
+            self.bytes_sent += size
+
+    def report(self):
+        with self._lock:
+            c = dict(self.counts)
+            size = self.bytes_sent
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (
+            f"走査 {c.get('scanned', 0)} / 解析 {c.get('parsed', 0)}"
+            f" / 送信 {c.get('sent', 0)} / スキップ {c.get('skipped', 0)}"
+            f" / 失敗 {c.get('failed', 0)}"
+            f" | {c.get('sent', 0) / elapsed:.1f} files/s,"
+            f" {size / elapsed / 1024 / 1024:.1f} MB/s ({elapsed:.0f}s)"
+        )
+
+
+# ------------------------------------------------------------------------
+# 並列走査
+# ------------------------------------------------------------------------
+def _scan_dir(path):
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTS):
+                        files.append((entry.path, entry.stat()))
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.warning(f"フォルダを読めません: {path}, err={e}")
+    return files, dirs
+
+
+def walk_parallel(roots, executor):
+    """roots 以下の画像ファイルを (path, stat) で返す。ディレクトリ単位で並列に読む"""
+    pending = {executor.submit(_scan_dir, r) for r in roots}
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for fut in done:
+            files, dirs = fut.result()
+            pending |= {executor.submit(_scan_dir, d) for d in dirs}
+            yield from files
+
+
+# ------------------------------------------------------------------------
+# PNG の parameters チャンクからタグを作る
+# ------------------------------------------------------------------------
+def build_item(path, st, args):
+    # Image.open はヘッダと IDAT より前のチャンクだけを読み、画素は展開しない
+    with Image.open(path) as im:
+        parameters = im.info.get("parameters")
+    tags, annotation = [], ""
+    if parameters:
+        positive, negative, params = parse_parameters(parameters)
+        tags = prompt_tags(positive, negative, args.save_positive, args.save_negative)
+        tags += param_tags(args.additional_tags, params)
+        if args.embed_generation_info:
+            annotation = parameters
+    if args.folder_mode == FOLDER_MODE_DATE:
+        folder = time.strftime("%Y-%m-%d", time.localtime(st.st_mtime))
+    else:
+        folder = ""
+    item = api_item.EAGLE_ITEM_PATH(
+        filefullpath=path,
+        filename=os.path.splitext(os.path.basename(path))[0],
+        annotation=annotation,
+        tags=tags,
+    )
+    return folder, item
+
+
+# ------------------------------------------------------------------------
+# 取り込み先フォルダごとにまとめて addFromPaths
+# ------------------------------------------------------------------------
+class Ingestor:
+    def __init__(self, args, root_folder_id, journal, stats):
+        self.args = args
+        self.root_folder_id = root_folder_id
+        self.journal = journal
+        self.stats = stats
+        self._batches = collections.defaultdict(list)  # {folder: [(key, item, size)]}
+        self._folder_ids = {}  # 送信スレッドから読み書きするので _folder_lock で守る
+        self._folder_lock = threading.Lock()
+        self._sender = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.send_workers, thread_name_prefix="eagle-backfill-send"
+        )
+        self._futures = set()
+
+    def add(self, folder, key, item, size):
+        batch = self._batches[folder]
+        batch.append((key, item, size))
+        if len(batch) >= self.args.batch_size:
+            self._submit(folder, self._batches.pop(folder))
+
+    def flush(self):
+        for folder in list(self._batches):
+            self._submit(folder, self._batches.pop(folder))
+        concurrent.futures.wait(self._futures)
+        self._sender.shutdown(wait=True)
+
+    def _submit(self, folder, batch):
+        # 送信待ちが溜まりすぎないよう、送信スレッド数の 2 倍を上限にする
+        while len(self._futures) >= self.args.send_workers * 2:
+            _done, self._futures = concurrent.futures.wait(
+                self._futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+        self._futures.add(self._sender.submit(self._send, folder, batch))
+
+    def _folder_id(self, folder):
+        if not folder:
+            return self.root_folder_id
+        with self._folder_lock:
+            folder_id = self._folder_ids.get(folder)
+        if not folder_id:
+            # 同じ日付のバッチが複数の送信スレッドで同時に来ても、作成は 1 回にまとめる
+            folder_id = singleflight.folders.do(
+                (self.args.server_url, self.args.port, self.root_folder_id, folder),
+                api_util.find_or_create_subfolder,
+                self.root_folder_id,
+                folder,
+                server_url=self.args.server_url,
+                port=self.args.port,
+            )
+            if folder_id:
+                with self._folder_lock:
+                    self._folder_ids[folder] = folder_id
+        return folder_id
+
+    def _send(self, folder, batch):
+        try:
+            folder_id = self._folder_id(folder)
+            if not folder_id:
+                raise RuntimeError(f"フォルダを用意できません: '{folder}'")
+            r_posts = api_item.add_items(
+                [item for _k, item, _size in batch],
+                folderId=folder_id,
+                server_url=self.args.server_url,
+                port=self.args.port,
+            )
+        except Exception as e:
+            self.stats.add("failed", len(batch))
+            logger.error(f"送信失敗 ({folder or 'root'}, {len(batch)}件): {e}")
+            return
+        # リモートの Eagle へは 1 件ずつ送るので、送れたものだけジャーナルに書く (次回は失敗分だけ送る)
+        sent = [b for b, r in zip(batch, r_posts) if api_item.is_success(r)]
+        failed = len(batch) - len(sent)
+        if sent:
+            self.journal.append([k for k, _item, _size in sent])
+            self.stats.add("sent", len(sent), size=sum(s for _k, _i, s in sent))
+        if failed:
+            self.stats.add("failed", failed)
+            errors = [r for r in r_posts if not api_item.is_success(r)]
+            logger.error(f"送信失敗 ({folder or 'root'}, {failed}件): {errors[:3]}")
+
+
+# ------------------------------------------------------------------------
+# メインエントリ
+# ------------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="webui の出力フォルダを Eagle にまとめて取り込みます"
+    )
+    parser.add_argument("dirs", nargs="+", help="走査するフォルダ")
+    parser.add_argument("--server-url", default=EAGLE_SERVER_URL)
+    parser.add_argument("--port", type=int, default=EAGLE_SERVER_PORT)
+    parser.add_argument(
+        "--root-folder", default=STABLE_DIFFUSION_NAME, help="取り込み先のルートフォルダ名"
+    )
+    parser.add_argument(
+        "--folder-mode",
+        choices=[FOLDER_MODE_DATE, FOLDER_MODE_ROOT],
+        default=FOLDER_MODE_DATE,
+        help="date: ルート/<更新日> に入れる, root: ルート直下に入れる",
+    )
+    parser.add_argument(
+        "--save-positive", action="store_true", help="正のプロンプトをタグとして保存"
+    )
+    parser.add_argument(
+        "--save-negative",
+        choices=["None", "tag", "n:tag"],
+        default="n:tag",
+        help="負のプロンプトをタグとして保存",
+    )
+    parser.add_argument(
+        "--additional-tags", default="", help='追加タグ (例: "Steps, Sampler, Model")'
+    )
+    parser.add_argument(
+        "--embed-generation-info",
+        action="store_true",
+        help="生成情報を Annotation に入れる",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="走査と解析のスレッド数")
+    parser.add_argument("--send-workers", type=int, default=2, help="送信スレッド数")
+    parser.add_argument("--batch-size", type=int, default=100, help="addFromPaths 1 回の件数")
+    parser.add_argument(
+        "--journal", default=DEFAULT_JOURNAL_FILE, help="送信済みファイルの記録 (再開用)"
+    )
+    parser.add_argument(
+        "--report-interval", type=float, default=5.0, help="進捗を表示する間隔 (秒)"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="解析だけ行い Eagle には送らない"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="Eagle へのリクエスト数の上限 (件/秒、0 で無制限)",
+    )
+    parser.add_argument(
+        "--no-adaptive-throttle",
+        action="store_true",
+        help="Eagle の応答が遅くなっても送信を絞らない",
+    )
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="Eagle に同じ名前・拡張子・サイズの項目があるファイルは送らない",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    roots = [os.path.normpath(d) for d in args.dirs if os.path.isdir(d)]
+    for d in args.dirs:
+        if not os.path.isdir(d):
+            logger.error(f"フォルダが存在しません: {d}")
+    if not roots:
+        return 1
+
+    # 取り込みは最も低い優先度で、webui の保存や監視の新規ファイルに帯域を譲る
+    scheduler.set_default_priority(scheduler.BACKFILL)
+    scheduler.configure(rate=args.rate_limit, adaptive=not args.no_adaptive_throttle)
+
+    journal = Journal(args.journal)
+    done = journal.load()
+    if done:
+        logger.info(f"送信済み {len(done)} 件をスキップして再開します")
+    stats = Stats()
+
+    root_folder_id = ""
+    if not args.dry_run:
+        root_folder_id = api_util.find_or_create_folder(
+            args.root_folder,
+            allow_create_new_folder=True,
+            server_url=args.server_url,
+            port=args.port,
+        )
+        if not root_folder_id:
+            logger.error(f"'{args.root_folder}' フォルダID を取得できず。終了。")
+            return 1
+    ingestor = Ingestor(args, root_folder_id, journal, stats)
+
+    # Eagle の既存項目は最初に一括で読み込み、走査中は手元の索引だけで判定する
+    existing = None
+    if args.skip_existing and not args.dry_run:
+        existing = item_index.get_index(args.server_url, args.port)
+        if not existing.fill():
+            logger.error("Eagle の既存項目を取得できず。終了。")
+            return 1
+        logger.info(f"Eagle の既存項目: {len(existing)} 件")
+
+    # 走査が終わった後の送信中も進捗を出せるよう、表示は別スレッドで行う
+    stop_report = threading.Event()
+
+    def _report_loop():
+        while not stop_report.wait(args.report_interval):
+            logger.info(stats.report())
+
+    threading.Thread(target=_report_loop, name="eagle-backfill-report", daemon=True).start()
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.workers, thread_name_prefix="eagle-backfill-scan"
+    ) as scanner, concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.workers, thread_name_prefix="eagle-backfill-parse"
+    ) as parser_pool:
+        parsing = {}  # {future: (key, path, size)}
+
+        def collect(wait_all=False):
+            if not parsing:
+                return
+            done_futs, _ = concurrent.futures.wait(
+                list(parsing),
+                return_when=(
+                    concurrent.futures.ALL_COMPLETED
+                    if wait_all
+                    else concurrent.futures.FIRST_COMPLETED
+                ),
+            )
+            for fut in done_futs:
+                key, path, size = parsing.pop(fut)
+                try:
+                    folder, item = fut.result()
+                except Exception as e:
+                    stats.add("failed")
+                    logger.warning(f"解析失敗: {path}, err={e}")
+                    continue
+                stats.add("parsed")
+                if not args.dry_run:
+                    ingestor.add(folder, key, item, size)
+
+        for path, st in walk_parallel(roots, scanner):
+            stats.add("scanned")
+            key = journal_key(path, st)
+            if key in done:
+                stats.add("skipped")
+                continue
+            if existing is not None and existing.find_file(path, size=st.st_size) is not None:
+                stats.add("skipped")
+                continue
+            parsing[parser_pool.submit(build_item, path, st, args)] = (
+                key,
+                path,
+                st.st_size,
+            )
+            # 解析待ちが溜まりすぎないようにする
+            if len(parsing) >= args.workers * 4:
+                collect()
+        collect(wait_all=True)
+
+    if not args.dry_run:
+        ingestor.flush()
+    stop_report.set()
+    logger.info("完了: " + stats.report())
+    return 0 if not stats.counts.get("failed") else 2
+
+
+if __name__ == "__main__":
+    code = main()
+    log.shutdown_logging()
+    sys.exit(code)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+複数の webui と監視スクリプトからの送信ジョブを 1 本にまとめて Eagle へ流す中継デーモン
+
+    python utils/eagle_relay.py --port 41600
+
+- localhost の HTTP で送信ジョブを受け取り、SQLite のアウトボックスに積む
+  (プロトコルは scripts/eagleapi/relay.py を参照)
+- Eagle への送信はこのプロセスだけが行う。フォルダのキャッシュ、コネクションプール、
+  フォルダごとのバッチ化 (addFromPaths)、レート制限をここに集約するので、
+  送信元のプロセスを増やしても Eagle から見た負荷は一定に保たれる
+- 取り込み先は "<ルートフォルダ>/<ジョブのフォルダ名 (日付)>"。今日と翌日の日付フォルダは先に作っておく
+
+拡張機能は設定「中継デーモンのURL」、監視スクリプトは環境変数 EAGLE_RELAY_URL で使う。
+"""
+import argparse
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from scripts.pipeline import log, prewarm
+
+logger = log.setup_logging()
+
+try:
+    from scripts.eagleapi import api_item, api_util, outbox, scheduler
+except ImportError as e:
+    logger.error("Eagle API のインポートに失敗。: " + str(e))
+    log.shutdown_logging()
+    sys.exit(1)
+
+# ------------------------------------------------------------------------
+# 定数
+# ------------------------------------------------------------------------
+RELAY_HOST = "127.0.0.1"
+RELAY_PORT = 41600
+EAGLE_SERVER_URL = "http://localhost"
+EAGLE_SERVER_PORT = 41595
+STABLE_DIFFUSION_NAME = "stable diffusion"
+DEFAULT_DB_FILE = os.path.join(os.path.dirname(__file__), "relay_outbox.sqlite3")
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+
+# ------------------------------------------------------------------------
+# フォルダの解決 (ルートフォルダ/<日付>)
+# ------------------------------------------------------------------------
+class FolderResolver:
+    def __init__(self, root_folder):
+        self.root_folder = root_folder
+        self._root_ids = {}  # {(server_url, port): folderId}
+
+    def root_id(self, server_url, port):
+        key = (server_url, port)
+        folder_id = self._root_ids.get(key)
+        if not folder_id:
+            folder_id = api_util.find_or_create_folder(
+                self.root_folder,
+                allow_create_new_folder=True,
+                server_url=server_url,
+                port=port,
+            )
+            if folder_id:
+                self._root_ids[key] = folder_id
+        return folder_id
+
+    def __call__(self, folder, server_url, port):
+        root_id = self.root_id(server_url, port)
+        if not root_id:
+            logger.error(f"'{self.root_folder}' フォルダID を取得できず ({server_url}:{port})")
+            return ""
+        if not folder:
+            return root_id
+        return api_util.find_or_create_subfolder(
+            root_id, folder, server_url=server_url, port=port
+        )
+
+
+# ------------------------------------------------------------------------
+# HTTP ハンドラ
+# ------------------------------------------------------------------------
+def parse_job(job, default_server_url, default_port):
+    """受け取ったジョブを (item, folder, server_url, port, key) にする (不正なら ValueError)"""
+    _item = job.get("item") or {}
+    if not _item.get("path"):
+        raise ValueError("item.path is required")
+    item = api_item.EAGLE_ITEM_PATH(
+        filefullpath=_item["path"],
+        filename=_item.get("name", ""),
+        website=_item.get("website", ""),
+        tags=_item.get("tags", []),
+        annotation=_item.get("annotation", ""),
+    )
+    return (
+        item,
+        str(job.get("folder") or ""),
+        job.get("server_url") or default_server_url,
+        int(job.get("port") or default_port),
+        job.get("key"),
+    )
+
+
+class RelayHandler(BaseHTTPRequestHandler):
+    server_version = "EagleRelay/1.0"
+    # 以下は make_server で設定する
+    outbox = None
+    default_server_url = EAGLE_SERVER_URL
+    default_port = EAGLE_SERVER_PORT
+
+    def _reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/api/health":
+            return self._reply(404, {"status": "error", "message": "not found"})
+        self._reply(
+            200, {"status": "success", "data": {"pending": self.outbox.pending_count()}}
+        )
+
+    def do_POST(self):
+        if self.path != "/api/enqueue":
+            return self._reply(404, {"status": "error", "message": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > MAX_BODY_BYTES:
+                raise ValueError(f"invalid Content-Length: {length}")
+            body = json.loads(self.rfile.read(length))
+            jobs = [
+                parse_job(j, self.default_server_url, self.default_port)
+                for j in body.get("jobs", [])
+            ]
+        except (ValueError, TypeError, AttributeError) as e:
+            return self._reply(400, {"status": "error", "message": str(e)})
+        results = []
+        for item, folder, server_url, port, key in jobs:
+            results.append(
+                self.outbox.enqueue(item, folder, server_url=server_url, port=port, key=key)
+            )
+        logger.debug("受付: %d件 (新規 %d件)", len(results), sum(results))
+        self._reply(200, {"status": "success", "data": results})
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+
+def make_server(host, port, relay_outbox, default_server_url, default_port):
+    handler = type(
+        "BoundRelayHandler",
+        (RelayHandler,),
+        {
+            "outbox": relay_outbox,
+            "default_server_url": default_server_url,
+            "default_port": default_port,
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+# ------------------------------------------------------------------------
+# メインエントリ
+# ------------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="複数の送信元からのジョブを 1 本にまとめて Eagle へ送る中継デーモン"
+    )
+    parser.add_argument("--host", default=RELAY_HOST, help="待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=RELAY_PORT, help="待ち受けるポート")
+    parser.add_argument("--server-url", default=EAGLE_SERVER_URL, help="既定の Eagle サーバー")
+    parser.add_argument("--eagle-port", type=int, default=EAGLE_SERVER_PORT)
+    parser.add_argument(
+        "--root-folder", default=STABLE_DIFFUSION_NAME, help="取り込み先のルートフォルダ名"
+    )
+    parser.add_argument("--db", default=DEFAULT_DB_FILE, help="アウトボックスの SQLite ファイル")
+    parser.add_argument("--batch-size", type=int, default=50, help="addFromPaths 1 回の件数")
+    parser.add_argument(
+        "--rate", type=float, default=20.0, help="Eagle へ送る画像の上限 (件/秒、0 で無制限)"
+    )
+    parser.add_argument(
+        "--request-rate",
+        type=float,
+        default=0.0,
+        help="Eagle へのリクエスト数の上限 (件/秒、0 で無制限)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scheduler.set_default_priority(scheduler.LIVE)
+    scheduler.configure(rate=args.request_rate, adaptive=True)
+
+    resolver = FolderResolver(args.root_folder)
+    relay_outbox = outbox.Outbox(
+        args.db, resolver, batch_size=args.batch_size, rate_per_sec=args.rate
+    )
+    relay_outbox.start()
+    pending = relay_outbox.pending_count()
+    if pending:
+        logger.info(f"未送信のジョブを再送します: {pending}件")
+
+    # 今日の日付フォルダを解決し、0時前には翌日分を作っておく
+    prewarm.PrewarmScheduler(
+        lambda: [
+            (
+                "eagle",
+                lambda d: bool(resolver(d, args.server_url, args.eagle_port)),
+            )
+        ]
+    ).start()
+
+    try:
+        server = make_server(
+            args.host, args.port, relay_outbox, args.server_url, args.eagle_port
+        )
+    except OSError as e:
+        logger.error(f"{args.host}:{args.port} で待ち受けできません: {e}")
+        relay_outbox.stop(5)
+        return 1
+    logger.info(f"中継デーモン開始: http://{args.host}:{args.port} -> {args.server_url}:{args.eagle_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt: 中継デーモン停止中...")
+    finally:
+        server.server_close()
+        relay_outbox.stop(5)
+    return 0
+
+
+if __name__ == "__main__":
+    code = main()
+    log.shutdown_logging()
+    sys.exit(code)
@@ -2,8 +2,9 @@
 import os
 import sys
 import time
-import logging
 import hashlib
+import shutil
+import tarfile
 import datetime
 import threading
 import concurrent.futures
@@ -13,16 +14,43 @@ from watchdog.events import FileSystemEventHandler
 from PIL import Image
 
 # ------------------------------------------------------------------------
-# 1) scripts/eagleapi を import できるように sys.path を通す
+# 1) scripts/eagleapi と同じフォルダの補助モジュールを import できるように sys.path を通す
+#    (補助モジュールは "utils." を付けずに読む。別の utils パッケージが入っていても取り違えない)
 # ------------------------------------------------------------------------
-project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(script_dir)
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
+if script_dir not in sys.path:
+    sys.path.insert(0, script_dir)
+
+from scripts.pipeline import bundles, log, prewarm, profiler, tracing
+
+logger = log.setup_logging()
+
+try:
+    from scripts.eagleapi import (
+        api_folder,
+        api_item,
+        hooks,
+        item_index,
+        relay,
+        scheduler,
+        singleflight,
+    )
+except ImportError as e:
+    logger.error("Eagle API のインポートに失敗。: " + str(e))
+    log.shutdown_logging()
+    sys.exit(1)
 
 try:
-    from scripts.eagleapi import api_folder, api_item, api_util
+    import drive_changes
+    import hash_store
+    import prefilter
+    import work_leases
 except ImportError as e:
-    logging.error("Eagle API のインポートに失敗。: " + str(e))
+    logger.error(f"{script_dir} の補助モジュールのインポートに失敗。: {e}")
+    log.shutdown_logging()
     sys.exit(1)
 
 # ------------------------------------------------------------------------
@@ -33,32 +61,109 @@ EAGLE_SERVER_PORT = 41595
 STABLE_DIFFUSION_NAME = "stable diffusion"
 
 PROCESSED_DB_FILE = os.path.join(os.path.dirname(__file__), "processed_files.txt")
+# 処理済みハッシュの持ち方: memory (16バイト/件) / bloom (ブルームフィルター + SQLite, 約1.2バイト/件)
+PROCESSED_STORE_MODE = os.environ.get("EAGLE_PROCESSED_STORE", "memory")
+PROCESSED_STORE_CAPACITY = int(os.environ.get("EAGLE_PROCESSED_CAPACITY", "10000000"))
 DEFAULT_EAGLE_FOLDER_ID = ""  # サブフォルダ名が取れなかったらルートへ入れる
+# Eagle に同じ名前・拡張子・サイズの項目が既にあればアップロードしない (0 で無効)
+SKIP_EXISTING = os.environ.get("EAGLE_SKIP_EXISTING", "1") != "0"
+
+# Eagle へのリクエスト数の上限 (件/秒、0 で無制限) と、応答が遅くなったときの自動調整 (0 で無効)。
+# 新規ファイルは LIVE、起動時の初回スキャン分は BACKFILL の優先度で送る
+RATE_LIMIT = float(os.environ.get("EAGLE_RATE_LIMIT", "0"))
+ADAPTIVE_THROTTLE = os.environ.get("EAGLE_ADAPTIVE_THROTTLE", "1") != "0"
+# 中継デーモン (utils/eagle_relay.py) の URL。設定すると Eagle へ直接送らずに中継デーモンへ渡す
+# (中継デーモンが停止中は直接送る)
+RELAY_URL = os.environ.get("EAGLE_RELAY_URL", "")
+
+# Drive の変更フィード (Changes API) から取り込む場合のサービスアカウントの JSON。
+# 設定すると同期フォルダの監視の代わりに (または併用して) 変更があったファイルだけをダウンロードする
+DRIVE_CHANGES_CREDENTIALS = os.environ.get("EAGLE_DRIVE_CHANGES_CREDENTIALS", "")
+DRIVE_FOLDER_IDS = [
+    x.strip() for x in os.environ.get("EAGLE_DRIVE_FOLDER_IDS", "").split(",") if x.strip()
+]
+DRIVE_CACHE_DIR = os.environ.get(
+    "EAGLE_DRIVE_CACHE_DIR", os.path.join(os.path.dirname(__file__), "drive_cache")
+)
+# 中継デーモンへ渡したダウンロードの目印 (DRIVE_CACHE_DIR/<fileId>/.relayed)。あるものは取り込み後も消さない
+RELAYED_MARKER = ".relayed"
+DRIVE_TOKEN_FILE = os.path.join(os.path.dirname(__file__), "drive_changes_token.json")
+DRIVE_POLL_INTERVAL = float(os.environ.get("EAGLE_DRIVE_POLL_INTERVAL", "30"))
+
+# 複数の監視スクリプト (ノード) で分担する場合の共有作業テーブル (SQLite)。空なら 1 ノードで動く
+WORK_DB = os.environ.get("EAGLE_WORK_DB", "")
+NODE_ID = os.environ.get("EAGLE_NODE_ID", "")
+LEASE_SECONDS = float(os.environ.get("EAGLE_LEASE_SECONDS", "120"))
+# この回数処理しても完了しない作業は拾い直さない (0 で無制限)
+WORK_MAX_ATTEMPTS = int(os.environ.get("EAGLE_WORK_MAX_ATTEMPTS", "10"))
+
+# ハッシュ計算の前に振り落とすファイルの規則 (utils/prefilter.py)。glob はカンマ区切り、0 は無制限
+# 例: EAGLE_FILTER_NAME_EXCLUDE="^grid-" EAGLE_FILTER_MIN_WIDTH=256 (グリッドとサムネイルを除外)
+FILTER_INCLUDE = os.environ.get("EAGLE_FILTER_INCLUDE", "")
+FILTER_EXCLUDE = os.environ.get("EAGLE_FILTER_EXCLUDE", ",".join(prefilter.DEFAULT_EXCLUDE))
+FILTER_NAME_EXCLUDE = os.environ.get("EAGLE_FILTER_NAME_EXCLUDE", "")
+FILTER_MIN_SIZE = int(os.environ.get("EAGLE_FILTER_MIN_SIZE", "0"))
+FILTER_MAX_SIZE = int(os.environ.get("EAGLE_FILTER_MAX_SIZE", "0"))
+FILTER_MIN_WIDTH = int(os.environ.get("EAGLE_FILTER_MIN_WIDTH", "0"))
+FILTER_MIN_HEIGHT = int(os.environ.get("EAGLE_FILTER_MIN_HEIGHT", "0"))
+FILTER_MAX_WIDTH = int(os.environ.get("EAGLE_FILTER_MAX_WIDTH", "0"))
+FILTER_MAX_HEIGHT = int(os.environ.get("EAGLE_FILTER_MAX_HEIGHT", "0"))
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg")
+
+# 拡張機能がまとめて送ったアーカイブ (*.eagle.tar) から画像を取り出す先 (監視フォルダの外に置く)
+BUNDLE_EXTRACT_DIR = os.environ.get(
+    "EAGLE_BUNDLE_EXTRACT_DIR", os.path.join(os.path.dirname(__file__), "bundle_extract")
+)
+# 中継デーモンへ渡した画像 (アーカイブの取り出し先・変更フィードのダウンロード) は後で
+# そのパスから登録されるので残しておき、この日数を過ぎたら起動時に消す
+RELAYED_KEEP_DAYS = float(os.environ.get("EAGLE_RELAYED_KEEP_DAYS", "7"))
+
+# 処理トレース (EAGLE_TRACE_SAMPLE_RATE が 0 より大きいときだけ記録)
+TRACE_SAMPLE_RATE = float(os.environ.get("EAGLE_TRACE_SAMPLE_RATE", "0"))
+TRACE_FORMAT = os.environ.get("EAGLE_TRACE_FORMAT", tracing.FORMAT_JSONL)
+TRACE_FILE = os.environ.get(
+    "EAGLE_TRACE_FILE",
+    os.path.join(
+        project_root,
+        "traces",
+        "watcher_trace"
+        + (".json" if TRACE_FORMAT == tracing.FORMAT_CHROME else ".jsonl"),
+    ),
+)
 
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+# プロファイル (EAGLE_PROFILE_EVERY_N 件に 1 件を cProfile で計測、0 で無効)。
+# スタックサンプラーは SIGUSR2 か制御ファイルの有無で ON/OFF する
+PROFILE_DIR = os.environ.get("EAGLE_PROFILE_DIR", os.path.join(project_root, "profiles"))
+PROFILE_EVERY_N = int(os.environ.get("EAGLE_PROFILE_EVERY_N", "0"))
+PROFILE_CONTROL_FILE = os.environ.get(
+    "EAGLE_PROFILE_CONTROL_FILE", os.path.join(project_root, "eagle_profile.enable")
 )
 
 # ------------------------------------------------------------------------
 # 2) 「stable diffusion」フォルダを探す or 作る
 # ------------------------------------------------------------------------
 def fetch_or_create_stable_diffusion_folder():
-    resp = api_folder.list(server_url=EAGLE_SERVER_URL, port=EAGLE_SERVER_PORT)
-    if resp.status_code != 200:
-        logging.error("Eagleフォルダ一覧取得失敗:" + resp.text)
-        return ""
+    # 8 スレッドから同時に呼ばれても一覧の取得と作成は 1 回にまとめる
+    return singleflight.folders.do(
+        (EAGLE_SERVER_URL, EAGLE_SERVER_PORT, None, STABLE_DIFFUSION_NAME),
+        _fetch_or_create_stable_diffusion_folder,
+    )
 
-    folder_list = api_util.getAllFolder(resp)
-    if not folder_list:
-        logging.error("フォルダ一覧が空または解析失敗。")
+
+def _fetch_or_create_stable_diffusion_folder():
+    mirror = api_folder.get_mirror(EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+    if not mirror.ensure_loaded():
+        logger.error("Eagleフォルダ一覧取得失敗")
         return ""
+    mirror.start_background_sync()
 
-    for fd in folder_list:
-        if fd.get("name") == STABLE_DIFFUSION_NAME:
-            return fd.get("id")
+    fd = mirror.find_by_name(STABLE_DIFFUSION_NAME)
+    if fd is not None:
+        return fd.get("id")
 
     # なければルートに作成
-    logging.info(f"'{STABLE_DIFFUSION_NAME}' フォルダが無いので新規作成します。")
+    logger.info(f"'{STABLE_DIFFUSION_NAME}' フォルダが無いので新規作成します。")
     r_create = api_folder.create(
         STABLE_DIFFUSION_NAME, server_url=EAGLE_SERVER_URL, port=EAGLE_SERVER_PORT
     )
@@ -66,38 +171,41 @@ def fetch_or_create_stable_diffusion_folder():
         try:
             return r_create.json()["data"]["id"]
         except:
-            logging.error("フォルダ作成後のレスポンス解析に失敗")
+            logger.error("フォルダ作成後のレスポンス解析に失敗")
             return ""
     else:
-        logging.error(f"'{STABLE_DIFFUSION_NAME}' フォルダ作成失敗: " + r_create.text)
+        logger.error(f"'{STABLE_DIFFUSION_NAME}' フォルダ作成失敗: " + r_create.text)
         return ""
 
 
 # ------------------------------------------------------------------------
 # 3) stable diffusion配下に日付サブフォルダを探す or 作る
-#    (親ID は stable diffusion フォルダID、重複は extendTags + name でチェック)
+#    (親ID は stable diffusion フォルダID、重複は親ID + name でチェック)
 # ------------------------------------------------------------------------
 def find_or_create_subfolder(parent_id, subfolder_name):
-    r_list = api_folder.list(server_url=EAGLE_SERVER_URL, port=EAGLE_SERVER_PORT)
-    if r_list.status_code != 200:
-        logging.error("サブフォルダ検索: フォルダ一覧取得失敗")
-        return ""
+    # 同じ (親ID, 名前) への同時の呼び出しは 1 回にまとめ、重複作成を防ぐ
+    return singleflight.folders.do(
+        (EAGLE_SERVER_URL, EAGLE_SERVER_PORT, parent_id, subfolder_name),
+        _find_or_create_subfolder,
+        parent_id,
+        subfolder_name,
+    )
 
-    folder_list = api_util.getAllFolder(r_list)
-    if not folder_list:
-        logging.error("サブフォルダ検索: フォルダ一覧が空または解析失敗")
+
+def _find_or_create_subfolder(parent_id, subfolder_name):
+    mirror = api_folder.get_mirror(EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+    if not mirror.ensure_loaded():
+        logger.error("サブフォルダ検索: フォルダ一覧取得失敗")
         return ""
 
-    # --- 「extendTags に 'stable diffusion' があり、name が subfolder_name」のフォルダを探す
-    for fd in folder_list:
-        if fd.get("name") == subfolder_name and "stable diffusion" in fd.get(
-            "extendTags", []
-        ):
-            logging.info(f"既存サブフォルダあり: '{subfolder_name}' (ID={fd.get('id')})")
-            return fd.get("id")
+    # --- 「stable diffusion フォルダ直下で name が subfolder_name」のフォルダを探す
+    fd = mirror.find_child(parent_id, subfolder_name)
+    if fd is not None:
+        logger.info(f"既存サブフォルダあり: '{subfolder_name}' (ID={fd.get('id')})")
+        return fd.get("id")
 
     # 無い場合 => 作成
-    logging.info(f"サブフォルダ '{subfolder_name}' が無いので新規作成")
+    logger.info(f"サブフォルダ '{subfolder_name}' が無いので新規作成")
     r_sub = api_folder.create_subfolder(
         newfoldername=subfolder_name,
         parent_id=parent_id,  # stable diffusion フォルダを親にする
@@ -108,13 +216,13 @@ def find_or_create_subfolder(parent_id, subfolder_name):
     if r_sub.status_code == 200:
         try:
             new_id = r_sub.json()["data"]["id"]
-            logging.info(f"サブフォルダ'{subfolder_name}'作成完了: ID={new_id}")
+            logger.info(f"サブフォルダ'{subfolder_name}'作成完了: ID={new_id}")
             return new_id
         except:
-            logging.error("サブフォルダ作成レスポンス解析失敗")
+            logger.error("サブフォルダ作成レスポンス解析失敗")
             return ""
     else:
-        logging.error(f"サブフォルダ作成失敗: {r_sub.text}")
+        logger.error(f"サブフォルダ作成失敗: {r_sub.text}")
         return ""
 
 
@@ -122,14 +230,16 @@ def find_or_create_subfolder(parent_id, subfolder_name):
 # 4) 重複チェック用
 # ------------------------------------------------------------------------
 def load_processed_hashes():
-    s = set()
-    if os.path.exists(PROCESSED_DB_FILE):
-        with open(PROCESSED_DB_FILE, "r") as f:
-            for line in f:
-                h = line.strip()
-                if h:
-                    s.add(h)
-    return s
+    start = time.time()
+    store = hash_store.open_store(
+        PROCESSED_DB_FILE,
+        mode=PROCESSED_STORE_MODE,
+        capacity=PROCESSED_STORE_CAPACITY,
+    )
+    logger.info(
+        f"処理済みハッシュ読み込み完了 ({PROCESSED_STORE_MODE}): {time.time() - start:.1f}s"
+    )
+    return store
 
 
 def save_processed_hash(h):
@@ -141,7 +251,7 @@ def save_processed_hash(h):
 # compute_md5: キャッシュなしで毎回 MD5 を計算する
 # ------------------------------------------------------------------------
 def compute_md5(file_path, block_size=65536):
-    logging.info(f"MD5計算開始: {file_path}")
+    logger.debug("MD5計算開始: %s", file_path)
     m = hashlib.md5()
     try:
         with open(file_path, "rb") as f:
@@ -151,10 +261,10 @@ def compute_md5(file_path, block_size=65536):
                     break
                 m.update(block)
     except Exception as e:
-        logging.error(f"ファイル読み込み失敗: {file_path}, err={e}")
+        logger.error(f"ファイル読み込み失敗: {file_path}, err={e}")
         return None
     result = m.hexdigest()
-    logging.info(f"MD5計算完了: {file_path} -> {result}")
+    logger.debug("MD5計算完了: %s -> %s", file_path, result)
     return result
 
 
@@ -163,7 +273,7 @@ def wait_for_file_complete(file_path, timeout=10):
     last_size = -1
     while True:
         if time.time() - start > timeout:
-            logging.warning("ファイルサイズ安定待ちタイムアウト: " + file_path)
+            logger.warning("ファイルサイズ安定待ちタイムアウト: " + file_path)
             return False
         try:
             sz = os.path.getsize(file_path)
@@ -175,6 +285,60 @@ def wait_for_file_complete(file_path, timeout=10):
         time.sleep(0.5)
 
 
+def is_target(file_path):
+    """処理対象 (画像またはアーカイブ) か"""
+    return file_path.lower().endswith(IMAGE_EXTS) or bundles.is_bundle(file_path)
+
+
+def extract_bundle_member(tar, entry, dest_dir, block_size=1024 * 1024):
+    """アーカイブから画像を 1 枚取り出し、manifest の MD5 と照合してパスを返します。
+
+    取り出しながら MD5 を計算するので、取り出した画像を読み直す必要はありません。
+    """
+    dest = os.path.join(dest_dir, os.path.basename(entry["member"]))
+    if os.path.exists(dest) and os.path.getsize(dest) == entry["size"]:
+        return dest  # 前回取り出し済み
+    part = dest + ".part"
+    m = hashlib.md5()
+    src = tar.extractfile(entry["member"])
+    try:
+        with open(part, "wb") as out:
+            while True:
+                block = src.read(block_size)
+                if not block:
+                    break
+                m.update(block)
+                out.write(block)
+    finally:
+        src.close()
+    if m.hexdigest() != entry["md5"]:
+        os.remove(part)
+        raise IOError(f"MD5 が manifest と一致しません: {entry['member']}")
+    os.replace(part, dest)
+    return dest
+
+
+def prune_old_dirs(root, keep_days=RELAYED_KEEP_DAYS, marker=None):
+    """root 直下の古いフォルダを消し、その数を返します。
+
+    marker を指定すると、そのファイルがあるフォルダだけを目印の日時で判定します。
+    """
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - keep_days * 24 * 3600
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        stamp = os.path.join(path, marker) if marker else path
+        try:
+            if os.path.isdir(path) and os.path.exists(stamp) and os.path.getmtime(stamp) < cutoff:
+                shutil.rmtree(path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"古いフォルダを消せません: {path}, err={e}")
+    return removed
+
+
 def get_date_from_file_mtime(file_path):
     ts = os.path.getmtime(file_path)
     return time.strftime("%Y-%m-%d", time.localtime(ts))
@@ -184,77 +348,401 @@ def get_date_from_file_mtime(file_path):
 # 5) Watchdogハンドラ (並列処理とロックによる重複排除を導入)
 # ------------------------------------------------------------------------
 class NewFileHandler(FileSystemEventHandler):
-    def __init__(self, monitored_folders, stable_folder_id):
+    def __init__(self, monitored_folders, stable_folder_id, work=None, rules=None, cache_dir=None):
         super().__init__()
         self.monitored_folders = monitored_folders
+        # 変更フィードのダウンロード先。ここのファイルは取り込んだら消す
+        self.cache_dir = cache_dir
         self.stable_folder_id = stable_folder_id
+        # 複数ノードで分担するときの作業テーブル (work_leases.WorkTable)
+        self.work = work
+        # ハッシュ計算の前に振り落とす規則 (prefilter.Rules)。何も判定しない規則なら呼ばない
+        self.rules = rules if rules else None
+        # contains() / add() はシャード単位のロックで守られるので、全体のロックは不要
         self.processed_hashes = load_processed_hashes()
-        self.processed_lock = threading.Lock()  # processed_hashes への排他アクセス用
+        # 登録中のハッシュ (処理済みに加えるのは登録に成功してから)
+        self._hashes_lock = threading.Lock()
+        self._hashes_in_flight = set()
+        self.relay_client = relay.RelayClient(RELAY_URL) if RELAY_URL else None
         # 並列処理用スレッドプール（必要に応じて max_workers を調整）
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
-    def process_file(self, file_path):
+    def process_file(self, file_path, level=scheduler.LIVE):
         # 対象拡張子のみ処理
-        if not file_path.lower().endswith((".png", ".jpg", ".jpeg")):
+        if not is_target(file_path):
             return
-
-        logging.info(f"ファイル検知: {file_path}")
-        if not wait_for_file_complete(file_path):
-            logging.info(f"書き込み中っぽいのでスキップ: {file_path}")
+        # 落とすファイルにかけるのは stat と先頭 33 バイトの読み込みまで (完了待ちもしない)。
+        # アーカイブは中の画像ごとに manifest で判定する
+        if self.rules is not None and not bundles.is_bundle(file_path):
+            reason = self.rules.check(file_path, self.relative_path(file_path))
+            if reason:
+                logger.debug("規則によりスキップ (%s): %s", reason, file_path)
+                self._discard_cached(file_path)
+                return
+        with scheduler.priority(level), tracing.trace("process_file", path=file_path):
+            profiler.profile_call("process_file", self._process_file, file_path)
+
+    def _process_file(self, file_path):
+        logger.debug("ファイル検知: %s", file_path)
+        with tracing.span("wait_complete"):
+            complete = wait_for_file_complete(file_path)
+        if not complete:
+            logger.info("書き込み中っぽいのでスキップ: %s", file_path)
             return
 
-        file_hash = compute_md5(file_path)
-        if not file_hash:
+        ingest = self._ingest_bundle if bundles.is_bundle(file_path) else self._ingest
+        if self.work is None:
+            finished = ingest(file_path)
+        else:
+            # 複数ノードで分担: ファイルを確保できたノードだけがハッシュを計算する
+            key = self.work_key(file_path)
+            finished = self._with_claim(key, file_path, ingest)
+            if finished is None:
+                logger.debug("他のノードが処理中または処理済み: %s", file_path)
+                # 処理中のノードが失敗したら、このノードの複製から拾い直すので残しておく
+                finished = self.work.is_done(key)
+        if finished == "relay":
+            self._keep_cached_for_relay(file_path)
+        elif finished:
+            self._discard_cached(file_path)
+
+    def _is_cached(self, file_path):
+        return bool(self.cache_dir) and file_path.startswith(os.path.join(self.cache_dir, ""))
+
+    def _keep_cached_for_relay(self, file_path):
+        """中継デーモンは後でこのパスから登録するので、消さないよう目印を置きます (古くなったら起動時に消す)。"""
+        if not self._is_cached(file_path) or os.path.dirname(file_path) == self.cache_dir:
             return
-
-        # すでに処理済みかチェック（排他制御）
-        with self.processed_lock:
-            if file_hash in self.processed_hashes:
-                logging.info(f"すでに処理済み: {file_path}")
-                return
-            self.processed_hashes.add(file_hash)
+        try:
+            with open(os.path.join(os.path.dirname(file_path), RELAYED_MARKER), "w"):
+                pass
+        except OSError as e:
+            logger.warning(f"中継デーモンへ渡したファイルの目印を置けません: {file_path}, err={e}")
+
+    def _discard_cached(self, file_path):
+        """変更フィードでダウンロードしたファイル (cache_dir/<fileId>/<名前>) を消します。
+
+        残しておくとキャッシュが増え続け、起動時の initial_scan でハッシュを計算し直すことになる。
+        中継デーモンへ渡したもの (目印があるもの) は、登録が済むまで残す。
+        """
+        if not self._is_cached(file_path):
+            return
+        if os.path.exists(os.path.join(os.path.dirname(file_path), RELAYED_MARKER)):
+            return
+        try:
+            os.remove(file_path)
+            if os.path.dirname(file_path) != self.cache_dir:
+                os.rmdir(os.path.dirname(file_path))
+        except OSError:
+            pass
+
+    def relative_path(self, file_path):
+        """監視フォルダからの相対パス ("/" 区切り。どの監視フォルダの下でもなければそのまま)"""
+        rel = file_path
+        for root in self.monitored_folders:
+            if file_path.startswith(os.path.join(root, "")):
+                rel = os.path.relpath(file_path, root)
+                break
+        return rel.replace(os.sep, "/")
+
+    def work_key(self, file_path):
+        """ノード間で共通のファイルのキー (監視フォルダからの相対パス + サイズ + 更新時刻)"""
+        st = os.stat(file_path)
+        return f"file:{self.relative_path(file_path)}|{st.st_size}|{int(st.st_mtime)}"
+
+    def _with_claim(self, key, file_path, fn, *args):
+        """作業を確保して fn を実行します。確保できなければ None。
+
+        fn が True を返したら完了として記録し、False (やり直すべき失敗) や例外なら手放します。
+        """
+        if not self.work.claim(key, file_path):
+            return None
+        finished = False
+        try:
+            finished = fn(file_path, *args)
+        finally:
+            if finished:
+                self.work.complete(key)
+            else:
+                self.work.release(key)
+        return finished
+
+    def _ingest(self, file_path):
+        """処理を終えたら (重複で飛ばした場合も含む) True、やり直すべきなら False を返します。
+
+        中継デーモンへ渡した場合は "relay" (ファイルは中継デーモンが登録するまで消さない)。
+        """
+        with tracing.span("hash"):
+            file_hash = compute_md5(file_path)
+        if not file_hash:
+            return False
+        if self.work is None:
+            return self._ingest_hashed(file_path, file_hash)
+        # 別のパスにある同じ内容のファイルも、1 ノードだけがアップロードする
+        result = self._with_claim("md5:" + file_hash, file_path, self._ingest_hashed, file_hash)
+        if result is None:
+            logger.debug("同じ内容を他のノードが処理中または処理済み: %s", file_path)
+            return True
+        return result
+
+    def _ingest_hashed(self, file_path, file_hash):
+        """登録できた (または処理済みだった) ら True、中継デーモンへ渡したら "relay"、
+        やり直すべきなら False を返します。
+
+        処理済みとして記録するのは登録に成功してからなので、失敗したファイルは再試行される。
+        """
+        # 同じ内容の別ファイルをこのノードの複数スレッドで同時に登録しない
+        with self._hashes_lock:
+            if self.processed_hashes.contains(file_hash):
+                logger.debug("すでに処理済み: %s", file_path)
+                return True
+            if file_hash in self._hashes_in_flight:
+                logger.debug("同じ内容を処理中: %s", file_path)
+                return True
+            self._hashes_in_flight.add(file_hash)
+        try:
+            added = self._add_file(file_path, file_hash)
+            if added:
+                self._mark_processed(file_hash)
+        finally:
+            with self._hashes_lock:
+                self._hashes_in_flight.discard(file_hash)
+        return added
+
+    def _add_file(self, file_path, file_hash):
+        """1 枚を Eagle へ登録し、成功したら True、中継デーモンへ渡したら "relay" を返します。"""
+        # Eagle に既にある画像 (別のマシンやバックフィルで登録済み) は送らない
+        index = item_index.get_index(EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+        if SKIP_EXISTING and index.is_loaded:
+            existing_id = index.find_file(file_path, md5=file_hash)
+            if existing_id is not None:
+                logger.debug("Eagle に登録済み (id=%s): %s", existing_id, file_path)
+                return True
 
         # 画像読み込み & メタ情報抽出
         try:
-            im = Image.open(file_path)
-            annotation = im.info.get("Annotation", "")
-            tags_str = im.info.get("Tags", "")
-            tags = [t.strip() for t in tags_str.split(",") if t.strip()]
+            with tracing.span("extract"):
+                im = Image.open(file_path)
+                annotation = im.info.get("Annotation", "")
+                tags_str = im.info.get("Tags", "")
+                tags = [t.strip() for t in tags_str.split(",") if t.strip()]
 
             # ファイル更新日時から日付フォルダを決定
             date_dir = get_date_from_file_mtime(file_path)
-            logging.info(f"サブフォルダ決定: '{date_dir}'")
+            logger.debug("サブフォルダ決定: '%s'", date_dir)
         except Exception as e:
-            logging.error(f"画像メタ情報抽出失敗: {file_path}, err={e}")
-            return
-
-        # stable diffusion 配下のサブフォルダ作成 or 既存使用
-        target_folder_id = find_or_create_subfolder(
-            parent_id=self.stable_folder_id, subfolder_name=date_dir
-        )
+            logger.error(f"画像メタ情報抽出失敗: {file_path}, err={e}")
+            return False
 
-        # 画像を Eagle に登録
         item = api_item.EAGLE_ITEM_PATH(
             filefullpath=file_path,
             filename=os.path.basename(file_path),
             annotation=annotation,
             tags=tags,
         )
-        resp = api_item.add_from_path(
-            item=item,
-            folderId=target_folder_id,
-            server_url=EAGLE_SERVER_URL,
-            port=EAGLE_SERVER_PORT,
-        )
+
+        # 中継デーモンがあれば、フォルダの解決と送信はそちらに任せる
+        if self.relay_client is not None:
+            try:
+                with tracing.span("relay"):
+                    self.relay_client.enqueue(
+                        item,
+                        date_dir,
+                        server_url=EAGLE_SERVER_URL,
+                        port=EAGLE_SERVER_PORT,
+                    )
+                logger.info("中継デーモンへ受け渡し: %s", file_path)
+                index.record_added_file(file_path, md5=file_hash)
+                return "relay"
+            except relay.RelayUnavailable as e:
+                logger.warning(f"中継デーモンに渡せないため直接送信します: {e}")
+            except relay.RelayError as e:
+                # 受け取られているかもしれないので直接は送らない (中継デーモンはパスで重複を除く)
+                logger.error(f"中継デーモンへの受け渡し失敗 (後で再試行): {file_path}, err={e}")
+                return False
+
+        # stable diffusion 配下のサブフォルダ作成 or 既存使用
+        with tracing.span("folder", folder=date_dir):
+            target_folder_id = find_or_create_subfolder(
+                parent_id=self.stable_folder_id, subfolder_name=date_dir
+            )
+
+        # 画像を Eagle に登録
+        with tracing.span("upload") as span_args:
+            resp = api_item.add_item(
+                item=item,
+                folderId=target_folder_id,
+                server_url=EAGLE_SERVER_URL,
+                port=EAGLE_SERVER_PORT,
+            )
+            span_args["status"] = resp.status_code
         if resp.status_code == 200:
-            logging.info(f"Eagle 転送成功: {file_path}")
-        else:
-            logging.error(
-                f"Eagle 転送失敗: {file_path}, status={resp.status_code}, text={resp.text}"
+            logger.info("Eagle 転送成功: %s", file_path)
+            try:
+                data = resp.json().get("data")
+            except (ValueError, AttributeError):
+                data = None
+            index.record_added_file(
+                file_path, md5=file_hash, item_id=data if isinstance(data, str) else None
             )
+            return True
+        logger.error(
+            f"Eagle 転送失敗: {file_path}, status={resp.status_code}, text={resp.text}"
+        )
+        return False
+
+    def _ingest_bundle(self, bundle_path):
+        """アーカイブの manifest を読み、未処理の画像だけを取り出して日付フォルダごとにまとめて登録します。
 
+        注釈・タグ・MD5 は manifest にあるので、画像を開いたりハッシュを計算し直したりしません。
+        複数ノードの分担はアーカイブ単位で行います (_process_file で確保済み)。
+        取り出しか登録に失敗した画像が 1 枚でもあれば False を返し、アーカイブごと再試行します
+        (登録できた画像は処理済みとして記録するので、再試行では飛ばされる)。
+        """
+        try:
+            with tracing.span("bundle_manifest"):
+                tar = tarfile.open(bundle_path, "r:")
+                manifest = bundles.read_manifest(tar)
+        except (OSError, KeyError, ValueError, tarfile.TarError) as e:
+            logger.error(f"アーカイブの manifest を読めません: {bundle_path}, err={e}")
+            return False
+
+        index = item_index.get_index(EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+        name = os.path.basename(bundle_path)[: -len(bundles.BUNDLE_SUFFIX)]
+        dest_dir = os.path.join(BUNDLE_EXTRACT_DIR, name)
+        batches = {}  # {日付: [(item, entry)]}
+        claimed = []  # このアーカイブで登録中にしたハッシュ
+        skipped = 0
+        failed = 0
+        try:
+            with tar, tracing.span("bundle_extract") as span_args:
+                for entry in manifest.get("entries", []):
+                    reason = None
+                    if self.rules is not None:
+                        reason = self.rules.check_name(
+                            entry["filename"], size=entry["size"]
+                        ) or self.rules.check_dims(entry.get("width"), entry.get("height"))
+                    if reason:
+                        skipped += 1
+                        continue
+                    with self._hashes_lock:
+                        if (
+                            self.processed_hashes.contains(entry["md5"])
+                            or entry["md5"] in self._hashes_in_flight
+                        ):
+                            skipped += 1
+                            continue
+                        self._hashes_in_flight.add(entry["md5"])
+                    claimed.append(entry["md5"])
+                    if SKIP_EXISTING and index.is_loaded:
+                        existing_id = index.find_file(
+                            entry["filename"], md5=entry["md5"], size=entry["size"]
+                        )
+                        if existing_id is not None:
+                            self._mark_processed(entry["md5"])
+                            skipped += 1
+                            continue
+                    try:
+                        os.makedirs(dest_dir, exist_ok=True)
+                        path = extract_bundle_member(tar, entry, dest_dir)
+                    except (OSError, KeyError, tarfile.TarError) as e:
+                        logger.error(f"アーカイブから取り出せません: {entry['member']}, err={e}")
+                        failed += 1
+                        continue
+                    item = api_item.EAGLE_ITEM_PATH(
+                        filefullpath=path,
+                        filename=entry["filename"],
+                        annotation=entry.get("annotation", ""),
+                        tags=entry.get("tags", []),
+                    )
+                    date_dir = entry.get("date") or manifest.get("date")
+                    batches.setdefault(date_dir, []).append((item, entry))
+                span_args["extracted"] = sum(len(b) for b in batches.values())
+                span_args["skipped"] = skipped
+
+            added = 0
+            relayed = False
+            for date_dir, batch in batches.items():
+                registered, via_relay = self._add_batch(date_dir, batch, index)
+                for entry in registered:
+                    self._mark_processed(entry["md5"])
+                added += len(registered)
+                failed += len(batch) - len(registered)
+                relayed = relayed or via_relay
+        finally:
+            with self._hashes_lock:
+                self._hashes_in_flight.difference_update(claimed)
+
+        # 中継デーモンは後でこのパスから登録するので、渡した画像は残す (起動時に古いものを消す)
+        if not relayed:
+            shutil.rmtree(dest_dir, ignore_errors=True)
+        if failed:
+            logger.error(
+                "アーカイブの取り込みに失敗した画像があります (後で再試行): %s (%d件、失敗 %d件)",
+                bundle_path,
+                added,
+                failed,
+            )
+            return False
+        logger.info(
+            "アーカイブを取り込みました: %s (%d件、スキップ %d件)", bundle_path, added, skipped
+        )
+        return True
+
+    def _mark_processed(self, file_hash):
+        self.processed_hashes.add(file_hash)
         save_processed_hash(file_hash)
 
+    def _add_batch(self, date_dir, batch, index):
+        """取り出した画像を 1 つの日付フォルダへまとめて登録します。
+
+        Returns:
+            (登録できた entry のリスト, 中継デーモンへ渡したか) のタプル
+        """
+        if self.relay_client is not None:
+            try:
+                with tracing.span("relay", count=len(batch)):
+                    self.relay_client.enqueue_many(
+                        [
+                            relay.make_job(item, date_dir, EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+                            for item, _entry in batch
+                        ]
+                    )
+                for item, entry in batch:
+                    index.record_added_file(entry["filename"], md5=entry["md5"], size=entry["size"])
+                logger.info("中継デーモンへ受け渡し: %s (%d件)", date_dir, len(batch))
+                return [entry for _item, entry in batch], True
+            except relay.RelayUnavailable as e:
+                logger.warning(f"中継デーモンに渡せないため直接送信します: {e}")
+            except relay.RelayError as e:
+                # 受け取られているかもしれないので直接は送らない (中継デーモンはパスで重複を除く)
+                logger.error(f"中継デーモンへの受け渡し失敗 (後で再試行): {date_dir}, err={e}")
+                return [], False
+
+        with tracing.span("folder", folder=date_dir):
+            target_folder_id = find_or_create_subfolder(
+                parent_id=self.stable_folder_id, subfolder_name=date_dir
+            )
+        with tracing.span("upload", count=len(batch)):
+            r_posts = api_item.add_items(
+                [item for item, _entry in batch],
+                folderId=target_folder_id,
+                server_url=EAGLE_SERVER_URL,
+                port=EAGLE_SERVER_PORT,
+            )
+        # リモートの Eagle へは 1 件ずつ送るので、一部だけ失敗することがある
+        registered = [entry for (_item, entry), r in zip(batch, r_posts) if api_item.is_success(r)]
+        for entry in registered:
+            index.record_added_file(entry["filename"], md5=entry["md5"], size=entry["size"])
+        if len(registered) < len(batch):
+            errors = [r for r in r_posts if not api_item.is_success(r)]
+            logger.error(
+                f"Eagle 転送失敗: {date_dir} ({len(batch) - len(registered)}/{len(batch)}件), resp={errors}"
+            )
+        else:
+            logger.info("Eagle 転送成功: %s (%d件)", date_dir, len(batch))
+        return registered, False
+
     # イベント発生時はスレッドプールにて非同期処理
     def on_created(self, event):
         if not event.is_directory:
@@ -275,13 +763,39 @@ def initial_scan(folder_list, handler):
     for fol in folder_list:
         for root, dirs, files in os.walk(fol):
             for fn in files:
-                if fn.lower().endswith((".png", ".jpg", ".jpeg")):
-                    fpath = os.path.join(root, fn)
-                    futures.append(handler.executor.submit(handler.process_file, fpath))
+                fpath = os.path.join(root, fn)
+                if is_target(fpath):
+                    futures.append(
+                        handler.executor.submit(
+                            handler.process_file, fpath, scheduler.BACKFILL
+                        )
+                    )
     if futures:
         concurrent.futures.wait(futures)
 
 
+def recover_abandoned_work(work, handler):
+    """期限切れ (ノードが落ちた) や手放された作業のうち、このノードから見えるファイルを処理し直す"""
+    submitted = {}  # {key: 投入した時刻} 同じ作業を続けて投入しない
+    while True:
+        time.sleep(work.lease_seconds / 2)
+        now = time.time()
+        try:
+            rows = work.expired(limit=1000)
+        except Exception as e:
+            logger.error(f"作業テーブルの参照失敗: {e}")
+            continue
+        for key, path in rows:
+            if now - submitted.get(key, 0) < work.lease_seconds * 2:
+                continue
+            submitted[key] = now
+            if path and os.path.exists(path):
+                logger.info(f"中断された作業を拾い直します: {path}")
+                handler.executor.submit(handler.process_file, path, scheduler.BACKFILL)
+        for key in [k for k, t in submitted.items() if now - t > work.lease_seconds * 10]:
+            del submitted[key]
+
+
 # ------------------------------------------------------------------------
 # 6) メインエントリ
 # ------------------------------------------------------------------------
@@ -295,8 +809,10 @@ def main():
                 if path_:
                     folder_list.append(path_)
 
-    if not folder_list:
-        logging.error("EAGLE_GOOGLE_DRIVE_FOLDER* の環境変数が設定されていません。")
+    if not folder_list and not DRIVE_CHANGES_CREDENTIALS:
+        logger.error(
+            "EAGLE_GOOGLE_DRIVE_FOLDER* か EAGLE_DRIVE_CHANGES_CREDENTIALS の環境変数が設定されていません。"
+        )
         sys.exit(1)
 
     valid_folders = []
@@ -304,34 +820,139 @@ def main():
         if os.path.exists(f_):
             valid_folders.append(os.path.normpath(f_))
         else:
-            logging.error(f"監視対象フォルダが存在しません: {f_}")
-    if not valid_folders:
-        logging.error("監視対象フォルダが一つも有効ではありません。終了します。")
+            logger.error(f"監視対象フォルダが存在しません: {f_}")
+    if not valid_folders and not DRIVE_CHANGES_CREDENTIALS:
+        logger.error("監視対象フォルダが一つも有効ではありません。終了します。")
         sys.exit(1)
 
+    tracing.configure(TRACE_FILE, fmt=TRACE_FORMAT, sample_rate=TRACE_SAMPLE_RATE)
+    hooks.set_tracer(tracing)
+    scheduler.set_default_priority(scheduler.LIVE)
+    scheduler.configure(rate=RATE_LIMIT, adaptive=ADAPTIVE_THROTTLE)
+    profiler.configure(PROFILE_DIR, every_n=PROFILE_EVERY_N)
+    profiler.install_signal_handler()
+    profiler.watch_control_file(PROFILE_CONTROL_FILE)
+    if tracing.is_enabled():
+        logger.info(f"処理トレース出力: {TRACE_FILE} (rate={TRACE_SAMPLE_RATE})")
+
     # B) stable diffusion フォルダID の取得
     stable_diff_folder_id = fetch_or_create_stable_diffusion_folder()
     if not stable_diff_folder_id:
-        logging.error(f"'{STABLE_DIFFUSION_NAME}' フォルダID を取得できず。終了。")
+        logger.error(f"'{STABLE_DIFFUSION_NAME}' フォルダID を取得できず。終了。")
         sys.exit(1)
 
+    # Eagle の既存項目を一括で読み込む (以降は自分の追加結果で更新する)
+    if SKIP_EXISTING:
+        index = item_index.get_index(EAGLE_SERVER_URL, EAGLE_SERVER_PORT)
+        if index.fill():
+            logger.info(f"Eagle の既存項目を読み込みました: {len(index)} 件")
+        else:
+            logger.warning("Eagle の既存項目を取得できず。重複チェックなしで続行します。")
+
+    # 今日の日付フォルダを解決し、0時前には翌日分を作っておく
+    prewarm.PrewarmScheduler(
+        lambda: [
+            (
+                "eagle",
+                lambda d: bool(find_or_create_subfolder(stable_diff_folder_id, d)),
+            )
+        ]
+    ).start()
+
+    # 複数ノードで分担する場合は共有の作業テーブルを開き、落ちたノードの作業を拾い直す
+    work = None
+    if WORK_DB:
+        work = work_leases.WorkTable(
+            WORK_DB,
+            node_id=NODE_ID or None,
+            lease_seconds=LEASE_SECONDS,
+            max_attempts=WORK_MAX_ATTEMPTS,
+        )
+        logger.info(f"作業テーブル: {WORK_DB} (ノード: {work.node_id}) {work.counts()}")
+
+    rules = prefilter.Rules(
+        include=FILTER_INCLUDE,
+        exclude=FILTER_EXCLUDE,
+        exclude_name_regex=FILTER_NAME_EXCLUDE,
+        min_size=FILTER_MIN_SIZE,
+        max_size=FILTER_MAX_SIZE,
+        min_width=FILTER_MIN_WIDTH,
+        min_height=FILTER_MIN_HEIGHT,
+        max_width=FILTER_MAX_WIDTH,
+        max_height=FILTER_MAX_HEIGHT,
+    )
+
     # C) Watchdog 開始
-    handler = NewFileHandler(valid_folders, stable_diff_folder_id)
+    cache_folders = [DRIVE_CACHE_DIR] if DRIVE_CHANGES_CREDENTIALS else []
+    handler = NewFileHandler(
+        valid_folders + cache_folders,
+        stable_diff_folder_id,
+        work=work,
+        rules=rules,
+        cache_dir=DRIVE_CACHE_DIR if DRIVE_CHANGES_CREDENTIALS else None,
+    )
+    if work is not None:
+        threading.Thread(
+            target=recover_abandoned_work,
+            args=(work, handler),
+            name="eagle-work-recovery",
+            daemon=True,
+        ).start()
     observer = Observer()
     for vf in valid_folders:
         observer.schedule(handler, vf, recursive=True)
-        logging.info(f"監視開始: {vf}")
+        logger.info(f"監視開始: {vf}")
     observer.start()
 
-    # D) 初回スキャン (既存ファイルも並列処理で実施)
-    initial_scan(valid_folders, handler)
+    pruned = prune_old_dirs(BUNDLE_EXTRACT_DIR)
+    if DRIVE_CHANGES_CREDENTIALS:
+        pruned += prune_old_dirs(DRIVE_CACHE_DIR, marker=RELAYED_MARKER)
+    if pruned:
+        logger.info(f"中継デーモンへ渡した古い画像を削除しました: {pruned}件")
+
+    # D) 初回スキャン (既存ファイルも並列処理で実施)。前回ダウンロードしたまま
+    #    処理されなかった変更フィードのファイルも拾う
+    initial_scan([f for f in handler.monitored_folders if os.path.isdir(f)], handler)
+
+    # E) Drive の変更フィード。処理済みのハッシュ (md5Checksum) のファイルはダウンロードしない
+    changes = None
+    if DRIVE_CHANGES_CREDENTIALS:
+        changes = drive_changes.ChangesSource(
+            drive_changes.DriveApiBackend(DRIVE_CHANGES_CREDENTIALS),
+            DRIVE_CACHE_DIR,
+            DRIVE_TOKEN_FILE,
+            on_file=lambda p: handler.executor.submit(handler.process_file, p),
+            folder_ids=DRIVE_FOLDER_IDS,
+            should_download=lambda f: not (
+                (
+                    f.get("md5Checksum")
+                    and handler.processed_hashes.contains(f["md5Checksum"])
+                )
+                # 名前とサイズの規則は一覧の情報だけで判定し、落とすファイルはダウンロードしない
+                # (アーカイブは中の画像ごとに判定する)
+                or (
+                    not bundles.is_bundle(f.get("name", ""))
+                    and rules.check_name(
+                        f.get("name", ""), size=int(f["size"]) if f.get("size") else None
+                    )
+                )
+            ),
+            poll_interval=DRIVE_POLL_INTERVAL,
+            exts=IMAGE_EXTS + (bundles.BUNDLE_SUFFIX,),
+        )
+        changes.start()
+        logger.info(f"Drive の変更フィードを監視開始: {DRIVE_FOLDER_IDS or 'マイドライブ全体'}")
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        logging.info("KeyboardInterrupt: 監視停止中...")
+        logger.info("KeyboardInterrupt: 監視停止中...")
         observer.stop()
+        if changes is not None:
+            changes.stop(5)
+        if work is not None:
+            work.stop()
     observer.join()
 
 
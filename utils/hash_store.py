@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+処理済みファイルのハッシュ (MD5) を少ないメモリで保持する集合
+
+- DigestSet     : 16 バイトの生ダイジェストを先頭 1 バイトで 256 個のシャードに分け、
+                  シャードごとにソート済みの bytes として持つ。1 件あたりほぼ 16 バイト。
+                  参照はロックを取らず、追加はシャード単位のロックで行う
+- BloomFilter   : ダイジェストの一部をそのままハッシュ値として使うブルームフィルター
+- DiskDigestSet : ブルームフィルターだけをメモリに置き、陽性のときだけ SQLite で正確に確認する
+                  (1 件あたり約 1.2 バイト。数千万件規模向け)
+
+どちらの集合も contains(hex) / add(hex) -> bool (新規なら True) を持ち、
+add は「無ければ追加」を不可分に行うので、ワーカー間の重複処理の判定にそのまま使える。
+"""
+import math
+import os
+import sqlite3
+import threading
+
+DIGEST_SIZE = 16
+NUM_SHARDS = 256
+
+
+def to_digest(hex_digest):
+    """32 文字の16進文字列を 16 バイトに変換する (不正な値は None)"""
+    try:
+        digest = bytes.fromhex(hex_digest.strip())
+    except (ValueError, AttributeError):
+        return None
+    return digest if len(digest) == DIGEST_SIZE else None
+
+
+def iter_hex_file(path, offset=0, end=None):
+    """processed_files.txt の各行を 16 バイトのダイジェストとして返す
+
+    Args:
+        path: ファイル
+        offset: 読み始めるバイト位置
+        end: 読み終えた位置を受け取るリスト (end[0] に設定する)
+    """
+    if not os.path.exists(path):
+        return
+    pos = offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # 書き込み途中の行は次回に読む
+            pos += len(line)
+            digest = to_digest(line.decode("ascii", "ignore"))
+            if digest is not None:
+                yield digest
+    if end is not None:
+        end[:] = [pos]
+
+
+class _Shard:
+    __slots__ = ("base", "pending", "lock")
+
+    def __init__(self):
+        self.base = b""  # ソート済みの 16 バイト列の連結 (差し替えのみで変更しない)
+        self.pending = set()  # マージ前に追加された分
+        self.lock = threading.Lock()
+
+    def _in_base(self, digest):
+        base = self.base
+        lo, hi = 0, len(base) // DIGEST_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = base[mid * DIGEST_SIZE : (mid + 1) * DIGEST_SIZE]
+            if cur < digest:
+                lo = mid + 1
+            elif cur > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def contains(self, digest):
+        # マージ時は base を差し替えてから pending を消すので、pending → base の順に見れば取りこぼさない
+        return digest in self.pending or self._in_base(digest)
+
+    def merge(self):
+        base = self.base
+        entries = [base[i : i + DIGEST_SIZE] for i in range(0, len(base), DIGEST_SIZE)]
+        merged = self.pending.copy()
+        entries.extend(merged)
+        entries.sort()
+        self.base = b"".join(entries)
+        self.pending -= merged
+
+
+class DigestSet:
+    def __init__(self, merge_threshold=512):
+        """
+        Args:
+            merge_threshold: シャードごとに、追加分がこの件数を超えたらソート済み配列へまとめる
+        """
+        self.merge_threshold = merge_threshold
+        self._shards = [_Shard() for _ in range(NUM_SHARDS)]
+
+    def bulk_load(self, digests):
+        """起動時の一括読み込み。シャードごとに 1 回だけソートする"""
+        buckets = [[] for _ in range(NUM_SHARDS)]
+        for digest in digests:
+            buckets[digest[0]].append(digest)
+        for shard, bucket in zip(self._shards, buckets):
+            if not bucket:
+                continue
+            with shard.lock:
+                base = shard.base
+                # 重複行を除いてソートし直す
+                entries = set(bucket)
+                entries.update(base[i : i + DIGEST_SIZE] for i in range(0, len(base), DIGEST_SIZE))
+                entries -= shard.pending
+                shard.base = b"".join(sorted(entries))
+
+    def contains_digest(self, digest):
+        return self._shards[digest[0]].contains(digest)
+
+    def add_digest(self, digest):
+        shard = self._shards[digest[0]]
+        with shard.lock:
+            if shard.contains(digest):
+                return False
+            shard.pending.add(digest)
+            if len(shard.pending) >= self.merge_threshold:
+                shard.merge()
+        return True
+
+    def contains(self, hex_digest):
+        digest = to_digest(hex_digest)
+        return digest is not None and self.contains_digest(digest)
+
+    def add(self, hex_digest):
+        digest = to_digest(hex_digest)
+        return digest is not None and self.add_digest(digest)
+
+    __contains__ = contains
+
+    def __len__(self):
+        return sum(
+            len(s.base) // DIGEST_SIZE + len(s.pending) for s in self._shards
+        )
+
+    def memory_bytes(self):
+        """ダイジェスト本体が使うおおよそのバイト数 (マージ前の分は set の分も含む)"""
+        return sum(len(s.base) + len(s.pending) * 100 for s in self._shards)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Args:
+            capacity: 想定する件数
+            error_rate: 偽陽性率
+        """
+        capacity = max(int(capacity), 1)
+        self.num_bits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, digest):
+        # MD5 は一様なので、前半と後半の 8 バイトをそのまま double hashing に使う
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+
+class DiskDigestSet:
+    def __init__(self, db_path, capacity=10_000_000, error_rate=0.01):
+        """ブルームフィルター + SQLite による正確な確認。
+
+        Args:
+            db_path: ダイジェストを保存する SQLite ファイル
+            capacity: ブルームフィルターの想定件数 (超えると偽陽性率が上がり SQLite の参照が増える)
+            error_rate: ブルームフィルターの偽陽性率
+        """
+        self.db_path = db_path
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed (digest BLOB PRIMARY KEY) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        conn.commit()
+        for (digest,) in conn.execute("SELECT digest FROM processed"):
+            self._bloom.add(digest)
+
+    def _conn(self):
+        # 参照はスレッドごとの接続で並行に行う
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def bulk_load(self, digests):
+        conn = self._conn()
+        with self._lock:
+            batch = []
+            for digest in digests:
+                batch.append((digest,))
+                self._bloom.add(digest)
+                if len(batch) >= 10000:
+                    conn.executemany("INSERT OR IGNORE INTO processed VALUES (?)", batch)
+                    batch = []
+            if batch:
+                conn.executemany("INSERT OR IGNORE INTO processed VALUES (?)", batch)
+            conn.commit()
+
+    def get_meta(self, key, default=0):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+            conn.commit()
+
+    def contains_digest(self, digest):
+        if digest not in self._bloom:
+            return False
+        row = self._conn().execute(
+            "SELECT 1 FROM processed WHERE digest = ?", (digest,)
+        ).fetchone()
+        return row is not None
+
+    def add_digest(self, digest):
+        with self._lock:
+            conn = self._conn()
+            cur = conn.execute("INSERT OR IGNORE INTO processed VALUES (?)", (digest,))
+            conn.commit()
+            self._bloom.add(digest)
+            return cur.rowcount == 1
+
+    def contains(self, hex_digest):
+        digest = to_digest(hex_digest)
+        return digest is not None and self.contains_digest(digest)
+
+    def add(self, hex_digest):
+        digest = to_digest(hex_digest)
+        return digest is not None and self.add_digest(digest)
+
+    __contains__ = contains
+
+
+def open_store(txt_path, mode="memory", db_path=None, capacity=10_000_000):
+    """processed_files.txt から処理済みハッシュの集合を作る。
+
+    Args:
+        txt_path: 16進のハッシュを 1 行 1 件で追記しているファイル
+        mode: "memory" (DigestSet) / "bloom" (DiskDigestSet)
+        db_path: mode="bloom" の SQLite ファイル (省略時は txt_path + ".sqlite3")
+        capacity: mode="bloom" のブルームフィルターの想定件数
+    """
+    if mode != "bloom":
+        store = DigestSet()
+        store.bulk_load(iter_hex_file(txt_path))
+        return store
+
+    store = DiskDigestSet(db_path or txt_path + ".sqlite3", capacity=capacity)
+    # SQLite へ取り込み済みの位置から後ろ (前回の終了後に追記された分) だけを読む
+    offset = store.get_meta("txt_offset", 0)
+    if not os.path.exists(txt_path) or os.path.getsize(txt_path) < offset:
+        offset = 0  # ファイルが作り直された
+    end = [offset]
+    store.bulk_load(iter_hex_file(txt_path, offset, end))
+    store.set_meta("txt_offset", end[0])
+    return store
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+ハッシュ計算や画像の読み込みの前に、取り込まないファイルを安く振り落とす規則
+
+判定は安い順に行い、落とされたファイルにかかるのは最大で stat 1 回と 33 バイトの読み込み 1 回。
+1. 名前だけで判定 : include / exclude の glob、ファイル名の正規表現 (I/O なし)
+2. stat           : サイズの下限・上限
+3. ヘッダー       : PNG の IHDR (先頭 33 バイト) の幅・高さの下限・上限
+                    (PNG 以外や読み切れなかった場合はこの判定を飛ばす)
+
+glob は "/" を含まなければファイル名に、含めば監視フォルダからの相対パスに対して照合する。
+glob 群は 1 つの正規表現にまとめて compile するので、規則が増えても照合は 1 回で済む。
+"""
+import fnmatch
+import os
+import re
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_HEADER_SIZE = 33  # シグネチャ 8 + 長さ 4 + "IHDR" 4 + 幅 4 + 高さ 4 + 残り 9
+
+# 書き込み途中・一時ファイル (既定で除外する)
+DEFAULT_EXCLUDE = ["*.tmp", "*.part", "*.crdownload", "*.download", "~*", ".*"]
+
+
+def split_list(value):
+    """カンマ区切りの文字列 (または list) を空要素を除いた list にする"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip() for v in value if v and v.strip()]
+
+
+def _compile_globs(patterns):
+    """glob の list を (ファイル名用, 相対パス用) の正規表現にまとめる (無ければ None)"""
+    name_globs = [p for p in patterns if "/" not in p]
+    path_globs = [p for p in patterns if "/" in p]
+
+    def _join(globs):
+        if not globs:
+            return None
+        return re.compile("|".join(f"(?:{fnmatch.translate(g)})" for g in globs), re.IGNORECASE)
+
+    return _join(name_globs), _join(path_globs)
+
+
+def read_png_size(path):
+    """PNG の IHDR から (幅, 高さ) を読む。PNG でなければ False、読み切れなければ None"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(PNG_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(head) < 8:
+        return None
+    if head[:8] != PNG_SIGNATURE:
+        return False
+    if len(head) < 24 or head[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", head[16:24])
+
+
+class Rules:
+    def __init__(
+        self,
+        include=None,
+        exclude=DEFAULT_EXCLUDE,
+        exclude_name_regex=None,
+        min_size=0,
+        max_size=0,
+        min_width=0,
+        min_height=0,
+        max_width=0,
+        max_height=0,
+    ):
+        """
+        Args:
+            include: 取り込む glob (指定するとどれかに一致するものだけ)
+            exclude: 取り込まない glob
+            exclude_name_regex: 一致したら取り込まないファイル名の正規表現 (例: "^grid-")
+            min_size, max_size: サイズの下限・上限 (バイト、0 で無制限)
+            min_width, min_height, max_width, max_height: PNG の幅・高さの下限・上限 (0 で無制限)
+        """
+        include = split_list(include)
+        self._include = _compile_globs(include) if include else None
+        self._exclude = _compile_globs(split_list(exclude))
+        self._name_re = re.compile(exclude_name_regex) if exclude_name_regex else None
+        self.min_size = int(min_size or 0)
+        self.max_size = int(max_size or 0)
+        self.min_width = int(min_width or 0)
+        self.min_height = int(min_height or 0)
+        self.max_width = int(max_width or 0)
+        self.max_height = int(max_height or 0)
+        self._check_size = bool(self.min_size or self.max_size)
+        self._check_dims = bool(
+            self.min_width or self.min_height or self.max_width or self.max_height
+        )
+
+    @staticmethod
+    def _match(compiled, name, rel):
+        name_re, path_re = compiled
+        return bool((name_re and name_re.match(name)) or (path_re and path_re.match(rel)))
+
+    def check_name(self, name, rel=None, size=None):
+        """I/O なしで判定できる規則 (名前と、分かっていればサイズ) だけを見ます。
+
+        Drive の変更フィードのように、ファイル本体を取得する前の一覧にも使えます。
+        取り込まないなら理由の文字列、取り込むなら None を返します。
+        """
+        rel = rel or name
+        if self._include is not None and not self._match(self._include, name, rel):
+            return "include に一致しない"
+        if self._match(self._exclude, name, rel):
+            return "exclude に一致"
+        if self._name_re is not None and self._name_re.search(name):
+            return "ファイル名が除外パターンに一致"
+        if size is not None:
+            return self._size_reason(size)
+        return None
+
+    def _size_reason(self, size):
+        if self.min_size and size < self.min_size:
+            return f"サイズが小さい ({size})"
+        if self.max_size and size > self.max_size:
+            return f"サイズが大きい ({size})"
+        return None
+
+    def check(self, path, rel=None):
+        """取り込まないなら理由の文字列、取り込むなら None を返します。
+
+        Args:
+            path: ファイルのパス
+            rel: 監視フォルダからの相対パス ("/" 区切り、省略時はファイル名)
+        """
+        name = os.path.basename(path)
+        reason = self.check_name(name, rel)
+        if reason:
+            return reason
+
+        if self._check_size:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                return "stat できない"
+            reason = self._size_reason(size)
+            if reason:
+                return reason
+
+        if self._check_dims and name.lower().endswith(".png"):
+            dims = read_png_size(path)
+            if dims is False:
+                return "PNG ではない"
+            if dims:
+                return self.check_dims(*dims)
+        return None
+
+    def check_dims(self, width, height):
+        """幅・高さの規則だけを見ます (分からなければ None を渡す)。"""
+        if not self._check_dims or not width or not height:
+            return None
+        if (self.min_width and width < self.min_width) or (
+            self.min_height and height < self.min_height
+        ):
+            return f"画像が小さい ({width}x{height})"
+        if (self.max_width and width > self.max_width) or (
+            self.max_height and height > self.max_height
+        ):
+            return f"画像が大きい ({width}x{height})"
+        return None
+
+    def __bool__(self):
+        # 何も判定しない規則なら呼び出し自体を省ける
+        return bool(
+            self._include is not None
+            or any(self._exclude)
+            or self._name_re
+            or self._check_size
+            or self._check_dims
+        )
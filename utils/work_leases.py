@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+複数の監視スクリプト (ノード) で取り込みを分担するための作業テーブル
+
+共有ストレージ上の SQLite に「誰がどの作業を持っているか」を記録する。
+- claim(key)     : 作業を期限付き (lease_seconds) で確保する。未処理か、他のノードの期限が
+                   切れている (ノードが落ちた) 場合だけ確保できる。完了済みなら確保できない
+- heartbeat      : 確保中の作業の期限をバックグラウンドで延長し続ける
+- complete(key)  : 完了として記録する (以降どのノードも確保できない)
+- release(key)   : 完了せずに手放す (別のノードや次回の再試行で処理される)。
+                   max_attempts 回確保しても完了しなかった作業は failed にし、拾い直さない
+                   (retry_failed() で pending に戻せる)
+- expired()      : 期限切れの作業 (落ちたノードが持っていたもの) を返す。生きているノードが拾い直す
+
+キーは任意の文字列。監視スクリプトはファイル (相対パス + サイズ + 更新時刻) と
+内容 (MD5) の 2 段で確保し、ハッシュ計算もアップロードも 1 ノードだけが行うようにしている。
+
+ネットワーク上のファイルシステムでは WAL が使えないので journal_mode は DELETE とし、
+書き込みは BEGIN IMMEDIATE で直列化する。
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from scripts.pipeline import log
+
+logger = log.get_logger("work_leases")
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    key         TEXT PRIMARY KEY,
+    path        TEXT NOT NULL DEFAULT '',
+    state       TEXT NOT NULL,
+    owner       TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_lease ON work (state, lease_until);
+"""
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkTable:
+    def __init__(self, db_path, node_id=None, lease_seconds=120.0, max_attempts=10):
+        """
+        Args:
+            db_path: 全ノードで共有する SQLite ファイル
+            node_id: このノードの名前 (省略時はホスト名-PID)
+            lease_seconds: 確保の有効期間。heartbeat はこの 1/3 ごとに延長する
+            max_attempts: この回数確保しても完了しなければ failed にする (0 で無制限)
+        """
+        self.db_path = db_path
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        self._held_lock = threading.Lock()
+        self._held = set()
+        self._stop = threading.Event()
+        self._thread = None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.executescript(_SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn):
+        # BEGIN IMMEDIATE で書き込みロックを先に取り、読み取りから更新までを不可分にする
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- 確保と完了 ------------------------------------------------------------
+    def claim(self, key, path=""):
+        """作業を確保できたら True (完了済み・他ノードが確保中なら False)"""
+        now = time.time()
+        until = now + self.lease_seconds
+
+        def _claim(conn):
+            row = conn.execute(
+                "SELECT state, owner, lease_until FROM work WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO work (key, path, state, owner, lease_until, attempts, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, 1, ?)",
+                    (key, path, LEASED, self.node_id, until, now),
+                )
+                return True
+            state, owner, lease_until = row
+            if state in (DONE, FAILED):
+                return False
+            if state == LEASED and owner != self.node_id and lease_until > now:
+                return False
+            conn.execute(
+                "UPDATE work SET path = ?, state = ?, owner = ?, lease_until = ?,"
+                " attempts = attempts + 1, updated_at = ? WHERE key = ?",
+                (path or "", LEASED, self.node_id, until, now, key),
+            )
+            return True
+
+        claimed = self._write(_claim)
+        if claimed:
+            with self._held_lock:
+                self._held.add(key)
+            self.start()
+        return claimed
+
+    def _finish(self, key, state):
+        now = time.time()
+        with self._held_lock:
+            self._held.discard(key)
+
+        def _update(conn):
+            new_state = state
+            if state == PENDING and self.max_attempts:
+                row = conn.execute("SELECT attempts FROM work WHERE key = ?", (key,)).fetchone()
+                if row and row[0] >= self.max_attempts:
+                    new_state = FAILED
+            cur = conn.execute(
+                "UPDATE work SET state = ?, owner = NULL, lease_until = 0, updated_at = ?"
+                " WHERE key = ? AND owner = ?",
+                (new_state, now, key, self.node_id),
+            )
+            return new_state if cur.rowcount else None
+
+        if self._write(_update) == FAILED:
+            logger.error("%d 回処理しても完了しないため、拾い直しをやめます: %s", self.max_attempts, key)
+
+    def complete(self, key):
+        self._finish(key, DONE)
+
+    def release(self, key):
+        self._finish(key, PENDING)
+
+    def retry_failed(self):
+        """failed の作業を pending に戻し、その件数を返します。"""
+        now = time.time()
+        return self._write(
+            lambda conn: conn.execute(
+                "UPDATE work SET state = ?, attempts = 0, updated_at = ? WHERE state = ?",
+                (PENDING, now, FAILED),
+            ).rowcount
+        )
+
+    def is_done(self, key):
+        row = self._conn().execute("SELECT state FROM work WHERE key = ?", (key,)).fetchone()
+        return bool(row and row[0] == DONE)
+
+    def expired(self, limit=100):
+        """期限が切れた作業と手放された作業を [(key, path)] で返す (拾い直し用)"""
+        now = time.time()
+        return self._conn().execute(
+            "SELECT key, path FROM work"
+            " WHERE (state = ? AND lease_until < ?) OR state = ?"
+            " ORDER BY updated_at LIMIT ?",
+            (LEASED, now, PENDING, limit),
+        ).fetchall()
+
+    def counts(self):
+        rows = self._conn().execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall()
+        return dict(rows)
+
+    # --- heartbeat -------------------------------------------------------------
+    def heartbeat(self):
+        """確保中の作業の期限を延長し、延長できた件数を返します。"""
+        with self._held_lock:
+            keys = list(self._held)
+        if not keys:
+            return 0
+        now = time.time()
+        until = now + self.lease_seconds
+
+        def _extend(conn):
+            extended = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                cur = conn.execute(
+                    "UPDATE work SET lease_until = ?, updated_at = ?"
+                    f" WHERE owner = ? AND state = ? AND key IN ({','.join('?' * len(chunk))})",
+                    (until, now, self.node_id, LEASED, *chunk),
+                )
+                extended += cur.rowcount
+            return extended
+
+        return self._write(_extend)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._held_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="eagle-work-heartbeat", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                # 延長できなくても期限までは有効。次の周期で再試行する
+                logger.error(f"作業の期限の延長に失敗: {e}")
+
+    def stop(self, release_held=True):
+        """heartbeat を止め、確保中の作業を手放します (他ノードがすぐに拾えるように)。"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if release_held:
+            with self._held_lock:
+                keys = list(self._held)
+            for key in keys:
+                self.release(key)